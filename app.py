@@ -1,8 +1,10 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, Response, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit
 import os
 import base64
+import json
 import numpy as np
 from PIL import Image
 import io
@@ -11,111 +13,579 @@ import threading
 import time
 
 # Import our custom modules
-from modules.data_handler import load_hyperspectral_data, create_rgb_visualization
+from modules.scene_registry import SceneRegistry, UnknownSceneError, DEFAULT_SCENE_ID
 from modules.iot_generator import generate_iot_data
-from modules.model_handler import run_prediction, CropClassifier, PATCH_SIZE
+from modules.model_handler import CropClassifier, PATCH_SIZE, ADAPTIVE_MODE
+from modules.inference_engine import InferenceEngine, InferenceConfig, configure_torch_threads
+from modules.batching_server import BatchingServer, classify_points
+from modules.model_export import load_inference_model
+from modules.spectral_reduction import load_reducer
+from modules.result_cache import ResultCache, fingerprint_state_dict, inference_cache_key
+from modules.map_encoding import negotiate_map_format, encode_map, MAP_HEADERS
+from modules.prediction_stream import RunningClassCounts, block_message
+from modules.tile_pyramid import TileCache, TilePyramids, parse_style
+from modules.roi import parse_roi, roi_mask, mask_fingerprint
+from modules.incremental_inference import ChangeTracker
+from modules.probability_maps import encode_probability_layer, validate_top_k, DEFAULT_TOP_K, PROBABILITY_HEADERS
+from modules.spectral_signatures import (batch_signatures, signatures_to_dict, encode_signatures, SIGNATURE_HEADERS,
+                                         SIGNATURE_MEDIA_TYPE)
+from modules.spectral_indices import (IndexCache, IndexExpressionError, resolve_index, index_cache_key, encode_raster,
+                                      raster_summary, zonal_summary, BUILTIN_INDICES, INDEX_BANDS, INDEX_FUNCTIONS,
+                                      RASTER_FORMATS, RASTER_HEADERS)
+from modules.metrics import (REGISTRY, REQUEST_SECONDS, REQUESTS_IN_PROGRESS, PROMETHEUS_CONTENT_TYPE, service_collector,
+                             set_enabled, stage_totals, timed)
+from modules.profiler import RequestProfiler, collapsed_stacks, DEFAULT_INTERVAL_MS
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, with every dumps (jsonify included) timed as the json_serialization stage."""
+
+    def dumps(self, obj, **kwargs):
+        with timed('json_serialization'):
+            return super().dumps(obj, **kwargs)
 
 app = Flask(__name__)
-CORS(app)
+app.json = TimedJSONProvider(app)
+CORS(app, expose_headers=list(MAP_HEADERS) + list(RASTER_HEADERS) + list(SIGNATURE_HEADERS) + list(PROBABILITY_HEADERS) + ['X-Index-Summary', 'ETag', 'X-Profile-Id']) # Binary map/raster metadata, tile validators, profiles
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
 # --- Global Variables (to store data in memory for the session) ---
-hypercube_data = None
-ground_truth_data = None
-trained_model = None
-prediction_map_data = None
-num_classes_global = 16 # Indian Pines has 16 classes (0-15, 0 is background)
+active_scene_id = DEFAULT_SCENE_ID # Scene used when a request names none
+scene_models = {} # Model path -> (model, inference engine, weights fingerprint)
+prediction_maps = {} # Scene id -> latest prediction map
+inference_servers = {} # Model path -> micro-batching server shared by every request using that model
+scene_models_lock = threading.Lock()
 
 # --- Configuration ---
 DATA_FOLDER = 'data'
 MODEL_PATH = os.path.join('models', 'crop_classifier.pth') # PyTorch model path
+MODEL_VARIANT = os.getenv('MODEL_VARIANT', 'fp32') # fp32, int8, torchscript, torchscript_int8 or onednn (see modules/model_export.py)
+INFERENCE_CONFIG = InferenceConfig.from_env() # INFERENCE_MODE, INFERENCE_WORKERS, INFERENCE_EXECUTOR, ...
+INFERENCE_SERVER_BATCH_SIZE = int(os.getenv('INFERENCE_SERVER_BATCH_SIZE', str(INFERENCE_CONFIG.batch_size))) # Patches per coalesced batch
+INFERENCE_SERVER_MAX_LATENCY_MS = float(os.getenv('INFERENCE_SERVER_MAX_LATENCY_MS', '5')) # Longest a partial batch waits for other callers
+RESULT_CACHE_FOLDER = os.getenv('RESULT_CACHE_FOLDER', os.path.join(DATA_FOLDER, 'cache', 'results'))
+RESULT_CACHE_MEMORY_MB = int(os.getenv('RESULT_CACHE_MEMORY_MB', '256')) # In-memory LRU budget for prediction maps
+RESULT_CACHE_DISK_MB = int(os.getenv('RESULT_CACHE_DISK_MB', '2048')) # Oldest result files are pruned beyond this
+SCENE_MEMORY_MB = int(os.getenv('SCENE_MEMORY_MB', '1024')) # Budget for resident scene cubes, least recently used evicted first
+TILE_CACHE_FOLDER = os.getenv('TILE_CACHE_FOLDER', os.path.join(DATA_FOLDER, 'cache', 'tiles'))
+TILE_CACHE_MEMORY_MB = int(os.getenv('TILE_CACHE_MEMORY_MB', '64')) # In-memory LRU budget for PNG tiles
+TILE_CACHE_DISK_MB = int(os.getenv('TILE_CACHE_DISK_MB', '512')) # Oldest tile files are pruned beyond this
+TILE_MAX_AGE = int(os.getenv('TILE_MAX_AGE', '3600')) # Cache-Control max-age of tiles and previews, in seconds
+RGB_PREVIEW_MAX_PIXELS = int(os.getenv('RGB_PREVIEW_MAX_PIXELS', '1048576')) # Larger scenes are only served as tiles
+INDEX_CACHE_FOLDER = os.getenv('INDEX_CACHE_FOLDER', os.path.join(DATA_FOLDER, 'cache', 'indices'))
+INDEX_CACHE_MEMORY_MB = int(os.getenv('INDEX_CACHE_MEMORY_MB', '128')) # In-memory LRU budget for spectral index rasters
+INDEX_CACHE_DISK_MB = int(os.getenv('INDEX_CACHE_DISK_MB', '1024')) # Oldest index rasters are pruned beyond this
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True').lower() == 'true' # Stage / request timings and /metrics
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'False').lower() == 'true' # Allows ?profile=1 and /debug/profiles
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0')) # Share of requests profiled unasked, when profiling is enabled
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', str(DEFAULT_INTERVAL_MS))) # Time between stack samples
+
+scene_registry = SceneRegistry(DATA_FOLDER, memory_budget_bytes=SCENE_MEMORY_MB * 1024 * 1024)
+result_cache = ResultCache(RESULT_CACHE_FOLDER, max_memory_bytes=RESULT_CACHE_MEMORY_MB * 1024 * 1024,
+                           max_disk_bytes=RESULT_CACHE_DISK_MB * 1024 * 1024)
+change_tracker = ChangeTracker(result_cache) # Tile checksums of each scene's last analysed cube, for incremental re-analysis
+tile_pyramids = TilePyramids(TileCache(TILE_CACHE_FOLDER, max_memory_bytes=TILE_CACHE_MEMORY_MB * 1024 * 1024,
+                                       max_disk_bytes=TILE_CACHE_DISK_MB * 1024 * 1024))
+index_cache = IndexCache(INDEX_CACHE_FOLDER, max_memory_bytes=INDEX_CACHE_MEMORY_MB * 1024 * 1024,
+                         max_disk_bytes=INDEX_CACHE_DISK_MB * 1024 * 1024)
+request_profiler = RequestProfiler(PROFILING_ENABLED, PROFILE_SAMPLE_RATE, PROFILE_INTERVAL_MS / 1000)
+configure_torch_threads(INFERENCE_CONFIG) # PyTorch thread counts are process-wide: set once here, not per run
+set_enabled(METRICS_ENABLED)
+REGISTRY.register_collector(service_collector(result_cache, tile_pyramids.cache, index_cache, scene_registry, inference_servers,
+                                              change_tracker))
 
 # --- Load Model on Startup ---
 # @app.before_first_request # Deprecated in newer Flask versions
-def _load_trained_model_on_startup():
-    global trained_model, num_classes_global
-    # We need to know num_classes to initialize the model.
-    # A robust way is to load data first to determine it.
-    # For simplicity here, we'll assume it's 16 (Indian Pines classes).
-    # In a real app, you might save num_classes with the model or derive it.
-
-    if os.path.exists(MODEL_PATH):
+def _scene_model(info):
+    """Returns (model, inference engine, weights fingerprint) for a scene, or None if it has no usable model."""
+    model_path = info.model_path
+    if not model_path:
+        return None
+    with scene_models_lock:
+        if model_path in scene_models:
+            return scene_models[model_path]
+        if not os.path.exists(model_path):
+            print(f"PyTorch model not found at {model_path}. Please run train.py first.")
+            return None
         try:
-            trained_model = CropClassifier(num_classes=num_classes_global)
-            trained_model.load_state_dict(torch.load(MODEL_PATH, map_location=torch.device('cpu')))
-            trained_model.eval() # Set to evaluation mode
-            print(f"Successfully loaded trained PyTorch model from {MODEL_PATH}")
+            model = load_inference_model(model_path, info.num_classes, MODEL_VARIANT)
+            model.eval() # Set to evaluation mode
+            # The spectral reducer (if the model was trained on a reduced cube) is part of the fingerprint
+            reducer = load_reducer(model_path)
+            state_dict = torch.load(model_path, map_location=torch.device('cpu'))
+            fingerprint = fingerprint_state_dict({**state_dict, **(reducer.state_dict() if reducer else {})})
+            # Patch batches of all requests for this model are coalesced by one server
+            server = BatchingServer(model, INFERENCE_SERVER_BATCH_SIZE, INFERENCE_SERVER_MAX_LATENCY_MS)
+            inference_servers[model_path] = server
+            engine = InferenceEngine(model, INFERENCE_CONFIG, reducer=reducer, batching_server=server)
+            scene_models[model_path] = (model, engine, fingerprint)
+            print(f"Successfully loaded trained PyTorch model from {model_path}")
         except Exception as e:
             print(f"Error loading PyTorch model: {e}")
-            trained_model = None
-    else:
-        print(f"PyTorch model not found at {MODEL_PATH}. Please run train.py first.")
-
-# Call the function directly when the app starts
-_load_trained_model_on_startup()
+            scene_models[model_path] = None
+        return scene_models[model_path]
+
+def _autotune_inference():
+    """
+    With INFERENCE_AUTOTUNE=true, times the inference settings on the default scene
+    before any request is served; engines created later use the tuned config.
+    """
+    global INFERENCE_CONFIG
+    scene_model = _scene_model(scene_registry.info(active_scene_id))
+    if not INFERENCE_CONFIG.autotune or scene_model is None:
+        return
+    try:
+        INFERENCE_CONFIG = scene_model[1].autotune(scene_registry.load(active_scene_id).hypercube)
+    except (FileNotFoundError, UnknownSceneError) as e:
+        print(f"Inference autotuning skipped: {e}")
+
+# Load the default scene's model directly when the app starts; other scenes' models load on first use
+_scene_model(scene_registry.info(active_scene_id))
+_autotune_inference()
+
+def _analysis_cache_key(scene, model_fingerprint, mask=None, top_k=0, lineage=False):
+    """
+    Prediction cache key for a scene's cube, model weights, inference settings, region of interest and probability outputs.
+    With lineage=True the key names the scene instead of its cube's content: the analysis an updated cube is diffed against.
+    """
+    config = {'mode': INFERENCE_CONFIG.mode, 'variant': MODEL_VARIANT, 'patch_size': PATCH_SIZE}
+    if INFERENCE_CONFIG.mode == ADAPTIVE_MODE:
+        config.update(grid_step=INFERENCE_CONFIG.adaptive_grid_step, min_confidence=INFERENCE_CONFIG.adaptive_min_confidence)
+    if mask is not None:
+        config['roi'] = mask_fingerprint(mask)
+    if top_k:
+        config['top_k'] = top_k
+    cube = f'scene:{scene.info.scene_id}' if lineage else scene.fingerprint
+    return inference_cache_key(cube, model_fingerprint, config)
+
+def _roi_mask(scene, params):
+    """The region-of-interest mask requested by roi / bbox / polygon parameters, or None. Raises ValueError."""
+    spec = parse_roi(params.get('roi'), params.get('bbox'), params.get('polygon'))
+    if spec is None:
+        return None
+    height, width = scene.hypercube.shape[:2]
+    return roi_mask(spec, height, width, scene.ground_truth)
+
+def _run_scene_analysis(scene, block_callback=None, mask=None, top_k=0):
+    """
+    Classifies a scene, or only the pixels of a mask (or reuses the cached result), and remembers the map for reports.
+    Returns (prediction_map, class_summary), plus the probability maps when top_k > 0.
+    """
+    _, engine, model_fingerprint = _scene_model(scene.info)
+    cache_key = _analysis_cache_key(scene, model_fingerprint, mask, top_k)
+    lineage_key = _analysis_cache_key(scene, model_fingerprint, mask, top_k, lineage=True)
+    # AI Prediction (reused from the prediction cache when cube, model, settings and region are unchanged;
+    # after a scene update only the tiles that changed since its last analysis are re-classified)
+    result = result_cache.get_or_compute(
+        cache_key, lambda: change_tracker.run(engine, scene.hypercube, lineage_key, cache_key, mask=mask, top_k=top_k,
+                                              block_callback=block_callback, checksums=scene.tile_checksums,
+                                              normalization=scene.normalization))
+    prediction_maps[scene.info.scene_id] = result[0]
+    return result
+
+def _scene_pyramid(scene, bands=None, percentiles=None):
+    """The RGB tile pyramid of a scene for a band triplet and stretch (defaults: the scene's). Raises ValueError."""
+    rgb_bands, stretch = parse_style(bands or scene.info.rgb_bands, percentiles)
+    return tile_pyramids.get(scene.hypercube, scene.fingerprint, rgb_bands, stretch, scene.histograms)
+
+def _tiles_info(scene, pyramid):
+    query = f"scene_id={scene.info.scene_id}&bands={','.join(map(str, pyramid.rgb_bands))}" \
+            f"&percentiles={','.join(f'{p:g}' for p in pyramid.percentiles)}"
+    return {**pyramid.info(), 'url': '/tiles/{z}/{x}/{y}.png?' + query,
+            'preview_url': f'/api/scenes/{scene.info.scene_id}/preview.png?' + query.split('&', 1)[1]}
+
+def _scene_preview(scene):
+    """The scene's cached RGB preview as a data URL (None above RGB_PREVIEW_MAX_PIXELS) and its tile pyramid."""
+    pyramid = _scene_pyramid(scene)
+    height, width = scene.hypercube.shape[:2]
+    rgb_image = None
+    if height * width <= RGB_PREVIEW_MAX_PIXELS:
+        preview_png = pyramid.preview_png()
+        with timed('base64_encode'):
+            rgb_image = f"data:image/png;base64,{base64.b64encode(preview_png).decode('utf-8')}"
+    return rgb_image, _tiles_info(scene, pyramid)
+
+def _png_response(etag, render):
+    """PNG response validated by etag; render() is only called when the client's copy is stale."""
+    headers = {'ETag': etag, 'Cache-Control': f'public, max-age={TILE_MAX_AGE}'}
+    if request.if_none_match.contains(etag.strip('"')):
+        return Response(status=304, headers=headers)
+    return Response(render(), mimetype='image/png', headers=headers)
+
+# --- Request instrumentation ---
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+    if METRICS_ENABLED:
+        REQUESTS_IN_PROGRESS.inc(1)
+    if request_profiler.should_profile(request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1'):
+        g.profile = request_profiler.begin(request.method, request.path)
+
+@app.after_request
+def _record_request(response):
+    """Times every request by URL rule and hands back the id of its profile, if one was sampled."""
+    profile = g.pop('profile', None)
+    if profile is not None:
+        response.headers['X-Profile-Id'] = request_profiler.end(profile, response.status_code)
+    if METRICS_ENABLED and 'request_start' in g:
+        rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, request.method, rule, response.status_code)
+    return response
+
+@app.teardown_request
+def _finish_request(error=None):
+    # Runs after after_request, and also when a request failed before reaching it
+    if METRICS_ENABLED and 'request_start' in g:
+        REQUESTS_IN_PROGRESS.inc(-1)
+    profile = g.pop('profile', None)
+    if profile is not None:
+        request_profiler.end(profile, 500)
 
 # --- Routes ---
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/api/scenes')
+def api_list_scenes():
+    return jsonify({'success': True, 'active_scene_id': active_scene_id, 'scenes': scene_registry.scenes(),
+                    'residency': scene_registry.stats()})
+
 @app.route('/api/load_data')
 def api_load_data():
-    global hypercube_data, ground_truth_data
+    global active_scene_id
     try:
-        hypercube_data, ground_truth_data = load_hyperspectral_data(DATA_FOLDER)
-        rgb_image_pil = create_rgb_visualization(hypercube_data)
-        
-        # Convert PIL Image to base64 string
-        buffered = io.BytesIO()
-        rgb_image_pil.save(buffered, format="PNG")
-        rgb_image_b64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        
-        return jsonify({'success': True, 'rgb_image_b64': f'data:image/png;base64,{rgb_image_b64}', 'hypercube_shape': hypercube_data.shape})
+        scene = scene_registry.load(request.args.get('scene_id') or active_scene_id)
+        active_scene_id = scene.info.scene_id
+        rgb_image, tiles = _scene_preview(scene)
+        return jsonify({'success': True, 'rgb_image_b64': rgb_image, 'tiles': tiles,
+                        'hypercube_shape': scene.hypercube.shape, 'scene': scene.info.to_dict()})
+    except UnknownSceneError as e:
+        return jsonify({'success': False, 'message': e.args[0]}), 404
     except FileNotFoundError as e:
         return jsonify({'success': False, 'message': str(e)}), 404
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error loading data: {str(e)}'}), 500
 
+@app.route('/api/scenes/<scene_id>/reload', methods=['POST'])
+def api_reload_scene(scene_id):
+    """
+    Re-reads a scene whose files were replaced (e.g. a new acquisition over part of the
+    field); its next analysis re-classifies only the tiles that changed.
+    """
+    try:
+        scene, previous_fingerprint = scene_registry.reload(scene_id)
+    except UnknownSceneError as e:
+        return jsonify({'success': False, 'message': e.args[0]}), 404
+    except FileNotFoundError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    return jsonify({'success': True, 'scene_id': scene.info.scene_id, 'fingerprint': scene.fingerprint,
+                    'changed': previous_fingerprint is not None and previous_fingerprint != scene.fingerprint})
+
+@app.route('/api/scenes/<scene_id>/stats')
+def api_scene_stats(scene_id):
+    """Per-band min/max/mean/std and class mean spectra; ?histogram_bins=N adds N-bin band histograms."""
+    try:
+        scene = scene_registry.load(scene_id)
+        statistics = scene.statistics.to_dict(request.args.get('histogram_bins', type=int))
+        return jsonify({'success': True, 'scene_id': scene.info.scene_id, 'statistics': statistics})
+    except UnknownSceneError as e:
+        return jsonify({'success': False, 'message': e.args[0]}), 404
+    except FileNotFoundError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+@app.route('/api/scenes/<scene_id>/tiles')
+def api_scene_tiles(scene_id):
+    try:
+        scene = scene_registry.load(scene_id)
+        pyramid = _scene_pyramid(scene, request.args.get('bands'), request.args.get('percentiles'))
+        return jsonify({'success': True, 'tiles': _tiles_info(scene, pyramid)})
+    except UnknownSceneError as e:
+        return jsonify({'success': False, 'message': e.args[0]}), 404
+    except FileNotFoundError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Invalid bands or percentiles: {e}'}), 400
+
+@app.route('/api/scenes/<scene_id>/preview.png')
+def api_scene_preview(scene_id):
+    try:
+        scene = scene_registry.load(scene_id)
+        pyramid = _scene_pyramid(scene, request.args.get('bands'), request.args.get('percentiles'))
+        return _png_response(pyramid.etag('preview'), pyramid.preview_png)
+    except UnknownSceneError as e:
+        return jsonify({'success': False, 'message': e.args[0]}), 404
+    except FileNotFoundError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Invalid bands or percentiles: {e}'}), 400
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.png')
+def api_tile(z, x, y):
+    """One 256x256 RGB preview tile (XYZ scheme), cached and revalidated with ETag/If-None-Match."""
+    try:
+        scene = scene_registry.load(request.args.get('scene_id') or active_scene_id)
+        pyramid = _scene_pyramid(scene, request.args.get('bands'), request.args.get('percentiles'))
+        return _png_response(pyramid.etag(z, x, y), lambda: pyramid.tile_png(z, x, y))
+    except UnknownSceneError as e:
+        return jsonify({'success': False, 'message': e.args[0]}), 404
+    except (FileNotFoundError, IndexError) as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Invalid bands or percentiles: {e}'}), 400
+
 @app.route('/api/run_analysis', methods=['GET'])
 def api_run_analysis():
-    global prediction_map_data
-    if hypercube_data is None:
-        return jsonify({'success': False, 'message': 'Please load hyperspectral data first.'}), 400
-    if trained_model is None:
+    try:
+        scene = scene_registry.load(request.args.get('scene_id') or active_scene_id)
+    except UnknownSceneError as e:
+        return jsonify({'success': False, 'message': e.args[0]}), 404
+    except FileNotFoundError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    if _scene_model(scene.info) is None:
         return jsonify({'success': False, 'message': 'Trained PyTorch model not found. Please run train.py first.'}), 400
 
+    # JSON unless the Accept header (or ?format=raw|rle|png) asks for a binary map; see modules/map_encoding.py
+    # ?roi=ground_truth, ?bbox=x0,y0,x1,y1 and ?polygon=[[x,y],...] classify only the selected pixels
     try:
+        map_format = negotiate_map_format(request.headers.get('Accept'), request.args.get('format'))
+        mask = _roi_mask(scene, request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    try:
+        prediction_map, class_summary = _run_scene_analysis(scene, mask=mask)
+
+        if map_format != 'json':
+            # Binary map in the body, shape/dtype/summary in X-Map-* headers
+            body, media_type, headers = encode_map(prediction_map, map_format, class_summary)
+            return Response(body, mimetype=media_type, headers={**headers, 'Vary': 'Accept'})
+
         # IoT Data
         iot_data = generate_iot_data(24) # Simulate 24 hours of data
 
-        # AI Prediction
-        prediction_map_data, class_summary = run_prediction(trained_model, hypercube_data)
-        
         # Convert prediction map to a flat list for easy transfer to JS
-        prediction_map_flat = prediction_map_data.flatten().tolist()
+        prediction_map_flat = prediction_map.flatten().tolist()
 
         return jsonify({'success': True, 'iot_data': iot_data, 'prediction_map': prediction_map_flat, 'class_summary': class_summary})
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error running analysis: {str(e)}'}), 500
 
+@app.route('/api/probability_maps')
+def api_probability_maps():
+    """
+    One layer of the per-pixel probability maps as a compact raster: ?layer=confidence,
+    margin, top_k_probabilities (f16, f32 or png) or top_k_labels (raw, rle or png),
+    &rank= picking one of the ?top_k= most probable classes. The maps come from the
+    same forwards as the label map and are cached with it; roi / bbox / polygon as
+    for /api/run_analysis.
+    """
+    try:
+        scene = scene_registry.load(request.args.get('scene_id') or active_scene_id)
+    except UnknownSceneError as e:
+        return jsonify({'success': False, 'message': e.args[0]}), 404
+    except FileNotFoundError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    if _scene_model(scene.info) is None:
+        return jsonify({'success': False, 'message': 'Trained PyTorch model not found. Please run train.py first.'}), 400
+    if INFERENCE_CONFIG.mode == ADAPTIVE_MODE:
+        return jsonify({'success': False, 'message': 'Probability maps are not available with INFERENCE_MODE=adaptive.'}), 400
+
+    try:
+        top_k = validate_top_k(int(request.args.get('top_k', DEFAULT_TOP_K)))
+        rank = int(request.args.get('rank', 1))
+        mask = _roi_mask(scene, request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    try:
+        _, _, probability_maps = _run_scene_analysis(scene, mask=mask, top_k=top_k)
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error running analysis: {str(e)}'}), 500
+    try:
+        body, media_type, headers = encode_probability_layer(probability_maps, request.args.get('layer', 'confidence'),
+                                                             rank, request.args.get('format'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return Response(body, mimetype=media_type, headers=headers)
+
 @app.route('/api/get_spectral_signature')
 def api_get_spectral_signature():
     x = int(request.args.get('x'))
     y = int(request.args.get('y'))
 
-    if hypercube_data is None:
+    try:
+        hypercube = scene_registry.load(request.args.get('scene_id') or active_scene_id).hypercube
+    except UnknownSceneError as e:
+        return jsonify({'success': False, 'message': e.args[0]}), 404
+    except FileNotFoundError:
         return jsonify({'success': False, 'message': 'Hyperspectral data not loaded.'}), 400
 
     try:
         # Extract the full spectral vector for the clicked pixel
-        spectral_signature = hypercube_data[y, x, :].tolist()
+        spectral_signature = hypercube[y, x, :].tolist()
         return jsonify({'success': True, 'spectral_signature': spectral_signature})
     except IndexError:
         return jsonify({'success': False, 'message': 'Invalid pixel coordinates.'}), 400
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error getting spectral signature: {str(e)}'}), 500
 
+@app.route('/api/spectral_signatures', methods=['POST'])
+def api_spectral_signatures():
+    """
+    Spectra of many pixels ('points': [[x, y], ...]) and mean / std spectra of regions
+    ('regions': rectangles or polygons) in one request; 'format': 'f32' returns one float32 buffer.
+    """
+    data = request.get_json() or {}
+    try:
+        hypercube = scene_registry.load(data.get('scene_id') or active_scene_id).hypercube
+    except UnknownSceneError as e:
+        return jsonify({'success': False, 'message': e.args[0]}), 404
+    except FileNotFoundError:
+        return jsonify({'success': False, 'message': 'Hyperspectral data not loaded.'}), 400
+
+    fmt = data.get('format') or ('f32' if SIGNATURE_MEDIA_TYPE in request.headers.get('Accept', '') else 'json')
+    if fmt not in ('json', 'f32'):
+        return jsonify({'success': False, 'message': "format must be 'json' or 'f32'."}), 400
+    try:
+        spectra, regions = batch_signatures(hypercube, data.get('points') or [], data.get('regions') or [])
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    if fmt == 'f32':
+        body, media_type, headers = encode_signatures(spectra, regions)
+        return Response(body, mimetype=media_type, headers={**headers, 'Vary': 'Accept'})
+    return jsonify({'success': True, **signatures_to_dict(spectra, regions)})
+
+@app.route('/api/classify_pixels', methods=['POST'])
+def api_classify_pixels():
+    """
+    Classifies individual pixels ('points': [[x, y], ...]) through the model's shared
+    micro-batching server, so concurrent clients' pixels share model batches.
+    """
+    data = request.get_json() or {}
+    try:
+        scene = scene_registry.load(data.get('scene_id') or active_scene_id)
+    except UnknownSceneError as e:
+        return jsonify({'success': False, 'message': e.args[0]}), 404
+    except FileNotFoundError:
+        return jsonify({'success': False, 'message': 'Hyperspectral data not loaded.'}), 400
+    scene_model = _scene_model(scene.info)
+    if scene_model is None:
+        return jsonify({'success': False, 'message': 'Trained PyTorch model not found. Please run train.py first.'}), 400
+
+    _, engine, _ = scene_model
+    try:
+        labels, confidence = classify_points(inference_servers[scene.info.model_path], scene.hypercube,
+                                             data.get('points') or [], engine.reducer)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({'success': True, 'labels': labels.tolist(), 'confidence': confidence.tolist()})
+
+@app.route('/api/inference_server/stats')
+def api_inference_server_stats():
+    """Queue length, batch-fill ratio and request latency of each model's micro-batching server, and incremental re-analysis counts."""
+    return jsonify({'success': True, 'servers': {path: server.stats() for path, server in list(inference_servers.items())},
+                    'incremental': change_tracker.stats()})
+
+@app.route('/metrics')
+def metrics():
+    """Stage and request histograms plus cache, scene and queue counters, in the Prometheus text format."""
+    if not METRICS_ENABLED:
+        return jsonify({'success': False, 'message': 'Metrics are disabled (METRICS_ENABLED=false).'}), 404
+    return Response(REGISTRY.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+@app.route('/debug/profiles')
+def api_list_profiles():
+    """Summaries of the most recent request profiles, newest first, with the stage totals so far."""
+    if not request_profiler.enabled:
+        return jsonify({'success': False, 'message': 'Profiling is disabled (set PROFILING_ENABLED=true).'}), 404
+    return jsonify({'success': True, 'profiles': request_profiler.profiles(), 'stages': stage_totals()})
+
+@app.route('/debug/profiles/<profile_id>')
+def api_get_profile(profile_id):
+    """One request profile, as collapsed stacks (flamegraph.pl, speedscope) or, with format=json, its summary."""
+    if not request_profiler.enabled:
+        return jsonify({'success': False, 'message': 'Profiling is disabled (set PROFILING_ENABLED=true).'}), 404
+    profile = request_profiler.get(profile_id)
+    if profile is None:
+        return jsonify({'success': False, 'message': f'Unknown profile \'{profile_id}\'.'}), 404
+    fmt = request.args.get('format', 'collapsed')
+    if fmt == 'json':
+        return jsonify({'success': True, 'profile': request_profiler.summary(profile)})
+    if fmt != 'collapsed':
+        return jsonify({'success': False, 'message': 'format must be \'collapsed\' or \'json\'.'}), 400
+    return Response(collapsed_stacks(profile['stacks']), mimetype='text/plain')
+
+@app.route('/api/indices')
+def api_list_indices():
+    return jsonify({'success': True, 'indices': BUILTIN_INDICES, 'bands': INDEX_BANDS,
+                    'functions': sorted(INDEX_FUNCTIONS), 'formats': list(RASTER_FORMATS)})
+
+def _index_raster(scene):
+    """(index name, compiled index, raster) for ?index= / ?expression=, computed once per cube and expression."""
+    name, spectral_index = resolve_index(request.args.get('index'), request.args.get('expression'),
+                                         scene.hypercube.shape[2])
+    raster = index_cache.get_or_compute(index_cache_key(scene.fingerprint, spectral_index),
+                                        lambda: spectral_index.compute(scene.hypercube))
+    return name, spectral_index, raster
+
+@app.route('/api/indices/raster')
+def api_index_raster():
+    """A spectral index over the whole scene as one binary raster (f16, f32 or greyscale PNG over ?range=)."""
+    try:
+        scene = scene_registry.load(request.args.get('scene_id') or active_scene_id)
+        name, spectral_index, raster = _index_raster(scene)
+        value_range = request.args.get('range')
+        value_range = tuple(float(v) for v in value_range.split(',')) if value_range else None
+        if value_range is not None and len(value_range) != 2:
+            raise ValueError('range must be two comma-separated numbers.')
+        body, media_type, headers = encode_raster(raster, request.args.get('format', 'f16'), value_range)
+    except UnknownSceneError as e:
+        return jsonify({'success': False, 'message': e.args[0]}), 404
+    except FileNotFoundError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    summary = {'index': name, 'expression': spectral_index.expression, 'bands': spectral_index.band_map,
+               **raster_summary(raster)}
+    headers['X-Index-Summary'] = json.dumps(summary, separators=(',', ':'))
+    return Response(body, mimetype=media_type, headers=headers)
+
+@app.route('/api/indices/zonal')
+def api_index_zonal():
+    """Per-class statistics of a spectral index over ?zones=ground_truth (default) or prediction."""
+    try:
+        scene = scene_registry.load(request.args.get('scene_id') or active_scene_id)
+        zones = request.args.get('zones', 'ground_truth')
+        if zones == 'ground_truth':
+            labels = scene.ground_truth
+        elif zones == 'prediction':
+            labels = prediction_maps.get(scene.info.scene_id)
+            if labels is None:
+                return jsonify({'success': False, 'message': 'No prediction map for this scene yet. Run analysis first.'}), 400
+        else:
+            return jsonify({'success': False, 'message': "zones must be 'ground_truth' or 'prediction'."}), 400
+        name, spectral_index, raster = _index_raster(scene)
+    except UnknownSceneError as e:
+        return jsonify({'success': False, 'message': e.args[0]}), 404
+    except FileNotFoundError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({'success': True, 'scene_id': scene.info.scene_id, 'index': name,
+                    'expression': spectral_index.expression, 'bands': spectral_index.band_map, 'zones': zones,
+                    'summary': raster_summary(raster), 'classes': zonal_summary(raster, labels)})
+
+def _resident_scene_data(scene_id):
+    """(loaded scene, prediction map) of a scene for reports and exports; None for what is unavailable."""
+    scene_id = scene_id or active_scene_id
+    try:
+        scene = scene_registry.load(scene_id)
+    except FileNotFoundError:
+        scene = None
+    return scene, prediction_maps.get(scene_id)
+
 @app.route('/api/generate_report', methods=['POST'])
 def api_generate_report():
     """Generate comprehensive agricultural report"""
@@ -125,6 +595,8 @@ def api_generate_report():
         include_iot = data.get('include_iot', True)
         include_analysis = data.get('include_analysis', True)
         include_spectral = data.get('include_spectral', True)
+        scene, prediction_map_data = _resident_scene_data(data.get('scene_id'))
+        hypercube_data = scene.hypercube if scene is not None else None
 
         # Collect data based on request parameters
         report_data = {
@@ -158,7 +630,9 @@ def api_generate_report():
             report_data['spectral_summary'] = {
                 'data_shape': hypercube_data.shape,
                 'wavelengths': hypercube_data.shape[2] if len(hypercube_data.shape) > 2 else 0,
-                'avg_spectral_signature': np.mean(hypercube_data, axis=(0, 1)).tolist()
+                # Precomputed band statistics; the cube is not rescanned per report
+                'avg_spectral_signature': scene.statistics.mean.tolist(),
+                'std_spectral_signature': scene.statistics.std.tolist()
             }
 
         if report_format == 'json':
@@ -222,6 +696,8 @@ def api_export_data():
         export_format = data.get('format', 'csv')
         data_types = data.get('data_types', ['iot'])
         date_range = data.get('date_range', None)
+        scene, prediction_map_data = _resident_scene_data(data.get('scene_id'))
+        hypercube_data = scene.hypercube if scene is not None else None
 
         # Collect requested data
         export_data = {}
@@ -294,59 +770,76 @@ def handle_disconnect():
     print(f'Client disconnected: {request.sid}')
 
 @socketio.on('request_initial_data')
-def handle_request_initial_data():
-    """Handle request for initial data"""
+def handle_request_initial_data(data=None):
+    """Handle request for initial data (optionally for data['scene_id'])"""
     print(f'Received request_initial_data from client: {request.sid}')
     try:
-        global hypercube_data, ground_truth_data
-        
-        # Load data if not already loaded
-        if hypercube_data is None or ground_truth_data is None:
-            hypercube_data, ground_truth_data = load_hyperspectral_data(DATA_FOLDER)
+        global active_scene_id
         
-        # Create RGB visualization
-        rgb_image_pil = create_rgb_visualization(hypercube_data)
+        # Load data if not already resident
+        scene = scene_registry.load((data or {}).get('scene_id') or active_scene_id)
+        active_scene_id = scene.info.scene_id
         
-        # Convert PIL Image to base64 string
-        buffered = io.BytesIO()
-        rgb_image_pil.save(buffered, format="PNG")
-        rgb_image_b64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+        # RGB preview (rendered once per scene) and tile pyramid for large scenes
+        rgb_image, tiles = _scene_preview(scene)
         
         # Emit initial data
         emit('initial_data', {
             'success': True,
-            'rgb_image_b64': f'data:image/png;base64,{rgb_image_b64}',
-            'hypercube_shape': hypercube_data.shape,
+            'rgb_image_b64': rgb_image,
+            'tiles': tiles,
+            'hypercube_shape': scene.hypercube.shape,
+            'scene': scene.info.to_dict(),
             'message': 'Initial data loaded successfully'
         })
         
+    except UnknownSceneError as e:
+        emit('connection_error', {'error': e.args[0]})
     except FileNotFoundError as e:
         emit('connection_error', {'error': str(e)})
     except Exception as e:
         emit('connection_error', {'error': f'Error loading initial data: {str(e)}'})
 
+def _socket_analysis_scene(data):
+    """
+    The scene a socket analysis request refers to and its region-of-interest mask
+    (data['roi'] / data['bbox'] / data['polygon'], None for the whole scene),
+    or (None, None) after emitting analysis_error.
+    """
+    try:
+        scene = scene_registry.load((data or {}).get('scene_id') or active_scene_id)
+    except UnknownSceneError as e:
+        emit('analysis_error', {'error': e.args[0]})
+        return None, None
+    except FileNotFoundError:
+        emit('analysis_error', {'error': 'Please load hyperspectral data first.'})
+        return None, None
+
+    if _scene_model(scene.info) is None:
+        emit('analysis_error', {'error': 'Trained PyTorch model not found. Please run train.py first.'})
+        return None, None
+    try:
+        return scene, _roi_mask(scene, data or {})
+    except ValueError as e:
+        emit('analysis_error', {'error': str(e)})
+        return None, None
+
 @socketio.on('request_analysis')
-def handle_request_analysis():
-    """Handle request for AI analysis"""
+def handle_request_analysis(data=None):
+    """Handle request for AI analysis (optionally for data['scene_id'])"""
     try:
-        global prediction_map_data
-        
-        if hypercube_data is None:
-            emit('analysis_error', {'error': 'Please load hyperspectral data first.'})
-            return
-            
-        if trained_model is None:
-            emit('analysis_error', {'error': 'Trained PyTorch model not found. Please run train.py first.'})
+        scene, mask = _socket_analysis_scene(data)
+        if scene is None:
             return
 
         # Generate IoT data
         iot_data = generate_iot_data(24)
 
-        # Run AI prediction
-        prediction_map_data, class_summary = run_prediction(trained_model, hypercube_data)
+        # Run AI prediction (reused from the prediction cache when cube, model and settings are unchanged)
+        prediction_map, class_summary = _run_scene_analysis(scene, mask=mask)
         
         # Convert prediction map to a flat list for easy transfer to JS
-        prediction_map_flat = prediction_map_data.flatten().tolist()
+        prediction_map_flat = prediction_map.flatten().tolist()
 
         # Emit analysis results
         emit('analysis_result', {
@@ -367,6 +860,52 @@ def handle_request_analysis():
     except Exception as e:
         emit('analysis_error', {'error': f'Error running analysis: {str(e)}'})
 
+@socketio.on('request_analysis_stream')
+def handle_request_analysis_stream(data=None):
+    """
+    Handle request for AI analysis, streaming the prediction map as it is computed.
+
+    Emits 'analysis_block' for every finished row block (rows, labels and running
+    class counts; labels as a list, or as a binary attachment when data['format']
+    is 'raw', 'rle' or 'png'), then 'analysis_complete' with the class summary.
+    """
+    try:
+        map_format = (data or {}).get('format', 'json')
+        scene, mask = _socket_analysis_scene(data)
+        if scene is None:
+            return
+
+        sid = request.sid
+        height = scene.hypercube.shape[0]
+        class_counts = RunningClassCounts()
+        rows_streamed = 0
+
+        def send_block(r0, r1, labels):
+            nonlocal rows_streamed
+            class_counts.add(labels)
+            rows_streamed += r1 - r0
+            # socketio.emit rather than emit: shards may finish on engine worker threads
+            socketio.emit('analysis_block', block_message(r0, r1, labels, class_counts.summary(), height,
+                                                          map_format, binary=True), to=sid)
+
+        # Run AI prediction (reused from the prediction cache when cube, model and settings are unchanged)
+        prediction_map, class_summary = _run_scene_analysis(scene, block_callback=send_block, mask=mask)
+
+        if rows_streamed < height:
+            # Served from the prediction cache: send the whole map as one block
+            send_block(0, height, prediction_map)
+
+        iot_data = generate_iot_data(24)
+        emit('analysis_complete', {
+            'success': True,
+            'iot_data': iot_data,
+            'class_summary': class_summary,
+            'message': 'Analysis completed successfully'
+        })
+
+    except Exception as e:
+        emit('analysis_error', {'error': f'Error running analysis: {str(e)}'})
+
 @socketio.on('request_iot_data')
 def handle_request_iot_data():
     """Handle request for IoT data"""
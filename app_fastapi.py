@@ -1,18 +1,21 @@
-from fastapi import FastAPI, HTTPException, Request, Response
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi import FastAPI, HTTPException, Request, Response, UploadFile, File, Form, Query
+from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 import os
 import base64
+import json
 import numpy as np
 from PIL import Image
 import io
 import torch
+import asyncio
 import threading
 import time
 import uvicorn
+from dataclasses import replace
 from typing import Dict, List, Optional, Any, Union
 import logging
 from dotenv import load_dotenv
@@ -28,13 +31,41 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Import our custom modules
-from modules.data_handler import load_hyperspectral_data, create_rgb_visualization
+from modules.scene_registry import SceneRegistry, UnknownSceneError, BUILTIN_SCENES, DEFAULT_SCENE_ID
 from modules.iot_generator import generate_iot_data
-from modules.model_handler import run_prediction, CropClassifier, PATCH_SIZE
+from modules.model_handler import CropClassifier, PATCH_SIZE, ADAPTIVE_MODE
+from modules.inference_engine import InferenceEngine, InferenceConfig, configure_torch_threads
+from modules.batching_server import BatchingServer, classify_points
+from modules.model_export import load_inference_model
+from modules.spectral_reduction import load_reducer
+from modules.result_cache import ResultCache, fingerprint_state_dict, inference_cache_key
+from modules.analysis_jobs import JobManager, QueueFullError, JOB_FAILED
+from modules.map_encoding import negotiate_map_format, encode_map, MAP_HEADERS, MAP_MEDIA_TYPES
+from modules.prediction_stream import block_message, sse_event
+from modules.tile_pyramid import TileCache, TilePyramids, parse_style
+from modules.roi import parse_roi, roi_mask, mask_fingerprint
+from modules.incremental_inference import ChangeTracker
+from modules.probability_maps import encode_probability_layer, validate_top_k, DEFAULT_TOP_K, PROBABILITY_HEADERS
+from modules.spectral_signatures import (batch_signatures, signatures_to_dict, encode_signatures, SIGNATURE_HEADERS,
+                                         SIGNATURE_MEDIA_TYPE)
+from modules.spectral_indices import (IndexCache, IndexExpressionError, resolve_index, index_cache_key, encode_raster,
+                                      raster_summary, zonal_summary, BUILTIN_INDICES, INDEX_BANDS, INDEX_FUNCTIONS,
+                                      RASTER_FORMATS, RASTER_HEADERS)
+from modules.metrics import (REGISTRY, REQUEST_SECONDS, REQUESTS_IN_PROGRESS, PROMETHEUS_CONTENT_TYPE, service_collector,
+                             set_enabled, stage_totals, timed)
+from modules.profiler import RequestProfiler, collapsed_stacks, DEFAULT_INTERVAL_MS
+
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse whose rendering is timed as the json_serialization stage."""
+
+    def render(self, content: Any) -> bytes:
+        with timed("json_serialization"):
+            return super().render(content)
 
 app = FastAPI(title="Field Prime Viz API", 
               description="FastAPI backend for Field Prime Viz agricultural analytics",
-              version="1.0.0")
+              version="1.0.0",
+              default_response_class=TimedJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -43,18 +74,91 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=list(MAP_HEADERS) + list(RASTER_HEADERS) + list(SIGNATURE_HEADERS) + list(PROBABILITY_HEADERS) + ["X-Index-Summary", "ETag", "X-Profile-Id"],  # Binary map/raster metadata, tile validators, profiles
 )
 
 # --- Global Variables (to store data in memory for the session) ---
-hypercube_data = None
-ground_truth_data = None
-trained_model = None
-prediction_map_data = None
+active_scene_id = os.getenv("DEFAULT_SCENE", DEFAULT_SCENE_ID)  # Scene used when a request names none
+scene_models = {}  # Model path -> (model, inference engine, weights fingerprint)
+prediction_maps = {}  # Scene id -> latest prediction map
+inference_servers = {}  # Model path -> micro-batching server shared by every request using that model
+scene_models_lock = threading.Lock()
 num_classes_global = int(os.getenv("NUM_CLASSES", "16"))  # Indian Pines has 16 classes (0-15, 0 is background)
 
 # --- Configuration ---
 DATA_FOLDER = os.getenv("DATA_FOLDER", 'data')
 MODEL_PATH = os.path.join(os.getenv("MODELS_FOLDER", 'models'), os.getenv("MODEL_FILENAME", 'crop_classifier.pth'))  # PyTorch model path
+MODEL_VARIANT = os.getenv("MODEL_VARIANT", "fp32")  # fp32, int8, torchscript, torchscript_int8 or onednn (see modules/model_export.py)
+HYPERCUBE_CACHE = os.getenv("HYPERCUBE_CACHE", "True").lower() == "true"  # Memory-mapped cache of the normalized cube
+CACHE_FOLDER = os.getenv("CACHE_FOLDER", os.path.join(DATA_FOLDER, 'cache'))
+HYPERCUBE_CACHE_DTYPE = os.getenv("HYPERCUBE_CACHE_DTYPE", "float32")  # float32 or float16
+INFERENCE_CONFIG = InferenceConfig.from_env()  # INFERENCE_MODE, INFERENCE_WORKERS, INFERENCE_EXECUTOR, ...
+INFERENCE_SERVER_BATCH_SIZE = int(os.getenv("INFERENCE_SERVER_BATCH_SIZE", str(INFERENCE_CONFIG.batch_size)))  # Patches per coalesced batch
+INFERENCE_SERVER_MAX_LATENCY_MS = float(os.getenv("INFERENCE_SERVER_MAX_LATENCY_MS", "5"))  # Longest a partial batch waits for other callers
+RESULT_CACHE_FOLDER = os.getenv("RESULT_CACHE_FOLDER", os.path.join(CACHE_FOLDER, 'results'))
+RESULT_CACHE_MEMORY_MB = int(os.getenv("RESULT_CACHE_MEMORY_MB", "256"))  # In-memory LRU budget for prediction maps
+RESULT_CACHE_DISK_MB = int(os.getenv("RESULT_CACHE_DISK_MB", "2048"))  # Oldest result files are pruned beyond this
+
+ANALYSIS_JOB_WORKERS = int(os.getenv("ANALYSIS_JOB_WORKERS", "1"))  # Analyses running at once, off the event loop
+ANALYSIS_JOB_QUEUE_DEPTH = int(os.getenv("ANALYSIS_JOB_QUEUE_DEPTH", "8"))  # Queued + running analyses before 429
+SCENE_MEMORY_MB = int(os.getenv("SCENE_MEMORY_MB", "1024"))  # Budget for resident scene cubes, least recently used evicted first
+UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", "uploads")
+TILE_CACHE_FOLDER = os.getenv("TILE_CACHE_FOLDER", os.path.join(CACHE_FOLDER, 'tiles'))
+TILE_CACHE_MEMORY_MB = int(os.getenv("TILE_CACHE_MEMORY_MB", "64"))  # In-memory LRU budget for PNG tiles
+TILE_CACHE_DISK_MB = int(os.getenv("TILE_CACHE_DISK_MB", "512"))  # Oldest tile files are pruned beyond this
+TILE_MAX_AGE = int(os.getenv("TILE_MAX_AGE", "3600"))  # Cache-Control max-age of tiles and previews, in seconds
+RGB_PREVIEW_MAX_PIXELS = int(os.getenv("RGB_PREVIEW_MAX_PIXELS", "1048576"))  # Larger scenes are only served as tiles
+INDEX_CACHE_FOLDER = os.getenv("INDEX_CACHE_FOLDER", os.path.join(CACHE_FOLDER, 'indices'))
+INDEX_CACHE_MEMORY_MB = int(os.getenv("INDEX_CACHE_MEMORY_MB", "128"))  # In-memory LRU budget for spectral index rasters
+INDEX_CACHE_DISK_MB = int(os.getenv("INDEX_CACHE_DISK_MB", "1024"))  # Oldest index rasters are pruned beyond this
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True").lower() == "true"  # Stage / request timings and /metrics
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "False").lower() == "true"  # Allows ?profile=1 and /debug/profiles
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # Share of requests profiled unasked, when profiling is enabled
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", str(DEFAULT_INTERVAL_MS)))  # Time between stack samples
+
+# Indian Pines keeps following MODEL_PATH / NUM_CLASSES; other scenes carry their own metadata
+scene_registry = SceneRegistry(
+    DATA_FOLDER, cache_folder=CACHE_FOLDER, cache_dtype=HYPERCUBE_CACHE_DTYPE, use_cache=HYPERCUBE_CACHE,
+    memory_budget_bytes=SCENE_MEMORY_MB * 1024 * 1024, upload_folder=UPLOAD_FOLDER,
+    scenes=[replace(info, model_path=MODEL_PATH, num_classes=num_classes_global) if info.scene_id == DEFAULT_SCENE_ID else info
+            for info in BUILTIN_SCENES])
+result_cache = ResultCache(RESULT_CACHE_FOLDER, max_memory_bytes=RESULT_CACHE_MEMORY_MB * 1024 * 1024,
+                           max_disk_bytes=RESULT_CACHE_DISK_MB * 1024 * 1024)
+change_tracker = ChangeTracker(result_cache)  # Tile checksums of each scene's last analysed cube, for incremental re-analysis
+job_manager = JobManager(max_workers=ANALYSIS_JOB_WORKERS, max_queue_depth=ANALYSIS_JOB_QUEUE_DEPTH)
+tile_pyramids = TilePyramids(TileCache(TILE_CACHE_FOLDER, max_memory_bytes=TILE_CACHE_MEMORY_MB * 1024 * 1024,
+                                       max_disk_bytes=TILE_CACHE_DISK_MB * 1024 * 1024))
+index_cache = IndexCache(INDEX_CACHE_FOLDER, max_memory_bytes=INDEX_CACHE_MEMORY_MB * 1024 * 1024,
+                         max_disk_bytes=INDEX_CACHE_DISK_MB * 1024 * 1024)
+request_profiler = RequestProfiler(PROFILING_ENABLED, PROFILE_SAMPLE_RATE, PROFILE_INTERVAL_MS / 1000)
+configure_torch_threads(INFERENCE_CONFIG)  # PyTorch thread counts are process-wide: set once here, not per run
+set_enabled(METRICS_ENABLED)
+REGISTRY.register_collector(service_collector(result_cache, tile_pyramids.cache, index_cache, scene_registry, inference_servers,
+                                              change_tracker, job_manager))
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    """Times every request by route template and, when asked for and enabled, samples a profile of it."""
+    profile = None
+    if request_profiler.should_profile(request.query_params.get("profile") == "1" or request.headers.get("X-Profile") == "1"):
+        profile = request_profiler.begin(request.method, request.url.path)
+    if METRICS_ENABLED:
+        REQUESTS_IN_PROGRESS.inc(1)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        if METRICS_ENABLED:
+            REQUESTS_IN_PROGRESS.inc(-1)
+            route = request.scope.get("route")
+            REQUEST_SECONDS.observe(time.perf_counter() - start, request.method,
+                                    getattr(route, "path", "unmatched"), status)
+        profile_id = request_profiler.end(profile, status) if profile is not None else None
+    if profile_id is not None:
+        response.headers["X-Profile-Id"] = profile_id
+    return response
 
 # --- Load Model on Startup ---
 @app.on_event("startup")
@@ -64,28 +168,93 @@ async def startup_event():
     await load_trained_model_on_startup()
 
 async def load_trained_model_on_startup():
-    global trained_model, num_classes_global
-    # We need to know num_classes to initialize the model.
-    # A robust way is to load data first to determine it.
-    # For simplicity here, we'll use the environment variable or default to 16 (Indian Pines classes).
-    
+    # The default scene's model is loaded up front; other scenes' models on first use.
     try:
-        if os.path.exists(MODEL_PATH):
-            try:
-                logger.info(f"Loading model from {MODEL_PATH} with {num_classes_global} classes")
-                trained_model = CropClassifier(num_classes=num_classes_global)
-                trained_model.load_state_dict(torch.load(MODEL_PATH, map_location=torch.device('cpu')))
-                trained_model.eval()  # Set to evaluation mode
-                logger.info(f"Successfully loaded trained PyTorch model from {MODEL_PATH}")
-            except Exception as e:
-                logger.error(f"Error loading PyTorch model: {e}")
-                trained_model = None
-        else:
-            logger.warning(f"PyTorch model not found at {MODEL_PATH}. Some features will be unavailable.")
+        await asyncio.to_thread(_scene_model, scene_registry.info(active_scene_id))
+        await asyncio.to_thread(_autotune_inference)
     except Exception as e:
         logger.error(f"Unexpected error during startup: {e}")
         # Continue running the app even if model loading fails
 
+def _scene_model(info):
+    """Returns (model, inference engine, weights fingerprint) for a scene, or None if it has no usable model."""
+    model_path = info.model_path
+    if not model_path:
+        return None
+    with scene_models_lock:
+        if model_path in scene_models:
+            return scene_models[model_path]
+        if not os.path.exists(model_path):
+            logger.warning(f"PyTorch model not found at {model_path}. Some features will be unavailable.")
+            return None
+        try:
+            logger.info(f"Loading {MODEL_VARIANT} model from {model_path} with {info.num_classes} classes")
+            model = load_inference_model(model_path, info.num_classes, MODEL_VARIANT)
+            model.eval()  # Set to evaluation mode
+            # The spectral reducer (if the model was trained on a reduced cube) is part of the fingerprint
+            reducer = load_reducer(model_path)
+            state_dict = torch.load(model_path, map_location=torch.device('cpu'))
+            fingerprint = fingerprint_state_dict({**state_dict, **(reducer.state_dict() if reducer else {})})
+            # Patch batches of all requests for this model are coalesced by one server
+            server = BatchingServer(model, INFERENCE_SERVER_BATCH_SIZE, INFERENCE_SERVER_MAX_LATENCY_MS)
+            inference_servers[model_path] = server
+            engine = InferenceEngine(model, INFERENCE_CONFIG, reducer=reducer, batching_server=server)
+            scene_models[model_path] = (model, engine, fingerprint)
+            logger.info(f"Successfully loaded trained PyTorch model from {model_path}")
+        except Exception as e:
+            logger.error(f"Error loading PyTorch model: {e}")
+            scene_models[model_path] = None
+        return scene_models[model_path]
+
+def _autotune_inference():
+    """
+    With INFERENCE_AUTOTUNE=true, times the inference settings on the default scene
+    before any request is served; engines created later use the tuned config.
+    """
+    global INFERENCE_CONFIG
+    scene_model = _scene_model(scene_registry.info(active_scene_id))
+    if not INFERENCE_CONFIG.autotune or scene_model is None:
+        return
+    try:
+        INFERENCE_CONFIG = scene_model[1].autotune(scene_registry.load(active_scene_id).hypercube)
+    except (FileNotFoundError, UnknownSceneError) as e:
+        logger.warning(f"Inference autotuning skipped: {e}")
+
+def _resolve_scene(scene_id=None):
+    """The loaded scene for scene_id (default: the active scene), loading it on first use."""
+    try:
+        return scene_registry.load(scene_id or active_scene_id)
+    except UnknownSceneError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+def _analysis_cache_key(scene, model_fingerprint, mask=None, top_k=0, lineage=False):
+    """
+    Prediction cache key for a scene's cube, model weights, inference settings, region of interest and probability outputs.
+    With lineage=True the key names the scene instead of its cube's content: the analysis an updated cube is diffed against.
+    """
+    config = {'mode': INFERENCE_CONFIG.mode, 'variant': MODEL_VARIANT, 'patch_size': PATCH_SIZE}
+    if INFERENCE_CONFIG.mode == ADAPTIVE_MODE:
+        config.update(grid_step=INFERENCE_CONFIG.adaptive_grid_step, min_confidence=INFERENCE_CONFIG.adaptive_min_confidence)
+    if mask is not None:
+        config['roi'] = mask_fingerprint(mask)
+    if top_k:
+        config['top_k'] = top_k
+    cube = f'scene:{scene.info.scene_id}' if lineage else scene.fingerprint
+    return inference_cache_key(cube, model_fingerprint, config)
+
+def _roi_mask(scene, roi=None, bbox=None, polygon=None):
+    """The region-of-interest mask of ?roi=ground_truth, ?bbox=x0,y0,x1,y1 and ?polygon=[[x,y],...], or None."""
+    try:
+        spec = parse_roi(roi, bbox, polygon)
+        if spec is None:
+            return None
+        height, width = scene.hypercube.shape[:2]
+        return roi_mask(spec, height, width, scene.ground_truth)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 # --- Routes ---
 @app.get("/", response_class=JSONResponse)
 async def index():
@@ -96,76 +265,524 @@ async def index():
         "description": "FastAPI backend for Field Prime Viz agricultural analytics",
         "frontend": "https://agritechpro.vercel.app",
         "endpoints": [
-            {"path": "/api/load_data", "method": "GET", "description": "Load hyperspectral data"},
-            {"path": "/api/run_analysis", "method": "GET", "description": "Run analysis on loaded data"},
-            {"path": "/api/get_spectral_signature", "method": "GET", "description": "Get spectral signature for a pixel"}
+            {"path": "/api/scenes", "method": "GET", "description": "List available scenes"},
+            {"path": "/api/scenes/upload", "method": "POST", "description": "Upload a scene (.mat cube and ground truth)"},
+            {"path": "/api/load_data", "method": "GET", "description": "Load hyperspectral data (?scene_id=...)"},
+            {"path": "/api/scenes/{scene_id}/reload", "method": "POST", "description": "Re-read a scene whose files were updated; the next analysis only re-classifies changed tiles"},
+            {"path": "/api/scenes/{scene_id}/stats", "method": "GET", "description": "Precomputed band statistics and class mean spectra (?histogram_bins=64)"},
+            {"path": "/api/scenes/{scene_id}/tiles", "method": "GET", "description": "RGB tile pyramid metadata and URL template"},
+            {"path": "/api/scenes/{scene_id}/preview.png", "method": "GET", "description": "Full-resolution RGB preview (cached, ETag)"},
+            {"path": "/tiles/{z}/{x}/{y}.png", "method": "GET", "description": "RGB preview tile (?scene_id=&bands=r,g,b&percentiles=low,high)"},
+            {"path": "/api/run_analysis", "method": "GET", "description": "Run analysis on loaded data (?roi=ground_truth, ?bbox=x0,y0,x1,y1 or ?polygon=[[x,y],...] to classify only a region)"},
+            {"path": "/api/run_analysis/stream", "method": "GET", "description": "Stream prediction map blocks as Server-Sent Events"},
+            {"path": "/api/probability_maps", "method": "GET", "description": "Per-pixel confidence, margin or top-k class raster (?layer=&rank=&top_k=3&format=f16|png|raw)"},
+            {"path": "/api/analysis_jobs", "method": "POST", "description": "Start a background analysis job"},
+            {"path": "/api/analysis_jobs/{job_id}", "method": "GET", "description": "Get analysis job status and progress"},
+            {"path": "/api/analysis_jobs/{job_id}/result", "method": "GET", "description": "Get a finished analysis job's result"},
+            {"path": "/api/get_spectral_signature", "method": "GET", "description": "Get spectral signature for a pixel"},
+            {"path": "/api/spectral_signatures", "method": "POST", "description": "Spectra of many pixels and mean/std spectra of rectangles/polygons (JSON or float32)"},
+            {"path": "/api/classify_pixels", "method": "POST", "description": "Classify individual pixels through the shared micro-batching server"},
+            {"path": "/api/inference_server/stats", "method": "GET", "description": "Micro-batching server queue length, batch-fill ratio and latency"},
+            {"path": "/api/indices", "method": "GET", "description": "Built-in spectral indices, band names and expression functions"},
+            {"path": "/api/indices/raster", "method": "GET", "description": "Spectral index raster (?index=ndvi or ?expression=..., &format=f16|f32|png)"},
+            {"path": "/api/indices/zonal", "method": "GET", "description": "Per-class statistics of a spectral index (?zones=ground_truth|prediction)"},
+            {"path": "/metrics", "method": "GET", "description": "Per-stage and per-route timings, cache and queue counters (Prometheus text format)"},
+            {"path": "/debug/profiles", "method": "GET", "description": "Sampled request profiles (PROFILING_ENABLED=true; profile a request with ?profile=1)"},
+            {"path": "/debug/profiles/{profile_id}", "method": "GET", "description": "One profile as collapsed stacks for flame graphs (?format=json for a summary)"}
         ]
     }
 
-@app.get("/api/load_data")
-async def api_load_data():
-    global hypercube_data, ground_truth_data
+@app.get("/api/scenes")
+async def api_list_scenes():
+    """Registered scenes with their metadata and residency."""
+    return {"success": True, "active_scene_id": active_scene_id, "scenes": scene_registry.scenes(),
+            "residency": scene_registry.stats()}
+
+@app.post("/api/scenes/upload")
+async def api_upload_scene(hypercube: UploadFile = File(...), ground_truth: Optional[UploadFile] = File(None),
+                           name: str = Form(...), rgb_bands: str = Form("29,19,9"), num_classes: int = Form(16)):
+    """Registers an uploaded scene (.mat cube, optional .mat ground truth)."""
+    try:
+        bands = tuple(int(b) for b in rgb_bands.split(","))
+        if len(bands) != 3:
+            raise ValueError
+    except ValueError:
+        raise HTTPException(status_code=400, detail="rgb_bands must be three comma-separated band indices.")
+
+    info = await asyncio.to_thread(scene_registry.register_upload, name, hypercube.file,
+                                   ground_truth.file if ground_truth is not None else None,
+                                   rgb_bands=bands, num_classes=num_classes)
+    return {"success": True, "scene": info.to_dict()}
+
+def _scene_pyramid(scene, bands=None, percentiles=None):
+    """The RGB tile pyramid of a scene for a band triplet and stretch (defaults: the scene's)."""
+    try:
+        rgb_bands, stretch = parse_style(bands or scene.info.rgb_bands, percentiles)
+        return tile_pyramids.get(scene.hypercube, scene.fingerprint, rgb_bands, stretch, scene.histograms)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid bands or percentiles: {e}")
+
+def _tiles_info(scene, pyramid):
+    query = f"scene_id={scene.info.scene_id}&bands={','.join(map(str, pyramid.rgb_bands))}" \
+            f"&percentiles={','.join(f'{p:g}' for p in pyramid.percentiles)}"
+    return {**pyramid.info(), "url": "/tiles/{z}/{x}/{y}.png?" + query,
+            "preview_url": f"/api/scenes/{scene.info.scene_id}/preview.png?" + query.split("&", 1)[1]}
+
+def _png_headers(etag):
+    return {"ETag": etag, "Cache-Control": f"public, max-age={TILE_MAX_AGE}"}
+
+def _not_modified(request: Request, etag):
+    """A 304 response if the client already holds this version of the image, else None."""
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=_png_headers(etag))
+    return None
+
+@app.post("/api/scenes/{scene_id}/reload")
+async def api_reload_scene(scene_id: str):
+    """
+    Re-reads a scene whose files were replaced (e.g. a new acquisition over part of the
+    field); its next analysis re-classifies only the tiles that changed.
+    """
     try:
-        hypercube_data, ground_truth_data = load_hyperspectral_data(DATA_FOLDER)
-        rgb_image_pil = create_rgb_visualization(hypercube_data)
-        
-        # Convert PIL Image to base64 string
-        buffered = io.BytesIO()
-        rgb_image_pil.save(buffered, format="PNG")
-        rgb_image_b64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        
-        return {"success": True, "rgb_image_b64": f"data:image/png;base64,{rgb_image_b64}", "hypercube_shape": list(hypercube_data.shape)}
+        scene, previous_fingerprint = await asyncio.to_thread(scene_registry.reload, scene_id)
+    except UnknownSceneError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
     except FileNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    return {"success": True, "scene_id": scene.info.scene_id, "fingerprint": scene.fingerprint,
+            "changed": previous_fingerprint is not None and previous_fingerprint != scene.fingerprint}
+
+@app.get("/api/scenes/{scene_id}/stats")
+async def api_scene_stats(scene_id: str, histogram_bins: Optional[int] = None):
+    """
+    Per-band min/max/mean/std and per-class mean spectra of a scene, read from its
+    statistics sidecar. ?histogram_bins=N adds per-band histograms with N bins
+    (N must divide the stored bin count, e.g. 64 or 256).
+    """
+    scene = await asyncio.to_thread(_resolve_scene, scene_id)
+    try:
+        statistics = scene.statistics.to_dict(histogram_bins)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "scene_id": scene.info.scene_id, "statistics": statistics}
+
+@app.get("/api/load_data")
+async def api_load_data(scene_id: Optional[str] = None):
+    """
+    Loads a scene (default: the active one), makes it the active scene and returns
+    its tile pyramid, plus the whole RGB preview inline if it has at most
+    RGB_PREVIEW_MAX_PIXELS pixels. The preview is rendered once and cached.
+    """
+    global active_scene_id
+    try:
+        scene = await asyncio.to_thread(_resolve_scene, scene_id)
+        active_scene_id = scene.info.scene_id
+        pyramid = _scene_pyramid(scene)
+        height, width = scene.hypercube.shape[:2]
+
+        rgb_image = None
+        if height * width <= RGB_PREVIEW_MAX_PIXELS:
+            preview_png = await asyncio.to_thread(pyramid.preview_png)
+            with timed("base64_encode"):
+                rgb_image = f"data:image/png;base64,{base64.b64encode(preview_png).decode('utf-8')}"
+
+        return {"success": True, "rgb_image_b64": rgb_image, "tiles": _tiles_info(scene, pyramid),
+                "hypercube_shape": list(scene.hypercube.shape), "scene": scene.info.to_dict()}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error loading data: {str(e)}")
 
-@app.get("/api/run_analysis")
-async def api_run_analysis():
-    global prediction_map_data
-    if hypercube_data is None:
-        raise HTTPException(status_code=400, detail="Please load hyperspectral data first.")
-    if trained_model is None:
-        raise HTTPException(status_code=400, detail="Trained PyTorch model not found. Please run train.py first.")
+@app.get("/api/scenes/{scene_id}/tiles")
+async def api_scene_tiles(scene_id: str, bands: Optional[str] = None, percentiles: Optional[str] = None):
+    """Zoom levels, tile counts and URL template of a scene's RGB tile pyramid."""
+    scene = await asyncio.to_thread(_resolve_scene, scene_id)
+    return {"success": True, "tiles": _tiles_info(scene, _scene_pyramid(scene, bands, percentiles))}
+
+@app.get("/api/scenes/{scene_id}/preview.png")
+async def api_scene_preview(request: Request, scene_id: str, bands: Optional[str] = None,
+                            percentiles: Optional[str] = None):
+    """Full-resolution RGB preview of a scene as PNG."""
+    scene = await asyncio.to_thread(_resolve_scene, scene_id)
+    pyramid = _scene_pyramid(scene, bands, percentiles)
+    etag = pyramid.etag("preview")
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    png = await asyncio.to_thread(pyramid.preview_png)
+    return Response(content=png, media_type="image/png", headers=_png_headers(etag))
+
+@app.get("/tiles/{z}/{x}/{y}.png")
+async def api_tile(request: Request, z: int, x: int, y: int, scene_id: Optional[str] = None,
+                   bands: Optional[str] = None, percentiles: Optional[str] = None):
+    """
+    One 256x256 tile of a scene's RGB preview (XYZ scheme: zoom 0 is the whole
+    scene, max_zoom is one tile pixel per scene pixel). Tiles are built on first
+    request, cached in memory and on disk, and revalidated with ETag/If-None-Match.
+    """
+    scene = await asyncio.to_thread(_resolve_scene, scene_id)
+    pyramid = _scene_pyramid(scene, bands, percentiles)
+    etag = pyramid.etag(z, x, y)
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    try:
+        png = await asyncio.to_thread(pyramid.tile_png, z, x, y)
+    except IndexError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return Response(content=png, media_type="image/png", headers=_png_headers(etag))
+
+def _require_scene_model(scene):
+    scene_model = _scene_model(scene.info)
+    if scene_model is None:
+        raise HTTPException(status_code=400, detail=f"Trained PyTorch model for scene '{scene.info.scene_id}' not found. Please run train.py first.")
+    return scene_model
+
+def _submit_analysis_job(scene, mask=None, top_k=0):
+    """
+    Queues a classification of a scene, or of the pixels of a mask; identical pending requests share one job.
+    The job's result is (prediction_map, class_summary), plus the probability maps when top_k > 0.
+    """
+    _, engine, model_fingerprint = _require_scene_model(scene)
+    cube, cache_key, scene_id = scene.hypercube, _analysis_cache_key(scene, model_fingerprint, mask, top_k), scene.info.scene_id
+    lineage_key = _analysis_cache_key(scene, model_fingerprint, mask, top_k, lineage=True)
+
+    def work(progress_callback, block_callback):
+        # AI Prediction (reused from the prediction cache when cube, model, settings and region are unchanged;
+        # after a scene update only the tiles that changed since its last analysis are re-classified)
+        result = result_cache.get_or_compute(
+            cache_key, lambda: change_tracker.run(engine, cube, lineage_key, cache_key, mask=mask, top_k=top_k,
+                                                  progress_callback=progress_callback, block_callback=block_callback,
+                                                  checksums=scene.tile_checksums, normalization=scene.normalization))
+        prediction_maps[scene_id] = result[0]
+        return result
 
     try:
-        # IoT Data
-        iot_data = generate_iot_data(24)  # Simulate 24 hours of data
+        return job_manager.submit(cache_key, work, rows_total=cube.shape[0])
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
 
-        # AI Prediction
-        prediction_map_data, class_summary = run_prediction(trained_model, hypercube_data)
-        
-        # Convert prediction map to a flat list for easy transfer to JS
-        prediction_map_flat = prediction_map_data.flatten().tolist()
+def _negotiate_map_format(request: Request, map_format: Optional[str]):
+    try:
+        return negotiate_map_format(request.headers.get("accept"), map_format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        return {"success": True, "iot_data": iot_data, "prediction_map": prediction_map_flat, "class_summary": class_summary}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error running analysis: {str(e)}")
+def _analysis_response(prediction_map, class_summary, map_format="json"):
+    """
+    Builds the analysis payload. Binary map formats (raw, rle, png) return the map
+    as the body with shape/dtype/summary in X-Map-* headers and no IoT data.
+    """
+    if map_format != "json":
+        body, media_type, headers = encode_map(prediction_map, map_format, class_summary)
+        return Response(content=body, media_type=media_type, headers={**headers, "Vary": "Accept"})
+
+    # IoT Data
+    iot_data = generate_iot_data(24)  # Simulate 24 hours of data
+
+    # Convert prediction map to a flat list for easy transfer to JS
+    prediction_map_flat = prediction_map.flatten().tolist()
+
+    return {"success": True, "iot_data": iot_data, "prediction_map": prediction_map_flat, "class_summary": class_summary}
+
+@app.get("/api/run_analysis")
+async def api_run_analysis(request: Request, format: Optional[str] = None, scene_id: Optional[str] = None,
+                           roi: Optional[str] = None, bbox: Optional[str] = None, polygon: Optional[str] = None):
+    """
+    Runs an analysis and waits for it without blocking the event loop.
+
+    The map is returned as JSON unless the Accept header (or ?format=raw|rle|png)
+    asks for a binary encoding; see modules/map_encoding.py. With ?roi=ground_truth,
+    ?bbox=x0,y0,x1,y1 and/or ?polygon=[[x,y],...] only the selected pixels are
+    classified; the rest of the map is 0.
+    """
+    map_format = _negotiate_map_format(request, format)
+    scene = await asyncio.to_thread(_resolve_scene, scene_id)
+    mask = await asyncio.to_thread(_roi_mask, scene, roi, bbox, polygon)
+    job = await asyncio.to_thread(_submit_analysis_job, scene, mask)
+    await asyncio.wrap_future(job.future)
+
+    if job.status == JOB_FAILED:
+        raise HTTPException(status_code=500, detail=f"Error running analysis: {job.error}")
+    return _analysis_response(*job.result, map_format)
+
+@app.get("/api/probability_maps")
+async def api_probability_maps(layer: str = "confidence", rank: int = 1, top_k: int = DEFAULT_TOP_K,
+                               format: Optional[str] = None, scene_id: Optional[str] = None, roi: Optional[str] = None,
+                               bbox: Optional[str] = None, polygon: Optional[str] = None):
+    """
+    One layer of the per-pixel probability maps as a compact raster: ?layer=confidence,
+    margin, top_k_probabilities (f16, f32 or png) or top_k_labels (raw, rle or png),
+    &rank= picking one of the ?top_k= most probable classes. The maps come from the
+    same forwards as the label map and are cached with it; roi / bbox / polygon as
+    for /api/run_analysis. Overall confidence statistics are in X-Probability-Summary.
+    """
+    if INFERENCE_CONFIG.mode == ADAPTIVE_MODE:
+        raise HTTPException(status_code=400, detail="Probability maps are not available with INFERENCE_MODE=adaptive.")
+    try:
+        validate_top_k(top_k)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    scene = await asyncio.to_thread(_resolve_scene, scene_id)
+    mask = await asyncio.to_thread(_roi_mask, scene, roi, bbox, polygon)
+    job = await asyncio.to_thread(_submit_analysis_job, scene, mask, top_k)
+    await asyncio.wrap_future(job.future)
+
+    if job.status == JOB_FAILED:
+        raise HTTPException(status_code=500, detail=f"Error running analysis: {job.error}")
+    try:
+        body, media_type, headers = await asyncio.to_thread(encode_probability_layer, job.result[2], layer, rank, format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(content=body, media_type=media_type, headers=headers)
+
+@app.get("/api/run_analysis/stream")
+async def api_stream_analysis(format: str = "json", scene_id: Optional[str] = None, roi: Optional[str] = None,
+                              bbox: Optional[str] = None, polygon: Optional[str] = None):
+    """
+    Runs an analysis and streams the prediction map as Server-Sent Events.
+
+    Emits a `block` event per finished row block (rows, labels and running class
+    counts; labels as a list for format=json, base64 for raw/rle/png), then
+    `complete` with the final class summary and IoT data, or `error`.
+    """
+    if format not in MAP_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown map format '{format}'. Expected one of {tuple(MAP_MEDIA_TYPES)}.")
+    scene = await asyncio.to_thread(_resolve_scene, scene_id)
+    mask = await asyncio.to_thread(_roi_mask, scene, roi, bbox, polygon)
+    job = await asyncio.to_thread(_submit_analysis_job, scene, mask)
+
+    loop = asyncio.get_running_loop()
+    blocks = asyncio.Queue()
+    subscribed = job.subscribe(lambda block: loop.call_soon_threadsafe(blocks.put_nowait, block))
+
+    async def events():
+        rows_streamed = 0
+        while subscribed:
+            block = await blocks.get()
+            if block is None:
+                break
+            r0, r1, labels, class_summary = block
+            rows_streamed += r1 - r0
+            yield sse_event("block", block_message(r0, r1, labels, class_summary, job.rows_total, format))
+
+        await asyncio.wrap_future(job.future)
+        if job.status == JOB_FAILED:
+            yield sse_event("error", {"success": False, "error": f"Error running analysis: {job.error}"})
+            return
+
+        prediction_map, class_summary = job.result
+        if rows_streamed < prediction_map.shape[0]:
+            # Served from the prediction cache (or joined too late): send the whole map as one block
+            yield sse_event("block", block_message(0, prediction_map.shape[0], prediction_map, class_summary,
+                                                   prediction_map.shape[0], format))
+        yield sse_event("complete", {"success": True, "class_summary": class_summary,
+                                     "iot_data": generate_iot_data(24)})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/api/analysis_jobs", status_code=202)
+async def api_submit_analysis_job(scene_id: Optional[str] = None, roi: Optional[str] = None, bbox: Optional[str] = None,
+                                  polygon: Optional[str] = None):
+    """Starts an analysis (of the whole scene or a region of interest) in the background and returns its job id."""
+    scene = await asyncio.to_thread(_resolve_scene, scene_id)
+    mask = await asyncio.to_thread(_roi_mask, scene, roi, bbox, polygon)
+    job = await asyncio.to_thread(_submit_analysis_job, scene, mask)
+    return {"success": True, **job.to_dict()}
+
+@app.get("/api/analysis_jobs/{job_id}")
+async def api_get_analysis_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown analysis job '{job_id}'.")
+    return {"success": True, **job.to_dict()}
+
+@app.get("/api/analysis_jobs/{job_id}/result")
+async def api_get_analysis_job_result(job_id: str, request: Request, format: Optional[str] = None):
+    map_format = _negotiate_map_format(request, format)
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown analysis job '{job_id}'.")
+    if not job.finished:
+        raise HTTPException(status_code=409, detail=f"Analysis job '{job_id}' is still {job.status}.")
+    if job.status == JOB_FAILED:
+        raise HTTPException(status_code=500, detail=f"Error running analysis: {job.error}")
+    return _analysis_response(*job.result, map_format)
+
+@app.get("/api/indices")
+async def api_list_indices():
+    """Built-in indices and what user expressions may contain."""
+    return {"success": True, "indices": BUILTIN_INDICES, "bands": INDEX_BANDS, "functions": sorted(INDEX_FUNCTIONS),
+            "formats": list(RASTER_FORMATS)}
+
+async def _index_raster(scene, index, expression):
+    """(index name, compiled index, raster) of a scene, computed once per cube and expression."""
+    try:
+        name, spectral_index = resolve_index(index, expression, scene.hypercube.shape[2])
+    except IndexExpressionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    raster = await asyncio.to_thread(index_cache.get_or_compute, index_cache_key(scene.fingerprint, spectral_index),
+                                     lambda: spectral_index.compute(scene.hypercube))
+    return name, spectral_index, raster
+
+@app.get("/api/indices/raster")
+async def api_index_raster(index: Optional[str] = None, expression: Optional[str] = None, format: str = "f16",
+                           value_range: Optional[str] = Query(None, alias="range"), scene_id: Optional[str] = None):
+    """
+    A spectral index over the whole scene as one binary raster: f16/f32 values in
+    row-major order, or a greyscale PNG scaled over ?range=low,high (default -1,1).
+    Shape, dtype and overall statistics are in the X-Raster-* / X-Index-Summary headers.
+    """
+    scene = await asyncio.to_thread(_resolve_scene, scene_id)
+    name, spectral_index, raster = await _index_raster(scene, index, expression)
+    try:
+        low_high = tuple(float(v) for v in value_range.split(",")) if value_range else None
+        if low_high is not None and len(low_high) != 2:
+            raise ValueError("range must be two comma-separated numbers.")
+        body, media_type, headers = encode_raster(raster, format, low_high)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    summary = {"index": name, "expression": spectral_index.expression, "bands": spectral_index.band_map,
+               **raster_summary(raster)}
+    headers["X-Index-Summary"] = json.dumps(summary, separators=(",", ":"))
+    return Response(content=body, media_type=media_type, headers=headers)
+
+@app.get("/api/indices/zonal")
+async def api_index_zonal(index: Optional[str] = None, expression: Optional[str] = None, zones: str = "ground_truth",
+                          scene_id: Optional[str] = None):
+    """
+    Mean / std / min / max of a spectral index per class, over the ground truth
+    classes or the classes of the scene's latest prediction map.
+    """
+    scene = await asyncio.to_thread(_resolve_scene, scene_id)
+    if zones == "ground_truth":
+        labels = scene.ground_truth
+    elif zones == "prediction":
+        labels = prediction_maps.get(scene.info.scene_id)
+        if labels is None:
+            raise HTTPException(status_code=400, detail="No prediction map for this scene yet. Run analysis first.")
+    else:
+        raise HTTPException(status_code=400, detail="zones must be 'ground_truth' or 'prediction'.")
+    name, spectral_index, raster = await _index_raster(scene, index, expression)
+    return {"success": True, "scene_id": scene.info.scene_id, "index": name, "expression": spectral_index.expression,
+            "bands": spectral_index.band_map, "zones": zones, "summary": raster_summary(raster),
+            "classes": await asyncio.to_thread(zonal_summary, raster, labels)}
 
 @app.get("/api/get_spectral_signature")
-async def api_get_spectral_signature(x: int, y: int):
-    if hypercube_data is None:
-        raise HTTPException(status_code=400, detail="Hyperspectral data not loaded.")
+async def api_get_spectral_signature(x: int, y: int, scene_id: Optional[str] = None):
+    hypercube = (await asyncio.to_thread(_resolve_scene, scene_id)).hypercube
 
     try:
         # Extract the full spectral vector for the clicked pixel
-        spectral_signature = hypercube_data[y, x, :].tolist()
+        spectral_signature = hypercube[y, x, :].tolist()
         return {"success": True, "spectral_signature": spectral_signature}
     except IndexError:
         raise HTTPException(status_code=400, detail="Invalid pixel coordinates.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting spectral signature: {str(e)}")
 
+class SignatureRequest(BaseModel):
+    points: List[List[int]] = []            # [[x, y], ...]
+    regions: List[Dict[str, Any]] = []      # {"type": "rect", "x0", "y0", "x1", "y1"} or {"type": "polygon", "points": [[x, y], ...]}
+    format: Optional[str] = None            # "json" or "f32"; defaults from the Accept header
+    scene_id: Optional[str] = None
+
+@app.post("/api/spectral_signatures")
+async def api_spectral_signatures(request: Request, body: SignatureRequest):
+    """
+    Batch counterpart of /api/get_spectral_signature: per-pixel spectra for a list
+    of points plus mean / std spectra of rectangles and polygons, in one request.
+    With format "f32" (or Accept: application/octet-stream) the spectra come back
+    as one little-endian float32 buffer described by the X-Spectra-* headers.
+    """
+    hypercube = (await asyncio.to_thread(_resolve_scene, body.scene_id)).hypercube
+    binary = body.format == "f32" or (body.format is None and SIGNATURE_MEDIA_TYPE in request.headers.get("accept", ""))
+    if body.format not in (None, "json", "f32"):
+        raise HTTPException(status_code=400, detail="format must be 'json' or 'f32'.")
+    try:
+        spectra, regions = await asyncio.to_thread(batch_signatures, hypercube, body.points, body.regions)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if binary:
+        content, media_type, headers = encode_signatures(spectra, regions)
+        return Response(content=content, media_type=media_type, headers={**headers, "Vary": "Accept"})
+    return {"success": True, **signatures_to_dict(spectra, regions)}
+
+class PixelRequest(BaseModel):
+    points: List[List[int]] = []  # [[x, y], ...]
+    scene_id: Optional[str] = None
+
+@app.post("/api/classify_pixels")
+async def api_classify_pixels(body: PixelRequest):
+    """
+    Classifies individual pixels through the model's shared micro-batching server,
+    so concurrent clients' pixels are coalesced into full model batches.
+    """
+    scene = await asyncio.to_thread(_resolve_scene, body.scene_id)
+    _, engine, _ = await asyncio.to_thread(_require_scene_model, scene)
+    try:
+        labels, confidence = await asyncio.to_thread(classify_points, inference_servers[scene.info.model_path],
+                                                     scene.hypercube, body.points, engine.reducer)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "labels": labels.tolist(), "confidence": confidence.tolist()}
+
+@app.get("/api/inference_server/stats")
+async def api_inference_server_stats():
+    """Queue length, batch-fill ratio and request latency of each model's micro-batching server, and incremental re-analysis counts."""
+    return {"success": True, "servers": {path: server.stats() for path, server in list(inference_servers.items())},
+            "incremental": change_tracker.stats()}
+
+@app.get("/metrics")
+async def metrics():
+    """Stage and request histograms plus cache, scene and queue counters, in the Prometheus text format."""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled (METRICS_ENABLED=false).")
+    return Response(content=REGISTRY.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+def _profiling_enabled():
+    if not request_profiler.enabled:
+        raise HTTPException(status_code=404, detail="Profiling is disabled (set PROFILING_ENABLED=true).")
+
+@app.get("/debug/profiles")
+async def api_list_profiles():
+    """Summaries of the most recent request profiles, newest first, with the stage totals so far."""
+    _profiling_enabled()
+    return {"success": True, "profiles": request_profiler.profiles(), "stages": stage_totals()}
+
+@app.get("/debug/profiles/{profile_id}")
+async def api_get_profile(profile_id: str, format: str = "collapsed"):
+    """One request profile, as collapsed stacks (flamegraph.pl, speedscope) or, with format=json, its summary."""
+    _profiling_enabled()
+    profile = request_profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"Unknown profile '{profile_id}'.")
+    if format == "json":
+        return {"success": True, "profile": request_profiler.summary(profile)}
+    if format != "collapsed":
+        raise HTTPException(status_code=400, detail="format must be 'collapsed' or 'json'.")
+    return PlainTextResponse(collapsed_stacks(profile["stacks"]))
+
 class ReportRequest(BaseModel):
     format: str = "pdf"
     include_iot: bool = True
     include_analysis: bool = True
     include_spectral: bool = True
+    scene_id: Optional[str] = None
 
 @app.post("/api/generate_report")
 async def api_generate_report(request: ReportRequest):
     """Generate comprehensive agricultural report"""
     try:
+        scene_id = request.scene_id or active_scene_id
+        try:
+            scene = await asyncio.to_thread(scene_registry.load, scene_id)
+            hypercube_data, statistics = scene.hypercube, scene.statistics
+        except FileNotFoundError:
+            hypercube_data, statistics = None, None
+        prediction_map_data = prediction_maps.get(scene_id)
+
         # Collect data based on request parameters
         report_data = {
             'timestamp': np.datetime_as_string(np.datetime64('now')),
@@ -198,7 +815,9 @@ async def api_generate_report(request: ReportRequest):
             report_data['spectral_summary'] = {
                 'data_shape': list(hypercube_data.shape),
                 'wavelengths': int(hypercube_data.shape[2] if len(hypercube_data.shape) > 2 else 0),
-                'avg_spectral_signature': np.mean(hypercube_data, axis=(0, 1)).tolist()
+                # Precomputed band statistics; the cube is not rescanned per report
+                'avg_spectral_signature': statistics.mean.tolist(),
+                'std_spectral_signature': statistics.std.tolist()
             }
 
         if request.format == 'json':
@@ -249,6 +868,8 @@ Spectral Data Summary:
                 'report': pdf_content,
                 'format': 'pdf'
             }
+    except UnknownSceneError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating report: {str(e)}")
 
@@ -0,0 +1,373 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+from datetime import datetime, timezone
+
+import numpy as np
+import scipy.io
+import torch
+
+from modules.data_handler import load_hyperspectral_data, create_rgb_visualization, RGB_BANDS
+from modules.model_handler import CropClassifier, run_prediction, PATCH_SIZE
+from modules.patch_extractor import pad_cube, iter_patch_batches
+from modules.iot_generator import generate_iot_data
+
+# --- Configuration ---
+GROUND_TRUTH_PATH = os.path.join('data', 'Indian_pines_gt.mat') # Bundled labels; the cube itself is not in the repository
+DEFAULT_SCENES = ('synthetic:64x64x200', 'indian_pines_gt')
+STAGES = ('load', 'patches', 'inference', 'rgb', 'iot', 'api')
+NUM_CLASSES = 16
+FIELD_SIZE = 16 # Side of the square parcels of synthetic ground truth, in pixels
+NOISE_STD = 0.02 # Per-pixel noise around each class's mean spectrum
+DEFAULT_TOLERANCE = 0.15 # A stage more than this much slower than the baseline is a regression
+MIN_REGRESSION_MS = 1.0 # ...and by at least this much, so sub-millisecond stages do not flag on timer noise
+BATCH_SIZE = 128
+
+# ---------------------------------------------------------------------------
+# Synthetic scenes
+# ---------------------------------------------------------------------------
+def synthetic_ground_truth(height, width, num_classes=NUM_CLASSES, seed=0):
+    """Field-like labels: FIELD_SIZE square parcels of random classes, a fifth left as background (0)."""
+    rng = np.random.default_rng(seed)
+    parcels = rng.integers(1, num_classes + 1, size=(-(-height // FIELD_SIZE), -(-width // FIELD_SIZE)))
+    parcels[rng.random(parcels.shape) < 0.2] = 0
+    return np.kron(parcels, np.ones((FIELD_SIZE, FIELD_SIZE), dtype=parcels.dtype))[:height, :width].astype(np.uint8)
+
+def synthetic_cube(ground_truth, bands, seed=0):
+    """
+    A float32 (height, width, bands) cube in [0, 1] whose pixels follow a smooth
+    mean spectrum per class of the ground truth, plus Gaussian noise.
+    """
+    rng = np.random.default_rng(seed)
+    num_classes = int(ground_truth.max()) + 1
+    walks = np.cumsum(rng.normal(0, 1, size=(num_classes, bands)), axis=1)
+    walks -= walks.min(axis=1, keepdims=True)
+    spectra = 0.1 + 0.8 * walks / np.maximum(walks.max(axis=1, keepdims=True), 1e-6)
+    cube = spectra[ground_truth].astype(np.float32)
+    cube += rng.normal(0, NOISE_STD, size=cube.shape).astype(np.float32)
+    return np.clip(cube, 0, 1, out=cube)
+
+def build_scene(spec, seed=0):
+    """
+    Builds a benchmark scene from a spec.
+
+    Args:
+        spec (str): 'synthetic:HxWxB' for synthetic labels and spectra, or
+            'indian_pines_gt' / 'indian_pines_gt:B' for the bundled Indian Pines
+            ground truth with synthetic B-band (default 200) spectra.
+
+    Returns:
+        tuple: (hypercube, ground_truth).
+    """
+    kind, _, size = spec.partition(':')
+    if kind == 'synthetic':
+        try:
+            height, width, bands = (int(n) for n in size.lower().split('x'))
+        except ValueError:
+            raise ValueError(f'Synthetic scenes are given as synthetic:HxWxB, got \'{spec}\'.')
+        ground_truth = synthetic_ground_truth(height, width, seed=seed)
+    elif kind == 'indian_pines_gt':
+        bands = int(size) if size else 200
+        mat = scipy.io.loadmat(GROUND_TRUTH_PATH)
+        ground_truth = next(v for k, v in mat.items() if isinstance(v, np.ndarray) and v.ndim > 1).astype(np.uint8)
+    else:
+        raise ValueError(f'Unknown scene \'{spec}\'. Expected synthetic:HxWxB or indian_pines_gt[:B].')
+    return synthetic_cube(ground_truth, bands, seed), ground_truth
+
+def write_scene_files(folder, hypercube, ground_truth):
+    """Saves a scene as the .mat pair load_hyperspectral_data (and the apps' default scene) read."""
+    os.makedirs(folder, exist_ok=True)
+    scipy.io.savemat(os.path.join(folder, 'Indian_pines_corrected.mat'), {'indian_pines_corrected': hypercube})
+    scipy.io.savemat(os.path.join(folder, 'Indian_pines_gt.mat'), {'indian_pines_gt': ground_truth})
+
+def benchmark_model(bands, seed=0):
+    """A CropClassifier with seeded random weights; throughput does not depend on what the weights learned."""
+    torch.manual_seed(seed)
+    model = CropClassifier(NUM_CLASSES, bands)
+    model.eval()
+    return model
+
+def _rgb_bands(bands):
+    return RGB_BANDS if bands > max(RGB_BANDS) else (bands * 3 // 4, bands // 2, bands // 4)
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+def _reset_peak_rss():
+    """Resets the kernel's RSS high-water mark (Linux); False where that is not supported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def measure(stage, scene, run, repeat, pixels=None, setup=None):
+    """
+    Times run() repeat times.
+
+    Args:
+        stage (str): Name of the stage.
+        scene (str): Spec of the scene it ran on.
+        run (callable): The work to time.
+        repeat (int): Number of timed runs.
+        pixels (int): Pixels processed per run, for the throughput; None if not pixel based.
+        setup (callable): Optional untimed step before every run (e.g. clearing a cache).
+
+    Returns:
+        dict: Latency percentiles in milliseconds, pixels per second (from the median
+        run) and the peak RSS during the stage. peak_rss_is_stage is False where the
+        high-water mark cannot be reset, i.e. the peak is the process's so far.
+    """
+    peak_resettable = _reset_peak_rss()
+    latencies = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+    median = float(np.median(latencies))
+    result = {
+        'stage': stage,
+        'scene': scene,
+        'repeat': repeat,
+        'pixels': pixels,
+        'latency_ms': {'mean': float(latencies.mean()), 'p50': median, 'p95': float(np.percentile(latencies, 95)),
+                       'p99': float(np.percentile(latencies, 99)), 'min': float(latencies.min()), 'max': float(latencies.max())},
+        'pixels_per_second': pixels / (median / 1000) if pixels and median > 0 else None,
+        'peak_rss_mb': _peak_rss_mb(),
+        'peak_rss_is_stage': peak_resettable,
+    }
+    throughput = f"{result['pixels_per_second']:>12,.0f} px/s" if result['pixels_per_second'] else ' ' * 17
+    print(f"{scene:<24}{stage:<34}p50 {median:>10.2f} ms  p95 {result['latency_ms']['p95']:>10.2f} ms"
+          f"{throughput}  peak RSS {result['peak_rss_mb']:>8.1f} MB")
+    return result
+
+# ---------------------------------------------------------------------------
+# Stages
+# ---------------------------------------------------------------------------
+def bench_load(spec, hypercube, ground_truth, workdir, repeat):
+    """load_hyperspectral_data: building the normalized .npy cache from .mat, and reopening it memory-mapped."""
+    folder = os.path.join(workdir, 'load')
+    cache_folder = os.path.join(folder, 'cache')
+    write_scene_files(folder, hypercube, ground_truth)
+    pixels = hypercube.shape[0] * hypercube.shape[1]
+    results = [
+        measure('load_hyperspectral_data_cold', spec, lambda: load_hyperspectral_data(folder, cache_folder=cache_folder),
+                repeat, pixels, setup=lambda: shutil.rmtree(cache_folder, ignore_errors=True)),
+        measure('load_hyperspectral_data_uncached', spec, lambda: load_hyperspectral_data(folder, use_cache=False),
+                repeat, pixels),
+    ]
+    # Warm: the cache exists, so each call opens the memmap and checks the header
+    load_hyperspectral_data(folder, cache_folder=cache_folder)
+    results.append(measure('load_hyperspectral_data_warm', spec,
+                           lambda: load_hyperspectral_data(folder, cache_folder=cache_folder), repeat, pixels))
+    return results
+
+def bench_patches(spec, hypercube, repeat):
+    """Padding the cube and cutting every pixel's patch into model-ready batches."""
+    pixels = hypercube.shape[0] * hypercube.shape[1]
+
+    def run():
+        for _ in iter_patch_batches(pad_cube(hypercube, PATCH_SIZE), PATCH_SIZE, BATCH_SIZE):
+            pass
+
+    return [measure('patch_batches', spec, run, repeat, pixels)]
+
+def bench_inference(spec, hypercube, repeat, max_pixels):
+    """run_prediction in dense and patch mode, on the first rows of the scene up to max_pixels."""
+    height, width, bands = hypercube.shape
+    rows = max(1, min(height, max_pixels // width)) if max_pixels else height
+    cube = np.ascontiguousarray(hypercube[:rows])
+    model = benchmark_model(bands)
+    torch.set_num_threads(os.cpu_count() or 1)
+    run_prediction(model, cube[:min(rows, PATCH_SIZE)], batch_size=BATCH_SIZE)  # Warm-up: kernel selection, allocations
+    return [measure(f'run_prediction_{mode}', spec, lambda mode=mode: run_prediction(model, cube, batch_size=BATCH_SIZE, mode=mode),
+                    repeat, rows * width)
+            for mode in ('dense', 'patch')]
+
+def bench_rgb(spec, hypercube, repeat):
+    pixels = hypercube.shape[0] * hypercube.shape[1]
+    rgb_bands = _rgb_bands(hypercube.shape[2])
+    return [measure('create_rgb_visualization', spec, lambda: create_rgb_visualization(hypercube, rgb_bands), repeat, pixels)]
+
+def bench_iot(repeat):
+    return [measure('generate_iot_data_24h', '-', lambda: generate_iot_data(24), max(repeat, 20))]
+
+def bench_api(spec, hypercube, ground_truth, workdir, repeat):
+    """
+    End-to-end FastAPI timings through an in-process TestClient, against a copy of the
+    scene registered as the default scene with a seeded model of its band count.
+    """
+    folder = os.path.join(workdir, 'api')
+    write_scene_files(folder, hypercube, ground_truth)
+    os.makedirs(os.path.join(folder, 'models'), exist_ok=True)
+    torch.save(benchmark_model(hypercube.shape[2]).state_dict(), os.path.join(folder, 'models', 'crop_classifier.pth'))
+    os.environ.update({
+        'DATA_FOLDER': folder,
+        'CACHE_FOLDER': os.path.join(folder, 'cache'),
+        'MODELS_FOLDER': os.path.join(folder, 'models'),
+        'UPLOAD_FOLDER': os.path.join(folder, 'uploads'),
+        'NUM_CLASSES': str(NUM_CLASSES),
+        'DEFAULT_SCENE': 'indian_pines',
+    })
+    from fastapi.testclient import TestClient
+    import app_fastapi
+    from modules.result_cache import ResultCache
+    from modules.incremental_inference import ChangeTracker
+
+    height, width = ground_truth.shape
+    pixels = height * width
+    client = TestClient(app_fastapi.app)
+    client.__enter__()  # Runs the startup event (model loading)
+
+    def get(path, **params):
+        def run():
+            response = client.get(path, params=params)
+            if response.status_code != 200:
+                raise RuntimeError(f'GET {path} returned {response.status_code}: {response.text[:200]}')
+        return run
+
+    def fresh_result_cache():
+        # A cold analysis: an empty prediction cache and no earlier analysis to diff against
+        app_fastapi.result_cache = ResultCache(tempfile.mkdtemp(dir=folder))
+        app_fastapi.change_tracker = ChangeTracker(app_fastapi.result_cache)
+
+    scene_id = 'indian_pines'
+    try:
+        return [
+            measure('api_load_data', spec, get('/api/load_data'), repeat, pixels),
+            measure('api_scene_stats', spec, get(f'/api/scenes/{scene_id}/stats'), repeat),
+            measure('api_run_analysis_cold', spec, get('/api/run_analysis', format='raw'), repeat, pixels,
+                    setup=fresh_result_cache),
+            measure('api_run_analysis_cached', spec, get('/api/run_analysis', format='raw'), repeat, pixels),
+            measure('api_run_analysis_json_cached', spec, get('/api/run_analysis'), repeat, pixels),
+            measure('api_tile', spec, get('/tiles/0/0/0.png'), repeat),
+            measure('api_index_raster_ndvi', spec, get('/api/indices/raster', index='ndvi'), repeat, pixels),
+            measure('api_get_spectral_signature', spec, get('/api/get_spectral_signature', x=width // 2, y=height // 2),
+                    max(repeat, 20)),
+        ]
+    finally:
+        client.__exit__(None, None, None)
+
+# ---------------------------------------------------------------------------
+# Baseline comparison
+# ---------------------------------------------------------------------------
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares median latencies and peak RSS with a saved baseline run.
+
+    Returns:
+        list: One dict per stage present in both runs, with 'regression' set where the
+        median latency grew by more than tolerance (and MIN_REGRESSION_MS).
+    """
+    previous = {(r['scene'], r['stage']): r for r in baseline['results']}
+    rows = []
+    for result in results:
+        before = previous.get((result['scene'], result['stage']))
+        if before is None:
+            continue
+        ratio = result['latency_ms']['p50'] / before['latency_ms']['p50'] if before['latency_ms']['p50'] else float('inf')
+        rows.append({'scene': result['scene'], 'stage': result['stage'], 'baseline_p50_ms': before['latency_ms']['p50'],
+                     'p50_ms': result['latency_ms']['p50'], 'ratio': ratio,
+                     'peak_rss_delta_mb': result['peak_rss_mb'] - before['peak_rss_mb'],
+                     'regression': ratio > 1 + tolerance
+                                   and result['latency_ms']['p50'] - before['latency_ms']['p50'] > MIN_REGRESSION_MS})
+    return rows
+
+def print_comparison(rows, baseline_meta, meta):
+    for key in ('cpu_count', 'torch', 'numpy', 'machine'):
+        if baseline_meta.get(key) != meta.get(key):
+            print(f"Warning: baseline {key} {baseline_meta.get(key)} differs from this run's {meta.get(key)}")
+    print(f"\n{'scene':<24}{'stage':<34}{'baseline':>12}{'now':>12}{'ratio':>8}{'RSS delta':>12}")
+    for row in rows:
+        flag = '  REGRESSION' if row['regression'] else ''
+        print(f"{row['scene']:<24}{row['stage']:<34}{row['baseline_p50_ms']:>10.2f}ms{row['p50_ms']:>10.2f}ms"
+              f"{row['ratio']:>7.2f}x{row['peak_rss_delta_mb']:>10.1f}MB{flag}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark data loading, patch extraction, inference, rendering and API endpoints.')
+    parser.add_argument('--scenes', nargs='+', default=list(DEFAULT_SCENES),
+                        help='synthetic:HxWxB and/or indian_pines_gt[:B] (the bundled ground truth with synthetic spectra)')
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stage')
+    parser.add_argument('--max-inference-pixels', type=int, default=8192,
+                        help='Inference runs on the first rows of each scene up to this many pixels; 0 for the whole scene')
+    parser.add_argument('--api-scene', default=DEFAULT_SCENES[0], help='Scene the API endpoints are timed on')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='Earlier --output file to compare against; exits with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed median latency growth over the baseline, as a fraction')
+    args = parser.parse_args()
+
+    meta = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'args': vars(args),
+    }
+    results = []
+    with tempfile.TemporaryDirectory(prefix='field-prime-bench-') as workdir:
+        for spec in args.scenes:
+            hypercube, ground_truth = build_scene(spec, args.seed)
+            print(f"--- {spec}: {hypercube.shape[0]}x{hypercube.shape[1]}x{hypercube.shape[2]} ---")
+            if 'load' in args.stages:
+                results += bench_load(spec, hypercube, ground_truth, os.path.join(workdir, 'scene'), args.repeat)
+            if 'patches' in args.stages:
+                results += bench_patches(spec, hypercube, args.repeat)
+            if 'inference' in args.stages:
+                results += bench_inference(spec, hypercube, args.repeat, args.max_inference_pixels)
+            if 'rgb' in args.stages:
+                results += bench_rgb(spec, hypercube, args.repeat)
+        if 'iot' in args.stages:
+            results += bench_iot(args.repeat)
+        if 'api' in args.stages:
+            hypercube, ground_truth = build_scene(args.api_scene, args.seed)
+            print(f"--- API on {args.api_scene} ---")
+            results += bench_api(args.api_scene, hypercube, ground_truth, workdir, args.repeat)
+
+    report = {'meta': meta, 'results': results}
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report['comparison'] = compare(results, baseline, args.tolerance)
+        print_comparison(report['comparison'], baseline['meta'], meta)
+        regressions = [row for row in report['comparison'] if row['regression']]
+
+    tmp_path = f'{args.output}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, args.output)
+    print(f"\nResults written to {args.output}")
+    if regressions:
+        print(f"{len(regressions)} stage(s) slower than the baseline by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
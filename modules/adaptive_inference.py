@@ -0,0 +1,190 @@
+import os
+import time
+import argparse
+
+import numpy as np
+
+from modules.model_handler import predict_pixels, run_prediction
+from modules.tiled_scene import TiledScene
+
+DEFAULT_GRID_STEP = 8          # Spacing of the initial sample lattice, in pixels
+DEFAULT_MIN_CONFIDENCE = 0.9   # Cells whose corners are less sure than this are refined even if they agree
+
+def _lattice(length, step):
+    """Sample positions along one axis: every step-th pixel plus the last one."""
+    positions = np.unique(np.r_[np.arange(0, length, step), length - 1])
+    if len(positions) == 1:
+        return positions, positions
+    return positions[:-1], positions[1:]
+
+def _cell_corners(cells):
+    """(4n, 2) (row, col) corners of (n, 4) cells given as inclusive (r0, r1, c0, c1) bounds."""
+    r0, r1, c0, c1 = cells.T
+    return np.stack([np.stack([r0, c0], 1), np.stack([r0, c1], 1), np.stack([r1, c0], 1), np.stack([r1, c1], 1)], 1).reshape(-1, 2)
+
+def _subdivide(cells):
+    """Quadtree children of cells; an axis spanning at most one pixel step is not split."""
+    r0, r1, c0, c1 = cells.T
+    split_rows, split_cols = r1 - r0 > 1, c1 - c0 > 1
+    rm = np.where(split_rows, (r0 + r1) // 2, r1)
+    cm = np.where(split_cols, (c0 + c1) // 2, c1)
+    children = [np.stack(bounds, 1) for bounds in ((r0, rm, c0, cm), (r0, rm, cm, c1), (rm, r1, c0, cm), (rm, r1, cm, c1))]
+    keep = [np.ones(len(cells), dtype=bool), split_cols, split_rows, split_rows & split_cols]
+    return np.concatenate([child[k] for child, k in zip(children, keep)])
+
+def predict_adaptive(model, hypercube, grid_step=DEFAULT_GRID_STEP, min_confidence=DEFAULT_MIN_CONFIDENCE,
+                     batch_size=128, mask=None):
+    """
+    Coarse-to-fine classification of a scene.
+
+    The model first classifies a lattice of every grid_step-th pixel. Each lattice
+    cell whose four corners agree with at least min_confidence softmax probability
+    is filled with that label; other cells are split quadtree-style, their new
+    corners classified (one batched pass per level) and checked the same way,
+    down to single pixel steps. Corners are shared between neighbouring cells, so
+    a class boundary crossing a cell edge triggers refinement on both sides.
+
+    Larger grid_step and lower min_confidence save more forwards at the risk of
+    missing features smaller than a cell; min_confidence=1 refines every cell
+    whose corners are not all certain.
+
+    Args:
+        model (CropClassifier): The classifier (any module taking patch batches works).
+        hypercube (np.ndarray or TiledScene): The (height, width, bands) cube.
+        grid_step (int): Spacing of the initial lattice; 1 classifies every pixel.
+        min_confidence (float): Corner confidence needed to fill a cell by propagation.
+        batch_size (int): Patches per forward.
+        mask (np.ndarray): Optional (height, width) boolean region of interest; cells
+            outside it are skipped and its complement is 0 in the map.
+
+    Returns:
+        tuple: (prediction_map, report) where report counts the pixels classified by
+        the model ('forwards') against the forwards dense run_prediction would make.
+    """
+    if grid_step < 1:
+        raise ValueError(f'grid_step must be positive, got {grid_step}.')
+    scene = hypercube if isinstance(hypercube, TiledScene) else TiledScene(hypercube)
+    height, width = scene.height, scene.width
+    labels = np.zeros((height, width), dtype=np.int64)
+    confidence = np.zeros((height, width), dtype=np.float32)
+    known = np.zeros((height, width), dtype=bool)
+    levels = []
+
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != (height, width):
+            raise ValueError(f'Mask shape {mask.shape} does not match the {height}x{width} scene.')
+        # Summed-area table: selected pixels of any cell in O(1)
+        selected = np.zeros((height + 1, width + 1), dtype=np.int64)
+        selected[1:, 1:] = mask.cumsum(0).cumsum(1)
+
+    def in_mask(cells):
+        if mask is None:
+            return cells
+        r0, r1, c0, c1 = cells.T
+        count = selected[r1 + 1, c1 + 1] - selected[r0, c1 + 1] - selected[r1 + 1, c0] + selected[r0, c0]
+        return cells[count > 0]
+
+    def classify(points):
+        points = np.unique(points, axis=0)  # Row-major, so batches read the cube in order
+        points = points[~known[points[:, 0], points[:, 1]]]
+        point_labels, point_confidence = predict_pixels(model, scene.cube, points, batch_size, return_confidence=True)
+        labels[points[:, 0], points[:, 1]] = point_labels
+        confidence[points[:, 0], points[:, 1]] = point_confidence
+        known[points[:, 0], points[:, 1]] = True
+        return len(points)
+
+    row_starts, row_ends = _lattice(height, grid_step)
+    col_starts, col_ends = _lattice(width, grid_step)
+    cells = np.stack([np.repeat(row_starts, len(col_starts)), np.repeat(row_ends, len(col_starts)),
+                      np.tile(col_starts, len(row_starts)), np.tile(col_ends, len(row_starts))], 1)
+    cells = in_mask(cells)
+
+    while len(cells):
+        corners = _cell_corners(cells)
+        forwards = classify(corners)
+        corner_labels = labels[corners[:, 0], corners[:, 1]].reshape(-1, 4)
+        corner_confidence = confidence[corners[:, 0], corners[:, 1]].reshape(-1, 4)
+        uniform = (corner_labels == corner_labels[:, :1]).all(axis=1) & (corner_confidence.min(axis=1) >= min_confidence)
+
+        # Fill agreeing cells, leaving pixels the model classified itself untouched
+        for (r0, r1, c0, c1), label in zip(cells[uniform], corner_labels[uniform, 0]):
+            block = labels[r0:r1 + 1, c0:c1 + 1]
+            block[~known[r0:r1 + 1, c0:c1 + 1]] = label
+
+        refine = cells[~uniform]
+        refine = refine[(refine[:, 1] - refine[:, 0] > 1) | (refine[:, 3] - refine[:, 2] > 1)]  # Else all pixels are corners
+        levels.append({'cells': int(len(cells)), 'filled': int(uniform.sum()), 'forwards': forwards})
+        cells = in_mask(_subdivide(refine))
+
+    pixels = height * width
+    if mask is not None:
+        labels[~mask] = 0
+        pixels = int(mask.sum())
+    forwards = sum(level['forwards'] for level in levels)
+    report = {
+        'pixels': pixels,
+        'forwards': forwards,
+        'forwards_saved': pixels - forwards,
+        'saved_fraction': (pixels - forwards) / pixels if pixels else 0.0,
+        'grid_step': grid_step,
+        'min_confidence': min_confidence,
+        'levels': levels,
+    }
+    return labels, report
+
+def compare_with_dense(model, hypercube, settings, batch_size=128, ground_truth=None):
+    """
+    Runs dense run_prediction once and predict_adaptive per (grid_step, min_confidence)
+    setting, reporting forwards saved, agreement with the dense map and time.
+
+    Returns:
+        list: One dict per setting, after a 'dense' reference row.
+    """
+    start = time.perf_counter()
+    reference, _ = run_prediction(model, hypercube, batch_size=batch_size)
+    dense_seconds = time.perf_counter() - start
+    labeled = ground_truth > 0 if ground_truth is not None else None
+
+    def row(name, prediction_map, forwards, seconds):
+        result = {'setting': name, 'forwards': forwards, 'saved_fraction': 1 - forwards / reference.size,
+                  'agreement_with_dense': float(np.mean(prediction_map == reference)),
+                  'seconds': seconds, 'speedup': dense_seconds / seconds}
+        if labeled is not None:
+            result['accuracy'] = float(np.mean(prediction_map[labeled] == ground_truth[labeled]))
+        return result
+
+    results = [row('dense', reference, reference.size, dense_seconds)]
+    for grid_step, min_confidence in settings:
+        start = time.perf_counter()
+        prediction_map, report = predict_adaptive(model, hypercube, grid_step, min_confidence, batch_size)
+        results.append(row(f'k={grid_step} c={min_confidence:g}', prediction_map, report['forwards'],
+                           time.perf_counter() - start))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare coarse-to-fine adaptive inference with dense run_prediction.')
+    parser.add_argument('--model-path', default=os.path.join('models', 'crop_classifier.pth'))
+    parser.add_argument('--data-folder', default='data')
+    parser.add_argument('--num-classes', type=int, default=16)
+    parser.add_argument('--grid-steps', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--min-confidence', type=float, nargs='+', default=[0.5, 0.9])
+    args = parser.parse_args()
+
+    from modules.data_handler import load_hyperspectral_data
+    from modules.model_export import load_fp32_model
+    from modules.spectral_reduction import load_reducer
+    hypercube, ground_truth = load_hyperspectral_data(args.data_folder)
+    reducer = load_reducer(args.model_path)
+    if reducer is not None:
+        hypercube = reducer.transform_cube(hypercube)
+    model = load_fp32_model(args.model_path, args.num_classes)
+
+    settings = [(k, c) for k in args.grid_steps for c in args.min_confidence]
+    print(f"{'setting':<16}{'forwards':>10}{'saved':>8}{'agreement':>11}{'accuracy':>10}{'seconds':>9}{'speedup':>9}")
+    for row in compare_with_dense(model, hypercube, settings, ground_truth=ground_truth):
+        print(f"{row['setting']:<16}{row['forwards']:>10}{row['saved_fraction']:>8.1%}{row['agreement_with_dense']:>11.4f}"
+              f"{row['accuracy']:>10.4f}{row['seconds']:>9.2f}{row['speedup']:>8.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.prediction_stream import RunningClassCounts
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+class QueueFullError(RuntimeError):
+    """Raised when a job is submitted while the queue is at its depth limit."""
+
+class AnalysisJob:
+    """
+    State of one background analysis, including row progress and its result.
+
+    Finished row blocks are kept while the job runs so that streaming listeners,
+    including ones that subscribe late, see every block exactly once. They are
+    dropped when the job finishes; by then the full result is available.
+    """
+
+    def __init__(self, key, rows_total):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = JOB_QUEUED
+        self.rows_done = 0
+        self.rows_total = rows_total
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self.blocks = []
+        self.class_counts = RunningClassCounts()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def update_progress(self, rows_done, rows_total):
+        self.rows_done = rows_done
+        self.rows_total = rows_total
+
+    def add_block(self, r0, r1, labels):
+        """Records a finished row block and forwards it to the listeners."""
+        with self._lock:
+            self.class_counts.add(labels)
+            block = (r0, r1, labels.copy(), self.class_counts.summary())
+            self.blocks.append(block)
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(block)
+
+    def subscribe(self, listener):
+        """
+        Calls listener(block) for every block so far and every later one, then
+        listener(None) once the job finishes. block is (r0, r1, labels, class_summary).
+
+        Returns:
+            bool: False if the job had already finished; nothing is replayed then.
+        """
+        with self._lock:
+            if self.finished:
+                return False
+            blocks = list(self.blocks)
+            self._listeners.append(listener)
+        for block in blocks:
+            listener(block)
+        return True
+
+    def _close(self):
+        with self._lock:
+            listeners, self._listeners = self._listeners, []
+            self.blocks = []
+        for listener in listeners:
+            listener(None)
+
+    @property
+    def finished(self):
+        return self.status in (JOB_DONE, JOB_FAILED)
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'rows_done': self.rows_done,
+            'rows_total': self.rows_total,
+            'progress': self.rows_done / self.rows_total if self.rows_total else 0.0,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+class JobManager:
+    """
+    Runs analyses on a bounded thread pool.
+
+    At most max_queue_depth jobs may be queued or running; further submissions
+    raise QueueFullError. Submitting a key that already has a queued or running
+    job returns that job instead of starting a second one. The last
+    max_finished_jobs finished jobs are kept so clients can still fetch results.
+    """
+
+    def __init__(self, max_workers=1, max_queue_depth=8, max_finished_jobs=64):
+        self.max_queue_depth = max_queue_depth
+        self.max_finished_jobs = max_finished_jobs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='analysis-job')
+        self._jobs = OrderedDict()
+        self._active = {}  # key -> job, for coalescing duplicate submissions
+        self._lock = threading.Lock()
+
+    def submit(self, key, work, rows_total=0):
+        """
+        Schedules work(progress_callback, block_callback) -> result, or joins the active job for key.
+
+        Returns:
+            AnalysisJob: The new or coalesced job.
+        """
+        with self._lock:
+            job = self._active.get(key)
+            if job is not None:
+                return job
+            if len(self._active) >= self.max_queue_depth:
+                raise QueueFullError(f'Analysis queue is full ({self.max_queue_depth} jobs pending).')
+
+            job = AnalysisJob(key, rows_total)
+            self._jobs[job.id] = job
+            self._active[key] = job
+            job.future = self._executor.submit(self._run, job, work)
+            return job
+
+    def _run(self, job, work):
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        try:
+            result = work(job.update_progress, job.add_block)
+            with job._lock:
+                job.result = result
+                job.rows_done = job.rows_total
+                job.status = JOB_DONE
+        except Exception as e:
+            with job._lock:
+                job.error = str(e)
+                job.status = JOB_FAILED
+        finally:
+            job.finished_at = time.time()
+            job._close()
+            with self._lock:
+                self._active.pop(job.key, None)
+                self._forget_old_jobs()
+        return job
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            return {'active_jobs': len(self._active), 'tracked_jobs': len(self._jobs),
+                    'max_queue_depth': self.max_queue_depth}
@@ -0,0 +1,111 @@
+import numpy as np
+
+from modules.tiled_scene import TiledScene
+
+HISTOGRAM_BINS = 4096  # Bins per band; percentiles are exact to within one bin of that band's range
+
+class BandHistograms:
+    """
+    One histogram per band of a scene, each over that band's own value range.
+
+    Built once per scene in two streamed passes (per-band min/max, then one
+    np.bincount per row block covering all bands), after which percentiles of
+    any band or combination of bands are resolved from the counts alone in
+    O(bands x bins), with no pass over the pixels. A false-colour composite
+    of any band triplet therefore gets its contrast stretch for free.
+    """
+
+    def __init__(self, low, high, counts):
+        """
+        Args:
+            low (np.ndarray): (bands,) smallest value of each band.
+            high (np.ndarray): (bands,) largest value of each band.
+            counts (np.ndarray): (bands, bins) pixel counts; bin i of band b covers
+                low[b] + [i, i + 1) * (high[b] - low[b]) / bins.
+        """
+        self.low = np.asarray(low, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+
+    @classmethod
+    def from_scene(cls, hypercube, bins=HISTOGRAM_BINS, low=None, high=None):
+        """
+        Computes the histograms of every band of a cube or TiledScene, block by block.
+        Per-band low/high already known (e.g. from modules.band_statistics) save the first pass.
+        """
+        scene = hypercube if isinstance(hypercube, TiledScene) else TiledScene(hypercube)
+        bands = scene.bands
+
+        if low is None or high is None:
+            low = np.full(bands, np.inf)
+            high = np.full(bands, -np.inf)
+            for _, _, window in scene.iter_windows():
+                np.minimum(low, window.min(axis=(0, 1)), out=low)
+                np.maximum(high, window.max(axis=(0, 1)), out=high)
+        low, high = np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64)
+
+        # Bin index of every value, offset by band so a single bincount fills all histograms
+        scale = (bins / np.where(high > low, high - low, 1.0)).astype(np.float32)
+        offsets = np.arange(bands, dtype=np.int64) * bins
+        counts = np.zeros(bands * bins, dtype=np.int64)
+        for _, _, window in scene.iter_windows():
+            window -= low.astype(np.float32)
+            window *= scale
+            index = window.astype(np.int64)
+            np.clip(index, 0, bins - 1, out=index)  # The maximum falls in the last bin
+            index += offsets
+            counts += np.bincount(index.ravel(), minlength=bands * bins)
+        return cls(low, high, counts.reshape(bands, bins))
+
+    @property
+    def bands(self):
+        return self.counts.shape[0]
+
+    @property
+    def bins(self):
+        return self.counts.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.low.nbytes + self.high.nbytes + self.counts.nbytes
+
+    def rebinned(self, bins):
+        """Coarser histograms (e.g. for display); bins must divide the current bin count."""
+        if bins < 1 or self.bins % bins:
+            raise ValueError(f'Histogram bins must divide {self.bins}, got {bins}.')
+        return self.counts.reshape(self.bands, bins, self.bins // bins).sum(axis=2)
+
+    def edges(self, band):
+        return np.linspace(self.low[band], self.high[band], self.bins + 1)
+
+    def _cdf(self, band, values):
+        """Pixels of `band` at or below each value, spreading every bin's count evenly over it."""
+        if self.high[band] <= self.low[band]:
+            return np.where(values >= self.low[band], self.counts[band].sum(), 0).astype(np.float64)
+        cumulative = np.concatenate(([0], np.cumsum(self.counts[band])))
+        return np.interp(values, self.edges(band), cumulative)
+
+    def percentiles(self, bands, percentiles):
+        """
+        Percentiles over the pooled pixels of the given bands.
+
+        Args:
+            bands (list): Band indices (e.g. the red, green and blue bands of a composite).
+            percentiles (tuple): Percentiles in [0, 100].
+
+        Returns:
+            list: One value per percentile.
+        """
+        bands = [int(b) for b in bands]
+        points = np.unique(np.concatenate([self.low[bands], self.high[bands]] + [self.edges(b) for b in bands]))
+        cdf = sum(self._cdf(b, points) for b in bands)
+        total = cdf[-1]
+
+        values = []
+        for percentile in percentiles:
+            rank = percentile / 100 * total
+            i = min(max(int(np.searchsorted(cdf, rank, side='left')), 1), len(points) - 1)
+            step = cdf[i] - cdf[i - 1]
+            fraction = (rank - cdf[i - 1]) / step if step else 1.0
+            values.append(float(points[i - 1] + min(max(fraction, 0.0), 1.0) * (points[i] - points[i - 1])))
+        return values
@@ -0,0 +1,152 @@
+import os
+
+import numpy as np
+
+from modules.tiled_scene import TiledScene
+from modules.band_histograms import BandHistograms, HISTOGRAM_BINS
+
+STATISTICS_FORMAT_VERSION = 1
+
+class BandStatistics:
+    """
+    Per-band summary of a scene: min, max, mean, standard deviation and
+    histogram of every band, plus the mean spectrum of every ground-truth class.
+
+    Computed once per scene content (one streamed pass for the moments and
+    class sums, one for the histograms) and kept as an .npz sidecar next to
+    the cached cube, keyed by the cube's fingerprint, so reports, contrast
+    stretches and the stats API read these numbers instead of rescanning the
+    cube per request.
+    """
+
+    def __init__(self, fingerprint, pixels, minimum, maximum, mean, std, histograms,
+                 class_labels=(), class_pixels=(), class_means=None):
+        self.fingerprint = fingerprint
+        self.pixels = int(pixels)
+        self.min = np.asarray(minimum, dtype=np.float64)
+        self.max = np.asarray(maximum, dtype=np.float64)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.std = np.asarray(std, dtype=np.float64)
+        self.histograms = histograms
+        self.class_labels = np.asarray(class_labels, dtype=np.int64)
+        self.class_pixels = np.asarray(class_pixels, dtype=np.int64)
+        self.class_means = (np.asarray(class_means, dtype=np.float64) if class_means is not None
+                            else np.zeros((0, len(self.mean))))
+
+    @classmethod
+    def from_scene(cls, hypercube, ground_truth=None, fingerprint=None, bins=HISTOGRAM_BINS):
+        """
+        Computes the statistics of a cube or TiledScene block by block.
+
+        Args:
+            hypercube (np.ndarray or TiledScene): The (height, width, bands) cube.
+            ground_truth (np.ndarray): Optional (height, width) labels, 0 = unlabeled;
+                a mean spectrum is computed for every other label.
+            fingerprint (str): Content hash of the cube the statistics belong to.
+            bins (int): Histogram bins per band.
+        """
+        scene = hypercube if isinstance(hypercube, TiledScene) else TiledScene(hypercube)
+        bands = scene.bands
+
+        labels = np.asarray(ground_truth) if ground_truth is not None else None
+        class_labels = np.unique(labels[labels > 0]) if labels is not None else np.zeros(0, dtype=np.int64)
+        class_index = np.zeros(int(class_labels.max()) + 1 if len(class_labels) else 1, dtype=np.int64)
+        class_index[class_labels] = np.arange(1, len(class_labels) + 1)  # 0 collects unlabeled pixels
+
+        minimum = np.full(bands, np.inf)
+        maximum = np.full(bands, -np.inf)
+        total = np.zeros(bands)
+        total_squares = np.zeros(bands)
+        class_sums = np.zeros((len(class_labels) + 1, bands))
+        class_pixels = np.zeros(len(class_labels) + 1, dtype=np.int64)
+        for r0, r1, window in scene.iter_windows():
+            np.minimum(minimum, window.min(axis=(0, 1)), out=minimum)
+            np.maximum(maximum, window.max(axis=(0, 1)), out=maximum)
+            pixels = window.reshape(-1, bands).astype(np.float64)
+            total += pixels.sum(axis=0)
+            total_squares += np.einsum('ij,ij->j', pixels, pixels)
+            if len(class_labels):
+                # Class sums by sorting the block's pixels by class and summing each run with reduceat
+                block_classes = class_index[labels[r0:r1].ravel()]
+                order = np.argsort(block_classes, kind='stable')
+                sorted_classes = block_classes[order]
+                starts = np.flatnonzero(np.r_[True, sorted_classes[1:] != sorted_classes[:-1]])
+                class_sums[sorted_classes[starts]] += np.add.reduceat(pixels[order], starts, axis=0)
+                class_pixels += np.bincount(block_classes, minlength=len(class_labels) + 1)
+
+        count = scene.height * scene.width
+        mean = total / max(count, 1)
+        std = np.sqrt(np.maximum(total_squares / max(count, 1) - mean ** 2, 0))
+        histograms = BandHistograms.from_scene(scene, bins, low=minimum, high=maximum)
+        class_means = class_sums[1:] / np.maximum(class_pixels[1:], 1)[:, None]
+        return cls(fingerprint, count, minimum, maximum, mean, std, histograms,
+                   class_labels, class_pixels[1:], class_means)
+
+    @classmethod
+    def load_or_compute(cls, path, hypercube, ground_truth=None, fingerprint=None, bins=HISTOGRAM_BINS):
+        """
+        Reads the sidecar at path if it was written for this cube (same fingerprint
+        and bin count); otherwise computes the statistics and writes the sidecar.
+        Without a path the statistics are only computed.
+        """
+        if path is not None:
+            statistics = cls.load(path)
+            if statistics is not None and statistics.fingerprint == fingerprint and statistics.histograms.bins == bins:
+                return statistics
+        statistics = cls.from_scene(hypercube, ground_truth, fingerprint, bins)
+        if path is not None:
+            statistics.save(path)
+        return statistics
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez_compressed(tmp_path, version=STATISTICS_FORMAT_VERSION, fingerprint=self.fingerprint or '',
+                            pixels=self.pixels, min=self.min, max=self.max, mean=self.mean, std=self.std,
+                            histogram_low=self.histograms.low, histogram_high=self.histograms.high,
+                            histogram_counts=self.histograms.counts, class_labels=self.class_labels,
+                            class_pixels=self.class_pixels, class_means=self.class_means)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """The statistics stored at path, or None if the file is missing, unreadable or outdated."""
+        try:
+            with np.load(path) as data:
+                if int(data['version']) != STATISTICS_FORMAT_VERSION:
+                    return None
+                histograms = BandHistograms(data['histogram_low'], data['histogram_high'], data['histogram_counts'])
+                return cls(str(data['fingerprint']) or None, int(data['pixels']), data['min'], data['max'],
+                           data['mean'], data['std'], histograms, data['class_labels'], data['class_pixels'],
+                           data['class_means'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    @property
+    def nbytes(self):
+        return self.histograms.nbytes + self.class_means.nbytes + 4 * self.mean.nbytes
+
+    def to_dict(self, histogram_bins=None):
+        """
+        JSON-serializable summary.
+
+        Args:
+            histogram_bins (int): If given, include per-band histograms rebinned to this
+                many bins (must divide the stored bin count).
+        """
+        summary = {
+            'pixels': self.pixels,
+            'bands': len(self.mean),
+            'min': self.min.tolist(),
+            'max': self.max.tolist(),
+            'mean': self.mean.tolist(),
+            'std': self.std.tolist(),
+            'class_mean_spectra': {str(label): {'pixels': int(pixels), 'mean': spectrum.tolist()}
+                                   for label, pixels, spectrum in zip(self.class_labels, self.class_pixels,
+                                                                      self.class_means)},
+        }
+        if histogram_bins:
+            summary['histograms'] = {'bins': histogram_bins, 'low': self.histograms.low.tolist(),
+                                     'high': self.histograms.high.tolist(),
+                                     'counts': self.histograms.rebinned(histogram_bins).tolist()}
+        return summary
@@ -0,0 +1,266 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+from modules.model_handler import PATCH_SIZE
+from modules.patch_extractor import gather_patches
+from modules.metrics import timed
+
+DEFAULT_MAX_LATENCY_MS = 5  # Longest a partial batch waits for more patches
+LATENCY_WINDOW = 1000       # Recent requests kept for the latency percentiles
+MAX_POINTS = 2048           # Pixels per classify_points request
+POINTS_IN_FLIGHT = 2        # classify_points chunks (of the server's batch_size) gathered ahead of their results
+
+class _Request:
+    __slots__ = ('patches', 'future', 'arrival', 'offset', 'done', 'logits')
+
+    def __init__(self, patches):
+        self.patches = patches
+        self.future = Future()
+        self.arrival = time.perf_counter()
+        self.offset = 0   # Patches handed to batches so far
+        self.done = 0     # Patches whose logits are in
+        self.logits = None
+
+class BatchingServer:
+    """
+    In-process inference server in front of one model, shared by every caller.
+
+    Callers submit patch batches of any size (the (n, 1, PATCH_SIZE, PATCH_SIZE,
+    bands) arrays of modules.patch_extractor) and get a Future of their logits.
+    A single worker thread coalesces the queued patches of all callers into
+    batches of batch_size, running a partial batch once its oldest request has
+    waited max_latency_ms. Under concurrent load the model sees full batches
+    instead of many small ones competing for the cores; a lone caller with a
+    full batch is served at once and a partial one waits at most the deadline.
+    """
+
+    def __init__(self, model, batch_size=128, max_latency_ms=DEFAULT_MAX_LATENCY_MS, name='inference-server'):
+        if batch_size < 1 or max_latency_ms < 0:
+            raise ValueError('batch_size must be positive and max_latency_ms non-negative.')
+        self.model = model
+        self.batch_size = batch_size
+        self.max_latency = max_latency_ms / 1000
+        self._queue = deque()
+        self._queued_patches = 0
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._requests = 0
+        self._patches = 0
+        self._batches = 0
+        self._errors = 0
+
+        self._thread = threading.Thread(target=self._serve, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, patches):
+        """
+        Queues patches for classification.
+
+        Args:
+            patches (np.ndarray): (n, 1, PATCH_SIZE, PATCH_SIZE, bands) float32 patches.
+                The array is read by the worker until the Future resolves, so do not
+                overwrite it before then.
+
+        Returns:
+            Future: Resolves to the (n, num_classes) float32 logits.
+        """
+        request = _Request(np.ascontiguousarray(patches, dtype=np.float32))
+        if len(request.patches) == 0:
+            request.future.set_result(np.zeros((0, 0), dtype=np.float32))
+            return request.future
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('The inference server is closed.')
+            self._queue.append(request)
+            self._queued_patches += len(request.patches)
+            self._condition.notify()
+        return request.future
+
+    def classify(self, patches, timeout=None):
+        """Blocking submit: ((n,) 1-indexed labels, (n,) softmax confidence of each label)."""
+        return _labels(self.submit(patches).result(timeout))
+
+    def close(self):
+        """Stops the worker once the queued patches are served."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def stats(self):
+        """Queue length, batch-fill ratio and per-request latency percentiles (milliseconds)."""
+        with self._condition:
+            queue_length, queued_patches = len(self._queue), self._queued_patches
+        with self._stats_lock:
+            latencies = np.array(self._latencies) * 1000
+            requests, patches, batches, errors = self._requests, self._patches, self._batches, self._errors
+        return {
+            'queue_length': queue_length,
+            'queued_patches': queued_patches,
+            'requests': requests,
+            'patches': patches,
+            'batches': batches,
+            'errors': errors,
+            'batch_size': self.batch_size,
+            'max_latency_ms': self.max_latency * 1000,
+            'batch_fill_ratio': patches / (batches * self.batch_size) if batches else 0.0,
+            'latency_ms': {name: float(np.percentile(latencies, q)) if len(latencies) else None
+                           for name, q in (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100))},
+        }
+
+    def _next_batch(self):
+        """Waits for work, then takes up to batch_size patches from the head of the queue as (request, start, stop) parts."""
+        with self._condition:
+            while not self._queue and not self._closed:
+                self._condition.wait()
+            if not self._queue:
+                return None
+            deadline = self._queue[0].arrival + self.max_latency
+            while self._queued_patches < self.batch_size and not self._closed:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            parts = []
+            taken = 0
+            while self._queue and taken < self.batch_size:
+                request = self._queue[0]
+                count = min(self.batch_size - taken, len(request.patches) - request.offset)
+                parts.append((request, request.offset, request.offset + count))
+                request.offset += count
+                taken += count
+                if request.offset == len(request.patches):
+                    self._queue.popleft()
+            self._queued_patches -= taken
+            return parts
+
+    def _serve(self):
+        while True:
+            parts = self._next_batch()
+            if parts is None:
+                return
+            if len(parts) == 1:
+                request, start, stop = parts[0]
+                batch = request.patches[start:stop]
+            else:
+                batch = np.concatenate([request.patches[start:stop] for request, start, stop in parts])
+
+            try:
+                with torch.no_grad(), timed('batched_forward'):
+                    logits = self.model(torch.from_numpy(batch)).cpu().numpy()
+            except Exception as e:
+                with self._stats_lock:
+                    self._errors += 1
+                for request, _, _ in parts:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+
+            finished = []
+            offset = 0
+            for request, start, stop in parts:
+                if request.logits is None:
+                    request.logits = np.empty((len(request.patches), logits.shape[1]), dtype=np.float32)
+                request.logits[start:stop] = logits[offset:offset + stop - start]
+                offset += stop - start
+                request.done += stop - start
+                if request.done == len(request.patches) and not request.future.done():
+                    finished.append(request)
+
+            now = time.perf_counter()
+            with self._stats_lock:
+                self._batches += 1
+                self._patches += len(batch)
+                self._requests += len(finished)
+                self._latencies.extend(now - request.arrival for request in finished)
+            for request in finished:
+                request.future.set_result(request.logits)
+
+def _labels(logits):
+    """((n,) 1-indexed labels, (n,) softmax confidence of each label) of (n, num_classes) logits."""
+    logits = torch.from_numpy(logits)
+    if logits.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    confidence, labels = torch.max(torch.softmax(logits, dim=1), dim=1)
+    return labels.numpy() + 1, confidence.numpy()
+
+class BatchedModel:
+    """
+    Model-like front of a BatchingServer for code that calls model(batch) one batch
+    at a time (model_handler.predict_pixels, the patch path of predict_rows,
+    adaptive inference), so those batches are coalesced with other callers'.
+    """
+
+    def __init__(self, server):
+        self.server = server
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        return torch.from_numpy(self.server.submit(x.cpu().numpy()).result())
+
+def classify_points(server, cube, points, reducer=None):
+    """
+    Classifies individual pixels through a BatchingServer.
+
+    Patches are gathered and submitted in chunks of the server's batch_size, with at
+    most POINTS_IN_FLIGHT chunks waiting for their logits, so memory follows the
+    batch size rather than the number of points.
+
+    Args:
+        cube (np.ndarray): The (height, width, bands) scene cube.
+        points (list): (x, y) pixel coordinates; x is the column, y the row.
+        reducer (SpectralReducer): The model's spectral reducer, if any.
+
+    Returns:
+        tuple: ((n,) 1-indexed labels, (n,) confidences), in the order given.
+
+    Raises:
+        ValueError: For too many points or points outside the scene.
+    """
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    height, width, bands = cube.shape
+    if len(points) > MAX_POINTS:
+        raise ValueError(f'At most {MAX_POINTS} points per request, got {len(points)}.')
+    outside = (points[:, 0] < 0) | (points[:, 0] >= width) | (points[:, 1] < 0) | (points[:, 1] >= height)
+    if outside.any():
+        x, y = points[np.argmax(outside)]
+        raise ValueError(f'Point ({x}, {y}) is outside the {width}x{height} scene.')
+
+    labels = np.empty(len(points), dtype=np.int64)
+    confidence = np.empty(len(points), dtype=np.float32)
+    pending = deque()
+
+    def collect():
+        start, future = pending.popleft()
+        chunk_labels, chunk_confidence = _labels(future.result())
+        labels[start:start + len(chunk_labels)] = chunk_labels
+        confidence[start:start + len(chunk_labels)] = chunk_confidence
+
+    for start in range(0, len(points), server.batch_size):
+        chunk = points[start:start + server.batch_size]
+        patches = np.empty((len(chunk), 1, PATCH_SIZE, PATCH_SIZE, bands), dtype=np.float32)  # Held by the server until served
+        gather_patches(cube, chunk[:, 1], chunk[:, 0], PATCH_SIZE, patches)
+        if reducer is not None:
+            # Reduce the gathered spectra, keeping the padding outside the scene at zero as transform_cube + pad_cube would
+            offsets = np.arange(PATCH_SIZE) - PATCH_SIZE // 2
+            rows, cols = chunk[:, 1, None] + offsets, chunk[:, 0, None] + offsets
+            padding = ~(((rows >= 0) & (rows < height))[:, :, None] & ((cols >= 0) & (cols < width))[:, None, :])
+            patches = reducer.transform(patches)
+            patches[:, 0][padding] = 0
+        pending.append((start, server.submit(patches)))
+        if len(pending) >= POINTS_IN_FLIGHT:
+            collect()
+    while pending:
+        collect()
+    return labels, confidence
@@ -2,74 +2,318 @@ import numpy as np
 import scipy.io
 from PIL import Image
 import os
+import json
+import hashlib
 
-def load_hyperspectral_data(data_folder_path):
+from modules.tiled_scene import TiledScene, band_percentiles
+from modules.metrics import timed
+from modules.incremental_inference import tile_checksums, CHECKSUM_TILE_SIZE
+
+HYPERCUBE_FILENAME = 'Indian_pines_corrected.mat'
+GROUND_TRUTH_FILENAME = 'Indian_pines_gt.mat'
+RGB_BANDS = (29, 19, 9)  # Red, green, blue band indices of the AVIRIS scenes
+
+# The normalized cube is converted once into an .npy file that later loads
+# open read-only with np.memmap, so every worker shares the same page cache.
+CACHE_FOLDER_NAME = 'cache'
+CACHE_FORMAT_VERSION = 2  # 2: tile checksums of the raw cube (modules.incremental_inference)
+CACHE_DTYPES = ('float32', 'float16')
+NORMALIZE_CHUNK_BANDS = 16  # Bands normalized per step while building the cache
+
+def _find_data_key(mat):
+    # The actual data is usually in a key that matches the filename (or similar)
+    # We find the key that contains the main data array
+    return [k for k, v in mat.items() if isinstance(v, np.ndarray) and v.ndim > 1][0]
+
+def _file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _source_record(path, with_hash=True):
+    stat = os.stat(path)
+    record = {'path': os.path.abspath(path), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+    if with_hash:
+        record['sha256'] = _file_sha256(path)
+    return record
+
+def _cache_paths(cache_folder, stem):
+    return {
+        'hypercube': os.path.join(cache_folder, f'{stem}_hypercube.npy'),
+        'ground_truth': os.path.join(cache_folder, f'{stem}_gt.npy'),
+        'meta': os.path.join(cache_folder, f'{stem}_meta.json'),
+        'stats': os.path.join(cache_folder, f'{stem}_stats.npz'),
+        'tiles': os.path.join(cache_folder, f'{stem}_tiles.npy'),
+    }
+
+def statistics_cache_path(cache_folder, hypercube_filename=HYPERCUBE_FILENAME, cache_dtype='float32'):
+    """Where the band statistics sidecar (modules.band_statistics) of a cached cube is kept."""
+    return _cache_paths(cache_folder, f'{os.path.splitext(hypercube_filename)[0]}_{cache_dtype}')['stats']
+
+def hypercube_cache_fingerprint(cache_folder, hypercube_filename=HYPERCUBE_FILENAME, cache_dtype='float32'):
+    """
+    Content hash of a cached normalized cube, derived from its header (the sha256 of
+    the source files plus the normalization) instead of from the cube itself, so a
+    warm load does not read the whole cube. None if there is no cache header.
+    """
+    paths = _cache_paths(cache_folder, f'{os.path.splitext(hypercube_filename)[0]}_{cache_dtype}')
+    meta = _read_cache_meta(paths['meta'])
+    if meta is None:
+        return None
+    payload = {key: meta.get(key) for key in ('version', 'shape', 'dtype', 'min', 'max')}
+    payload['sources'] = {name: record['sha256'] for name, record in meta['sources'].items()}
+    return hashlib.blake2b(json.dumps(payload, sort_keys=True).encode(), digest_size=20).hexdigest()
+
+def raw_tile_checksums(cache_folder, hypercube_filename=HYPERCUBE_FILENAME, cache_dtype='float32'):
     """
-    Loads and preprocesses the Indian Pines hyperspectral dataset.
+    Tile checksums of a cached cube's raw, pre-normalization values, taken when the
+    cache was built, and the (min, max) it was normalized by. Diffing these rather than
+    the normalized cube keeps a change of a global extreme from dirtying every tile.
+
+    Returns:
+        tuple: (checksums, (min, max)), or None if there is no cache header.
+    """
+    paths = _cache_paths(cache_folder, f'{os.path.splitext(hypercube_filename)[0]}_{cache_dtype}')
+    meta = _read_cache_meta(paths['meta'])
+    if meta is None or meta.get('tile_size') != CHECKSUM_TILE_SIZE:
+        return None
+    try:
+        checksums = np.load(paths['tiles'])
+    except (OSError, ValueError):
+        return None
+    return checksums, (meta['min'], meta['max'])
+
+def _write_json_atomic(path, payload):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f, indent=2)
+    os.replace(tmp_path, path)
+
+def _read_cache_meta(meta_path):
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _validate_cache(meta, source_paths, paths, dtype):
+    """
+    Checks a cache header against the current source files.
+
+    A matching mtime and size is trusted as-is; when only the mtime moved
+    (e.g. the files were copied) the sources are re-hashed and the header is
+    refreshed if the content is unchanged.
+
+    Returns:
+        bool: True if the cached arrays can be used.
+    """
+    if meta is None or meta.get('version') != CACHE_FORMAT_VERSION or meta.get('dtype') != dtype:
+        return False
+    if set(meta['sources']) != set(source_paths):
+        return False
+    if not all(os.path.isfile(paths[k]) for k in ('hypercube', 'ground_truth', 'tiles')):
+        return False
+
+    refreshed = False
+    for name, path in source_paths.items():
+        cached = meta['sources'].get(name)
+        current = _source_record(path, with_hash=False)
+        if cached is None or cached['size'] != current['size']:
+            return False
+        if cached['mtime_ns'] != current['mtime_ns']:
+            if _file_sha256(path) != cached['sha256']:
+                return False
+            cached['mtime_ns'] = current['mtime_ns']
+            refreshed = True
+
+    if refreshed:
+        _write_json_atomic(paths['meta'], meta)
+    return True
+
+def build_hypercube_cache(hypercube_path, gt_path, cache_folder, dtype='float32'):
+    """
+    Converts a hyperspectral .mat file into a normalized on-disk cache.
+
+    Args:
+        hypercube_path (str): Path to the hyperspectral .mat file.
+        gt_path (str): Path to the ground truth .mat file, or None for an unlabeled
+            scene (the cached ground truth is then all zeros).
+        cache_folder (str): Folder the cache files are written to.
+        dtype (str): Storage dtype of the normalized cube ('float32' or 'float16').
+
+    Returns:
+        dict: The cache header (shape, dtype, min/max and source fingerprints).
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(hypercube_path))[0]
+    paths = _cache_paths(cache_folder, f'{stem}_{dtype}')
+
+    sources = {'hypercube': _source_record(hypercube_path)}
+    if gt_path is not None:
+        sources['ground_truth'] = _source_record(gt_path)
+
+    with timed('mat_load'):
+        corrected_mat = scipy.io.loadmat(hypercube_path)
+        raw_cube = corrected_mat[_find_data_key(corrected_mat)]
+        if gt_path is not None:
+            gt_mat = scipy.io.loadmat(gt_path)
+            ground_truth = gt_mat[_find_data_key(gt_mat)]
+        else:
+            ground_truth = np.zeros(raw_cube.shape[:2], dtype=np.uint8)
+
+    pid = os.getpid()
+    cube_tmp = f"{paths['hypercube']}.{pid}.tmp"
+    gt_tmp = f"{paths['ground_truth']}.{pid}.tmp"
+    tiles_tmp = f"{paths['tiles']}.{pid}.tmp"
+    with timed('normalization'):
+        # Normalize to [0, 1] a few bands at a time so the float64 working copy
+        # never covers more than NORMALIZE_CHUNK_BANDS bands
+        data_min = float(np.min(raw_cube))
+        data_max = float(np.max(raw_cube))
+        scale = (data_max - data_min) or 1.0
+
+        cube_out = np.lib.format.open_memmap(cube_tmp, mode='w+', dtype=dtype, shape=raw_cube.shape)
+        for b in range(0, raw_cube.shape[2], NORMALIZE_CHUNK_BANDS):
+            chunk = raw_cube[:, :, b:b + NORMALIZE_CHUNK_BANDS].astype(np.float64)
+            cube_out[:, :, b:b + NORMALIZE_CHUNK_BANDS] = (chunk - data_min) / scale
+        cube_out.flush()
+        del cube_out
+    with open(gt_tmp, 'wb') as f:
+        np.save(f, ground_truth)
+    with open(tiles_tmp, 'wb') as f:
+        np.save(f, tile_checksums(raw_cube, CHECKSUM_TILE_SIZE))
+
+    os.replace(cube_tmp, paths['hypercube'])
+    os.replace(gt_tmp, paths['ground_truth'])
+    os.replace(tiles_tmp, paths['tiles'])
+
+    # The header is written last so a half-built cache is never considered valid
+    meta = {
+        'version': CACHE_FORMAT_VERSION,
+        'shape': list(raw_cube.shape),
+        'dtype': dtype,
+        'min': data_min,
+        'max': data_max,
+        'tile_size': CHECKSUM_TILE_SIZE,
+        'sources': sources,
+    }
+    _write_json_atomic(paths['meta'], meta)
+    return meta
+
+def load_hyperspectral_data(data_folder_path, use_cache=True, cache_folder=None, cache_dtype='float32',
+                            hypercube_filename=HYPERCUBE_FILENAME, ground_truth_filename=GROUND_TRUTH_FILENAME):
+    """
+    Loads and preprocesses a hyperspectral dataset (Indian Pines by default).
+
+    The first call converts the .mat files into a normalized cache; later calls
+    open the cached cube read-only with np.memmap instead of re-parsing them.
 
     Args:
         data_folder_path (str): The path to the folder containing the dataset.
+        use_cache (bool): Whether to read/write the memory-mapped cache.
+        cache_folder (str): Where the cache lives. Defaults to '<data_folder_path>/cache'.
+        cache_dtype (str): Storage dtype of the cached cube ('float32' or 'float16').
+        hypercube_filename (str): The .mat file holding the cube.
+        ground_truth_filename (str): The .mat file holding the labels, or None for an
+            unlabeled scene (ground truth is then all zeros).
 
     Returns:
         tuple: A tuple containing:
             - hypercube (np.ndarray): The normalized hyperspectral data cube.
             - ground_truth (np.ndarray): The ground truth data.
     """
-    corrected_path = os.path.join(data_folder_path, 'Indian_pines_corrected.mat')
-    gt_path = os.path.join(data_folder_path, 'Indian_pines_gt.mat')
+    corrected_path = os.path.join(data_folder_path, hypercube_filename)
+    gt_path = os.path.join(data_folder_path, ground_truth_filename) if ground_truth_filename else None
 
-    if not os.path.isfile(corrected_path) or not os.path.isfile(gt_path):
+    if not os.path.isfile(corrected_path) or (gt_path is not None and not os.path.isfile(gt_path)):
         raise FileNotFoundError(f'Dataset files not found in \'{data_folder_path}\'. Please download them as instructed.')
 
-    # Load the .mat files
-    corrected_mat = scipy.io.loadmat(corrected_path)
-    gt_mat = scipy.io.loadmat(gt_path)
+    if not use_cache:
+        # Load the .mat files
+        with timed('mat_load'):
+            corrected_mat = scipy.io.loadmat(corrected_path)
+            hypercube = corrected_mat[_find_data_key(corrected_mat)]
+            if gt_path is not None:
+                gt_mat = scipy.io.loadmat(gt_path)
+                ground_truth = gt_mat[_find_data_key(gt_mat)]
+            else:
+                ground_truth = np.zeros(hypercube.shape[:2], dtype=np.uint8)
 
-    # The actual data is usually in a key that matches the filename (or similar)
-    # We find the key that contains the main data array
-    hypercube_key = [k for k, v in corrected_mat.items() if isinstance(v, np.ndarray) and v.ndim > 1][0]
-    gt_key = [k for k, v in gt_mat.items() if isinstance(v, np.ndarray) and v.ndim > 1][0]
+        # Normalize the hypercube data to the range [0, 1]
+        with timed('normalization'):
+            hypercube = hypercube.astype(np.float64)
+            hypercube -= np.min(hypercube)
+            hypercube /= np.max(hypercube)
+
+        return hypercube, ground_truth
 
-    hypercube = corrected_mat[hypercube_key]
-    ground_truth = gt_mat[gt_key]
+    if cache_dtype not in CACHE_DTYPES:
+        raise ValueError(f'Unsupported cache dtype \'{cache_dtype}\'. Expected one of {CACHE_DTYPES}.')
 
-    # Normalize the hypercube data to the range [0, 1]
-    hypercube = hypercube.astype(np.float64)
-    hypercube -= np.min(hypercube)
-    hypercube /= np.max(hypercube)
+    cache_folder = cache_folder or os.path.join(data_folder_path, CACHE_FOLDER_NAME)
+    paths = _cache_paths(cache_folder, f'{os.path.splitext(hypercube_filename)[0]}_{cache_dtype}')
+    source_paths = {'hypercube': corrected_path}
+    if gt_path is not None:
+        source_paths['ground_truth'] = gt_path
+
+    if not _validate_cache(_read_cache_meta(paths['meta']), source_paths, paths, cache_dtype):
+        build_hypercube_cache(corrected_path, gt_path, cache_folder, dtype=cache_dtype)
+
+    hypercube = np.load(paths['hypercube'], mmap_mode='r')
+    ground_truth = np.load(paths['ground_truth'])
 
     return hypercube, ground_truth
 
-def create_rgb_visualization(hypercube: np.ndarray):
+def stretch_to_uint8(block, low, high, out=None):
+    """Linearly maps [low, high] to [0, 255], clipping outside values. Modifies float32 `block` in place."""
+    np.clip(block, low, high, out=block)
+    block -= low
+    block *= 255 / ((high - low) or 1.0)
+    if out is None:
+        return block.astype(np.uint8)
+    out[...] = block
+    return out
+
+def create_rgb_visualization(hypercube, rgb_bands=RGB_BANDS, percentiles=(2, 98), stretch_range=None,
+                             histograms=None):
     """
     Creates a 3-channel RGB visualization from the hyperspectral cube.
 
+    The three bands are read and stretched one row block at a time, so only the
+    8-bit output covers the whole scene.
+
     Args:
-        hypercube (np.ndarray): The normalized hyperspectral data cube.
+        hypercube (np.ndarray or TiledScene): The normalized hyperspectral data cube.
+        rgb_bands (tuple): Indices of the red, green and blue bands.
+        percentiles (tuple): Lower and upper percentile of the contrast stretch.
+        stretch_range (tuple): Precomputed (low, high) values; skips the percentile pass.
+        histograms (BandHistograms): Precomputed band histograms (modules.band_histograms)
+            the percentiles are read from instead of scanning the bands.
 
     Returns:
         Image: A PIL Image object for the RGB visualization.
     """
-    # Bands for RGB visualization (adjust if necessary for different datasets)
-    red_band = 29
-    green_band = 19
-    blue_band = 9
+    scene = hypercube if isinstance(hypercube, TiledScene) else TiledScene(hypercube)
 
-    rgb_image = np.stack([
-        hypercube[:, :, red_band],
-        hypercube[:, :, green_band],
-        hypercube[:, :, blue_band]
-    ], axis=-1)
+    # Bands for RGB visualization (set per scene, see modules.scene_registry)
+    red_band, green_band, blue_band = rgb_bands
+    rgb_bands = [red_band, green_band, blue_band]
 
     # Perform contrast stretching to improve visibility (similar to imadjust)
     # This simple version clips the data at the 2nd and 98th percentiles
-    p2, p98 = np.percentile(rgb_image, (2, 98))
-    rgb_image_stretched = np.clip(rgb_image, p2, p98)
-    rgb_image_stretched = (rgb_image_stretched - p2) / (p98 - p2)
+    with timed('rgb_render'):
+        if stretch_range is None:
+            stretch_range = (histograms.percentiles(rgb_bands, percentiles) if histograms is not None
+                             else band_percentiles(scene, rgb_bands, percentiles))
+        low, high = stretch_range
+
+        # Convert to an 8-bit image for display
+        rgb_image_8bit = np.empty((scene.height, scene.width, 3), dtype=np.uint8)
+        for r0, r1, rgb_block in scene.iter_windows(bands=rgb_bands):
+            stretch_to_uint8(rgb_block, low, high, out=rgb_image_8bit[r0:r1])
 
-    # Convert to an 8-bit image for display
-    rgb_image_8bit = (rgb_image_stretched * 255).astype(np.uint8)
-    
     return Image.fromarray(rgb_image_8bit)
 
 if __name__ == '__main__':
@@ -0,0 +1,264 @@
+import os
+import io
+import hashlib
+import threading
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from modules.model_handler import PATCH_SIZE
+from modules.probability_maps import store_outputs
+from modules.metrics import timed
+
+CHECKSUM_TILE_SIZE = 32  # Side of the tiles a cube is checksummed and diffed in
+FULL_RUN_DIRTY_FRACTION = 0.9  # Above this share of dirty pixels the whole scene is simply re-run
+
+def tile_checksums(cube, tile_size=CHECKSUM_TILE_SIZE):
+    """
+    Content hash of every tile_size x tile_size tile of a (height, width, bands) cube.
+
+    The cube is read one band of tile rows at a time, so a memory-mapped cube is
+    streamed. Returns a (tiles_down, tiles_across) uint64 array.
+    """
+    height, width = cube.shape[:2]
+    checksums = np.empty((-(-height // tile_size), -(-width // tile_size)), dtype=np.uint64)
+    for i, r0 in enumerate(range(0, height, tile_size)):
+        rows = np.asarray(cube[r0:r0 + tile_size])
+        for j, c0 in enumerate(range(0, width, tile_size)):
+            digest = hashlib.blake2b(np.ascontiguousarray(rows[:, c0:c0 + tile_size]).data, digest_size=8)
+            checksums[i, j] = int.from_bytes(digest.digest(), 'little')
+    return checksums
+
+def _dilate(mask, radius):
+    """Square (Chebyshev) dilation of a boolean mask, one separable pass per axis."""
+    for axis in (0, 1):
+        padding = [(0, 0), (0, 0)]
+        padding[axis] = (radius, radius)
+        mask = sliding_window_view(np.pad(mask, padding), 2 * radius + 1, axis=axis).any(axis=-1)
+    return mask
+
+def dirty_pixels(old_checksums, new_checksums, height, width, tile_size=CHECKSUM_TILE_SIZE, halo=PATCH_SIZE // 2):
+    """
+    Pixels whose prediction may have changed between two cubes: the pixels of the
+    tiles whose checksums differ, dilated by the patch halo, since a pixel's patch
+    reaches halo pixels into its neighbours.
+
+    Returns:
+        np.ndarray: (height, width) boolean mask.
+    """
+    changed = np.asarray(old_checksums) != np.asarray(new_checksums)
+    mask = np.repeat(np.repeat(changed, tile_size, axis=0), tile_size, axis=1)[:height, :width]
+    return _dilate(mask, halo) if halo else mask
+
+def patch_class_summary(class_summary, old_labels, new_labels):
+    """
+    Updates per-class pixel counts (summarize_prediction format) for pixels whose label
+    went from old_labels to new_labels, without recounting the rest of the map.
+    """
+    size = int(max(np.max(old_labels, initial=0), np.max(new_labels, initial=0),
+                   max((entry['crop_type_id'] for entry in class_summary), default=0))) + 1
+    with timed('summary'):
+        counts = np.zeros(size, dtype=np.int64)
+        for entry in class_summary:
+            counts[entry['crop_type_id']] = entry['pixel_count']
+        counts -= np.bincount(np.asarray(old_labels, dtype=np.int64).ravel(), minlength=size)
+        counts += np.bincount(np.asarray(new_labels, dtype=np.int64).ravel(), minlength=size)
+        return [{'crop_type_id': cls, 'pixel_count': int(count)} for cls, count in enumerate(counts) if cls != 0 and count]
+
+def classify_changes(engine, hypercube, base_result, base_checksums, mask=None, top_k=0, tile_size=CHECKSUM_TILE_SIZE,
+                     progress_callback=None, block_callback=None, checksums=None, normalization=None,
+                     base_normalization=None):
+    """
+    Classifies an updated cube by re-running only what changed since a previous result.
+
+    The cube's tile checksums are diffed against base_checksums (those of the cube
+    base_result was computed from); the dirty tiles, dilated by the patch halo, are
+    classified as a masked InferenceEngine run and patched into a copy of the base
+    map, probability maps and class counts. Work follows the size of the change. Without
+    a usable base (none given, another shape) or when nearly everything changed, the
+    scene is classified in full.
+
+    modules.data_handler normalizes a scene by its global min / max, so the checksums
+    of a cached scene are taken from its raw cube when the cache is built and passed
+    in with that (min, max) as normalization. If the constants moved since the base,
+    every normalized value moved with them: the scene is classified in full and the
+    report says so (normalization_changed), while changed_tiles still counts only the
+    tiles whose raw values changed. Without precomputed checksums the normalized cube
+    is hashed here, one pass over the cube.
+
+    Args:
+        engine (InferenceEngine): The engine base_result came from.
+        hypercube (np.ndarray or TiledScene): The updated (height, width, bands) cube.
+        base_result (tuple): (prediction_map, class_summary[, probability_maps]) of the old cube, or None.
+        base_checksums (np.ndarray): tile_checksums of the old cube, or None.
+        mask (np.ndarray): The region of interest base_result was restricted to, if any.
+        top_k (int): As InferenceEngine.run; base_result must have been run with the same top_k.
+        progress_callback, block_callback: As InferenceEngine.run; blocks carry the patched rows.
+        checksums (np.ndarray): The updated cube's raw tile checksums, if precomputed.
+        normalization (tuple): The (min, max) the updated cube was normalized by, with checksums.
+        base_normalization (tuple): The (min, max) behind base_checksums, if they are raw.
+
+    Returns:
+        tuple: (result, checksums, report), where result is as InferenceEngine.run,
+        checksums are the updated cube's (with report['normalization'] if they are raw)
+        and report counts the pixels re-classified.
+    """
+    cube = getattr(hypercube, 'cube', hypercube)
+    height, width = cube.shape[:2]
+    tiles_shape = (-(-height // tile_size), -(-width // tile_size))
+    if checksums is None or np.shape(checksums) != tiles_shape:
+        checksums, normalization = tile_checksums(cube, tile_size), None
+    normalization = tuple(normalization) if normalization is not None else None
+    base_normalization = tuple(base_normalization) if base_normalization is not None else None
+    run_kwargs = {'progress_callback': progress_callback, 'mask': mask, 'top_k': top_k}
+
+    # Raw and normalized checksums are not comparable
+    if base_result is None or base_checksums is None or np.shape(base_checksums) != checksums.shape \
+            or base_result[0].shape != (height, width) or (normalization is None) != (base_normalization is None):
+        result = engine.run(hypercube, block_callback=block_callback, **run_kwargs)
+        return result, checksums, {'incremental': False, 'normalization': normalization, 'normalization_changed': False,
+                                   'changed_tiles': int(checksums.size), 'tiles': int(checksums.size),
+                                   'pixels': height * width, 'reclassified': height * width}
+
+    changed_tiles = int(np.count_nonzero(base_checksums != checksums))
+    if normalization != base_normalization:
+        result = engine.run(hypercube, block_callback=block_callback, **run_kwargs)
+        return result, checksums, {'incremental': False, 'normalization': normalization, 'normalization_changed': True,
+                                   'changed_tiles': changed_tiles, 'tiles': int(checksums.size),
+                                   'pixels': height * width, 'reclassified': height * width}
+
+    dirty = dirty_pixels(base_checksums, checksums, height, width, tile_size)
+    if mask is not None:
+        dirty &= mask
+    reclassified = int(np.count_nonzero(dirty))
+    report = {'incremental': True, 'normalization': normalization, 'normalization_changed': False,
+              'changed_tiles': changed_tiles, 'tiles': int(checksums.size), 'pixels': height * width,
+              'reclassified': reclassified}
+
+    if reclassified > FULL_RUN_DIRTY_FRACTION * height * width:
+        result = engine.run(hypercube, block_callback=block_callback, **run_kwargs)
+        return result, checksums, {**report, 'incremental': False}
+
+    prediction_map = np.array(base_result[0], dtype=np.int64)
+    probability_maps = {layer: np.array(values) for layer, values in base_result[2].items()} if top_k else None
+    if reclassified == 0:
+        if progress_callback is not None:
+            progress_callback(height, height)
+        if block_callback is not None:
+            block_callback(0, height, prediction_map)
+        result = (prediction_map, list(base_result[1]))
+        return (result + (probability_maps,) if top_k else result), checksums, report
+
+    old_labels = prediction_map[dirty]
+
+    def patched_block(r0, r1, labels):
+        # Blocks of a masked run are 0 outside the mask; stream the base rows with the dirty pixels replaced
+        rows = prediction_map[r0:r1]
+        rows[dirty[r0:r1]] = labels[dirty[r0:r1]]
+        block_callback(r0, r1, rows)
+
+    run_kwargs['mask'] = dirty
+    partial = engine.run(hypercube, block_callback=patched_block if block_callback is not None else None, **run_kwargs)
+    new_labels = partial[0][dirty]
+    prediction_map[dirty] = new_labels
+    class_summary = patch_class_summary(base_result[1], old_labels, new_labels)
+    if top_k:
+        rows, cols = np.nonzero(dirty)
+        store_outputs(probability_maps, (rows, cols), {layer: values[rows, cols] for layer, values in partial[2].items()})
+        return (prediction_map, class_summary, probability_maps), checksums, report
+    return (prediction_map, class_summary), checksums, report
+
+class ChangeTracker:
+    """
+    Remembers, per analysis lineage (a scene id plus the model and inference settings,
+    without the cube's content), which cached result was computed last, the tile
+    checksums of its cube and, for raw checksums, the cube's normalization, so the next
+    run on an updated cube only re-classifies the tiles that changed (see classify_changes).
+    Runs forced by a new normalization are counted as normalization_reruns.
+
+    Entries live next to the result cache as <lineage>.tiles.npz, so lineages survive
+    restarts; the results themselves stay in the modules.result_cache.ResultCache.
+    """
+
+    def __init__(self, result_cache, folder=None, tile_size=CHECKSUM_TILE_SIZE):
+        self.result_cache = result_cache
+        self.folder = folder or result_cache.cache_folder
+        self.tile_size = tile_size
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.incremental_runs = 0
+        self.normalization_reruns = 0
+        self.pixels = 0
+        self.reclassified = 0
+        self.last_report = None
+
+    def _path(self, lineage_key):
+        return os.path.join(self.folder, f'{lineage_key}.tiles.npz')
+
+    def get(self, lineage_key):
+        """(result key, tile checksums, normalization or None) of the latest classification of a lineage, or None."""
+        with self._lock:
+            entry = self._entries.get(lineage_key)
+        if entry is not None:
+            return entry
+        path = self._path(lineage_key)
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as stored:
+            if int(stored['tile_size']) != self.tile_size or 'normalization' not in stored.files:
+                return None
+            normalization = tuple(stored['normalization'].tolist()) or None  # Empty for normalized-cube checksums
+            entry = (str(stored['result_key']), stored['checksums'], normalization)
+        with self._lock:
+            self._entries[lineage_key] = entry
+        return entry
+
+    def put(self, lineage_key, result_key, checksums, normalization=None):
+        os.makedirs(self.folder, exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez(buffer, result_key=result_key, checksums=checksums, tile_size=self.tile_size,
+                 normalization=np.array(normalization or (), dtype=np.float64))
+        tmp_path = f'{self._path(lineage_key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(buffer.getvalue())
+        os.replace(tmp_path, self._path(lineage_key))
+        with self._lock:
+            self._entries[lineage_key] = (result_key, checksums, tuple(normalization) if normalization else None)
+
+    def run(self, engine, hypercube, lineage_key, result_key, mask=None, top_k=0, progress_callback=None,
+            block_callback=None, checksums=None, normalization=None):
+        """
+        Classifies a cube, incrementally from the lineage's previous result when it is
+        still cached, and records this run as the lineage's latest. Meant as the compute
+        step of ResultCache.get_or_compute(result_key, ...), i.e. on a cache miss.
+        checksums / normalization are a cached scene's raw tile checksums and (min, max)
+        (LoadedScene.tile_checksums / normalization), if it has them.
+
+        Returns:
+            tuple: As InferenceEngine.run.
+        """
+        base = self.get(lineage_key)
+        base_result, base_checksums, base_normalization = None, None, None
+        if base is not None:
+            base_result = self.result_cache.get(base[0])
+            if base_result is not None:
+                base_checksums, base_normalization = base[1], base[2]
+        result, checksums, report = classify_changes(engine, hypercube, base_result, base_checksums, mask, top_k,
+                                                     self.tile_size, progress_callback, block_callback, checksums,
+                                                     normalization, base_normalization)
+        self.put(lineage_key, result_key, checksums, report['normalization'])
+        with self._lock:
+            self.runs += 1
+            self.incremental_runs += report['incremental']
+            self.normalization_reruns += report['normalization_changed']
+            self.pixels += report['pixels']
+            self.reclassified += report['reclassified']
+            self.last_report = report
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'runs': self.runs, 'incremental_runs': self.incremental_runs,
+                    'normalization_reruns': self.normalization_reruns, 'pixels': self.pixels,
+                    'reclassified': self.reclassified, 'last_report': self.last_report}
@@ -0,0 +1,507 @@
+import os
+import json
+import time
+import logging
+from dataclasses import dataclass, asdict, replace
+from contextlib import contextmanager
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+
+from modules.model_handler import (predict_rows, predict_tile, predict_pixels, plan_masked_prediction, summarize_prediction,
+                                   PATCH_SIZE, INFERENCE_MODES, ADAPTIVE_MODE)
+from modules.adaptive_inference import predict_adaptive, DEFAULT_GRID_STEP, DEFAULT_MIN_CONFIDENCE
+from modules.batching_server import BatchedModel
+from modules.probability_maps import empty_probability_maps, store_outputs, validate_top_k
+from modules.tiled_scene import TiledScene
+from modules.model_export import serialize_model, deserialize_model
+from modules.metrics import count_pixels, paused
+
+logger = logging.getLogger(__name__)
+
+EXECUTORS = ('thread', 'process')
+AUTOTUNE_BATCH_SIZES = (128, 512)
+AUTOTUNE_SAMPLE_ROWS = 16  # Rows of the scene timed per autotune candidate
+MASKED_CHUNK_BATCHES = 8  # Full batches of region-of-interest pixels per work item
+
+@dataclass
+class InferenceConfig:
+    """Tunables of the sharded inference engine. Zero thread counts mean 'derive from the CPU count'."""
+    mode: str = 'dense'
+    executor: str = 'thread'
+    workers: int = 1
+    batch_size: int = 128
+    tile_size: int = 32
+    shard_rows: int = 0            # Rows per shard; defaults to tile_size
+    intra_op_threads: int = 0      # torch.set_num_threads of the server process and of each process worker
+    inter_op_threads: int = 0      # torch.set_num_interop_threads, likewise
+    autotune: bool = False         # The web servers run InferenceEngine.autotune at start-up
+    autotune_path: str = os.path.join('models', 'inference_autotune.json')
+    adaptive_grid_step: int = DEFAULT_GRID_STEP             # mode='adaptive': initial sample lattice spacing
+    adaptive_min_confidence: float = DEFAULT_MIN_CONFIDENCE  # mode='adaptive': confidence needed to fill a cell
+
+    @classmethod
+    def from_env(cls):
+        """Builds a config from INFERENCE_* environment variables."""
+        defaults = cls()
+        return cls(
+            mode=os.getenv('INFERENCE_MODE', defaults.mode),
+            executor=os.getenv('INFERENCE_EXECUTOR', defaults.executor),
+            workers=int(os.getenv('INFERENCE_WORKERS', defaults.workers)),
+            batch_size=int(os.getenv('INFERENCE_BATCH_SIZE', defaults.batch_size)),
+            tile_size=int(os.getenv('INFERENCE_TILE_SIZE', defaults.tile_size)),
+            shard_rows=int(os.getenv('INFERENCE_SHARD_ROWS', defaults.shard_rows)),
+            intra_op_threads=int(os.getenv('INFERENCE_INTRA_OP_THREADS', defaults.intra_op_threads)),
+            inter_op_threads=int(os.getenv('INFERENCE_INTER_OP_THREADS', defaults.inter_op_threads)),
+            autotune=os.getenv('INFERENCE_AUTOTUNE', 'False').lower() == 'true',
+            autotune_path=os.getenv('INFERENCE_AUTOTUNE_PATH', defaults.autotune_path),
+            adaptive_grid_step=int(os.getenv('INFERENCE_ADAPTIVE_GRID_STEP', defaults.adaptive_grid_step)),
+            adaptive_min_confidence=float(os.getenv('INFERENCE_ADAPTIVE_MIN_CONFIDENCE', defaults.adaptive_min_confidence)),
+        )
+
+    def validate(self):
+        if self.mode not in INFERENCE_MODES + (ADAPTIVE_MODE,):
+            raise ValueError(f'Unknown inference mode \'{self.mode}\'. Expected one of {INFERENCE_MODES + (ADAPTIVE_MODE,)}.')
+        if self.executor not in EXECUTORS:
+            raise ValueError(f'Unknown executor \'{self.executor}\'. Expected one of {EXECUTORS}.')
+        if self.workers < 1 or self.batch_size < 1 or self.tile_size < 1:
+            raise ValueError('workers, batch_size and tile_size must be positive.')
+        if self.adaptive_grid_step < 1 or not 0 <= self.adaptive_min_confidence <= 1:
+            raise ValueError('adaptive_grid_step must be positive and adaptive_min_confidence within [0, 1].')
+
+    def resolved_intra_op_threads(self):
+        return self.intra_op_threads or max(1, (os.cpu_count() or 1) // self.workers)
+
+def shard_rows(height, rows_per_shard):
+    """Splits [0, height) into consecutive (r0, r1) row blocks."""
+    return [(r0, min(r0 + rows_per_shard, height)) for r0 in range(0, height, rows_per_shard)]
+
+def _set_torch_threads(intra_op_threads, inter_op_threads):
+    torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # Can only be set once per process, before any inter-op parallel work
+            logger.debug('Inter-op thread count already fixed for this process')
+
+def configure_torch_threads(config):
+    """
+    Applies a config's intra- / inter-op thread counts to PyTorch in this process.
+
+    Both are process-wide settings, so they are set once at start-up (the web servers
+    call this next to InferenceConfig.from_env) rather than by every run; process-pool
+    workers apply them in their initializer.
+    """
+    _set_torch_threads(config.resolved_intra_op_threads(), config.inter_op_threads)
+
+# --- Process pool workers: each loads the model once and maps the scene of every task itself ---
+_worker_model = None
+_worker_scene = None
+_worker_scene_source = None
+_worker_shm = None
+
+def _process_worker_init(model_payload, intra_op_threads, inter_op_threads):
+    global _worker_model
+    _set_torch_threads(intra_op_threads, inter_op_threads)
+    _worker_model = deserialize_model(model_payload)
+    _worker_model.eval()
+
+def _open_worker_scene(scene_source):
+    """
+    The scene of a task: the cube's .npy file memory-mapped, or the shared-memory copy
+    the parent made for the run. The last one is kept open for the run's other tasks.
+    """
+    global _worker_scene, _worker_scene_source, _worker_shm
+    if scene_source == _worker_scene_source:
+        return _worker_scene
+    _worker_scene, _worker_scene_source = None, None
+    if _worker_shm is not None:
+        _worker_shm.close()
+        _worker_shm = None
+    kind, *location = scene_source
+    if kind == 'npy':
+        _worker_scene = TiledScene.open(location[0])
+    else:
+        shm_name, shape, dtype = location
+        _worker_shm = shared_memory.SharedMemory(name=shm_name)
+        _worker_scene = TiledScene(np.ndarray(shape, dtype=dtype, buffer=_worker_shm.buf))  # Read-only by convention
+    _worker_scene_source = scene_source
+    return _worker_scene
+
+def _predict_shard(model, scene, r0, r1, batch_size, mode, tile_size, top_k=0):
+    """Classifies rows [r0, r1) from a full-width window with a half-patch halo."""
+    window = scene.read_window(r0, r1, halo=PATCH_SIZE // 2)
+    return predict_rows(model, window, 0, r1 - r0, batch_size=batch_size, mode=mode, tile_size=tile_size, top_k=top_k)
+
+def _process_worker_run(scene_source, r0, r1, batch_size, mode, tile_size, top_k=0):
+    scene = _open_worker_scene(scene_source)
+    return r0, r1, _predict_shard(_worker_model, scene, r0, r1, batch_size, mode, tile_size, top_k)
+
+def _predict_item(model, scene, item, batch_size, tile_size, top_k=0):
+    """Labels of one masked-run work item: a dense ('tile', (r0, r1, c0, c1)) or packed ('pixels', coords)."""
+    kind, value = item
+    if kind == 'tile':
+        return predict_tile(model, scene, *value, batch_size=batch_size, tile_size=tile_size, top_k=top_k)
+    return predict_pixels(model, scene.cube, value, batch_size=batch_size, top_k=top_k)
+
+def _process_worker_run_item(scene_source, index, item, batch_size, tile_size, top_k=0):
+    return index, _predict_item(_worker_model, _open_worker_scene(scene_source), item, batch_size, tile_size, top_k)
+
+def _store_result(prediction_map, probability_maps, index, result, keep=None):
+    """
+    Writes a predict_* result (labels, or (labels, probability outputs) when
+    probability_maps is given) into the maps at index, zeroing pixels outside keep.
+    """
+    labels = result
+    if probability_maps is not None:
+        labels, outputs = result
+        store_outputs(probability_maps, index, outputs, keep)
+    prediction_map[index] = labels if keep is None else np.where(keep, labels, 0)
+
+class InferenceEngine:
+    """
+    Runs full-scene classification as row shards on a thread or process pool.
+
+    Each shard reads its own full-width window of the scene with a half-patch
+    halo (modules.tiled_scene), so the cube is never padded or copied as a whole
+    and memory follows shard size, not scene size. Threads share the model
+    (PyTorch releases the GIL inside its kernels). The process pool is started
+    on the first process run and kept until close(): its workers receive a copy
+    of the model once, and each run only tells them where its cube is (the .npy
+    file they memory-map, or a shared-memory copy when the cube only lives in
+    RAM). Shard results are stitched into one prediction map.
+
+    With a region-of-interest mask only the selected pixels are classified: tiles
+    the mask mostly covers run densely and the other pixels are packed into full
+    batches from anywhere in the scene (modules.model_handler.plan_masked_prediction).
+
+    mode='adaptive' classifies coarse-to-fine instead (modules.adaptive_inference):
+    one in-process quadtree pass over the scene, whose report of forwards saved
+    is kept in last_adaptive_report.
+
+    A model trained on a spectrally reduced cube is given its SpectralReducer
+    (modules.spectral_reduction); the reduced cube is then built once per run
+    and sharded like any other in-memory cube. Masked runs (regions of interest,
+    incremental re-analysis) reduce only the tiles their pixels' patches reach.
+
+    run(top_k=k) also keeps the per-pixel confidence, margin and top-k classes of
+    the same forwards (modules.probability_maps); adaptive runs cannot, as most
+    of their pixels are filled without a forward.
+    """
+
+    def __init__(self, model, config=None, reducer=None, batching_server=None):
+        self.model = model
+        # Patch batches (patch mode, packed ROI pixels, adaptive forwards) of thread runs go through the
+        # shared modules.batching_server when given, so concurrent runs fill each other's batches
+        self.patch_model = BatchedModel(batching_server) if batching_server is not None else model
+        self.reducer = reducer
+        self.config = config or InferenceConfig()
+        self.config.validate()
+        self._tuned = False
+        self._tune_lock = threading.Lock()
+        self.last_adaptive_report = None
+        self._pool = None  # Process pool of executor='process', started on first use and kept across runs
+        self._pool_workers = 0
+        self._pool_lock = threading.Lock()
+
+    def run(self, hypercube, progress_callback=None, block_callback=None, mask=None, top_k=0):
+        """
+        Classifies the whole hypercube.
+
+        Args:
+            hypercube (np.ndarray or TiledScene): The (height, width, bands) data cube,
+                ideally memory-mapped.
+            progress_callback (callable): Optional progress_callback(rows_done, rows_total),
+                called as shards complete.
+            block_callback (callable): Optional block_callback(r0, r1, labels) receiving
+                each finished row block of the map, for streaming partial results.
+                Shards may finish out of order; callbacks are made one at a time.
+            mask (np.ndarray): Optional (height, width) boolean region of interest; pixels
+                outside it are not classified and are 0 in the map.
+            top_k (int): With top_k > 0, also returns the probability maps.
+
+        Returns:
+            tuple: (prediction_map, class_summary[, probability_maps]), as
+            modules.model_handler.run_prediction.
+        """
+        if top_k:
+            validate_top_k(top_k)
+            if self.config.mode == ADAPTIVE_MODE:
+                raise ValueError('Probability maps need every pixel classified; they are not available in adaptive mode.')
+        if self.reducer is not None:
+            if mask is not None and self.config.mode != ADAPTIVE_MODE:
+                # Only the masked pixels' patches are read: reduce just the tiles they reach
+                hypercube = self.reducer.transform_cube(hypercube, mask=mask, halo=PATCH_SIZE // 2,
+                                                        tile_size=self.config.tile_size)
+            else:
+                hypercube = self.reducer.transform_cube(hypercube)
+
+        config = self.config
+        scene = hypercube if isinstance(hypercube, TiledScene) else TiledScene(hypercube)
+        height, width, _ = scene.shape
+        shards = shard_rows(height, config.shard_rows or config.tile_size)
+        prediction_map = np.zeros((height, width), dtype=np.int64)
+        probability_maps = empty_probability_maps(height, width, top_k) if top_k else None
+
+        progress_lock = threading.Lock()
+        rows_done = 0
+
+        def shard_done(r0, r1):
+            nonlocal rows_done
+            with progress_lock:
+                rows_done += r1 - r0
+                if block_callback is not None:
+                    block_callback(r0, r1, prediction_map[r0:r1])
+                if progress_callback is not None:
+                    progress_callback(rows_done, height)
+
+        if config.mode == ADAPTIVE_MODE:
+            self._run_adaptive(scene, mask, prediction_map)
+            for r0, r1 in shards:
+                shard_done(r0, r1)
+        elif mask is not None:
+            self._run_masked(scene, mask, shards, prediction_map, probability_maps, shard_done)
+        elif config.executor == 'process' and config.workers > 1:
+            self._run_processes(scene, shards, prediction_map, probability_maps, shard_done)
+        else:
+            self._run_threads(scene, shards, prediction_map, probability_maps, shard_done)
+        if config.mode == ADAPTIVE_MODE:
+            count_pixels(self.last_adaptive_report['forwards'])  # Pixels filled without a forward do not count
+        else:
+            count_pixels(int(np.count_nonzero(mask)) if mask is not None else height * width)
+
+        if top_k:
+            return prediction_map, summarize_prediction(prediction_map), probability_maps
+        return prediction_map, summarize_prediction(prediction_map)
+
+    def _run_adaptive(self, scene, mask, prediction_map):
+        config = self.config
+        prediction_map[...], report = predict_adaptive(self.patch_model, scene, config.adaptive_grid_step,
+                                                       config.adaptive_min_confidence, config.batch_size, mask)
+        self.last_adaptive_report = report
+        logger.info(f"Adaptive inference: {report['forwards']} forwards for {report['pixels']} pixels "
+                    f"({report['saved_fraction']:.1%} saved)")
+
+    def _run_threads(self, scene, shards, prediction_map, probability_maps, shard_done):
+        config = self.config
+        self.model.eval()
+        dense = config.mode == 'dense' and hasattr(self.model, 'forward_dense')
+        model = self.model if dense else self.patch_model
+        top_k = probability_maps['top_k_labels'].shape[-1] if probability_maps is not None else 0
+
+        def work(shard):
+            r0, r1 = shard
+            result = _predict_shard(model, scene, r0, r1, config.batch_size, config.mode, config.tile_size, top_k)
+            _store_result(prediction_map, probability_maps, slice(r0, r1), result)
+            shard_done(r0, r1)
+
+        if config.workers == 1:
+            for shard in shards:
+                work(shard)
+            return
+
+        with ThreadPoolExecutor(max_workers=config.workers) as executor:
+            for future in [executor.submit(work, shard) for shard in shards]:
+                future.result()
+
+    def _executor(self):
+        """
+        The engine's spawn-based process pool, started on first use. Its workers import
+        torch and load the model once; runs only pass them where to find their scene.
+        """
+        config = self.config
+        with self._pool_lock:
+            if self._pool is not None and self._pool_workers != config.workers:
+                self._pool.shutdown()
+                self._pool = None
+            if self._pool is None:
+                initargs = (serialize_model(self.model), config.resolved_intra_op_threads(), config.inter_op_threads)
+                self._pool = ProcessPoolExecutor(max_workers=config.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_process_worker_init, initargs=initargs)
+                self._pool_workers = config.workers
+            return self._pool
+
+    @contextmanager
+    def _process_run(self, scene):
+        """
+        (executor, scene source) of one process-pool run. The scene source is the cube's
+        .npy path, or the name of a shared-memory copy of the cube made for this run.
+        A pool broken by a dead worker is dropped, so the next run starts a new one.
+        """
+        shm = None
+        path = scene.path
+        if path is not None:
+            scene_source = ('npy', path)
+        else:
+            cube = scene.cube
+            shm = shared_memory.SharedMemory(create=True, size=max(1, cube.nbytes))
+            np.ndarray(cube.shape, dtype=cube.dtype, buffer=shm.buf)[...] = cube
+            scene_source = ('shm', shm.name, cube.shape, cube.dtype.str)
+        executor = self._executor()
+        try:
+            yield executor, scene_source
+        except BrokenProcessPool:
+            with self._pool_lock:
+                if self._pool is executor:
+                    self._pool = None
+            raise
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    def close(self):
+        """Shuts down the process pool, if one was started."""
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    def _run_processes(self, scene, shards, prediction_map, probability_maps, shard_done):
+        config = self.config
+        top_k = probability_maps['top_k_labels'].shape[-1] if probability_maps is not None else 0
+        with self._process_run(scene) as (executor, scene_source):
+            futures = [executor.submit(_process_worker_run, scene_source, r0, r1, config.batch_size, config.mode,
+                                       config.tile_size, top_k)
+                       for r0, r1 in shards]
+            for future in as_completed(futures):
+                r0, r1, result = future.result()
+                _store_result(prediction_map, probability_maps, slice(r0, r1), result)
+                shard_done(r0, r1)
+
+    def _run_masked(self, scene, mask, shards, prediction_map, probability_maps, shard_done):
+        """
+        Classifies the pixels of a region-of-interest mask as work items (dense tiles and
+        chunks of MASKED_CHUNK_BATCHES full batches); a row shard is reported done once
+        every item touching its rows has finished.
+        """
+        config = self.config
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != (scene.height, scene.width):
+            raise ValueError(f'Mask shape {mask.shape} does not match the {scene.height}x{scene.width} scene.')
+
+        dense = config.mode == 'dense' and hasattr(self.model, 'forward_dense')
+        top_k = probability_maps['top_k_labels'].shape[-1] if probability_maps is not None else 0
+        tiles, coords = plan_masked_prediction(mask, config.tile_size, dense=dense)
+        chunk = config.batch_size * MASKED_CHUNK_BATCHES
+        items = [('tile', tile) for tile in tiles] + [('pixels', coords[i:i + chunk]) for i in range(0, len(coords), chunk)]
+
+        # Outstanding items per shard; chunks are row-major, so an item spans the shards between its first and last row
+        shard_starts = np.array([r0 for r0, _ in shards])
+        pending = np.zeros(len(shards), dtype=np.int64)
+        item_shards = []
+        for kind, value in items:
+            first_row, last_row = (value[0], value[1] - 1) if kind == 'tile' else (value[0, 0], value[-1, 0])
+            first, last = np.searchsorted(shard_starts, [first_row, last_row], side='right') - 1
+            item_shards.append(range(first, last + 1))
+            pending[first:last + 1] += 1
+        pending_lock = threading.Lock()
+
+        for index in np.flatnonzero(pending == 0):
+            shard_done(*shards[index])
+
+        def store(index, result):
+            kind, value = items[index]
+            if kind == 'tile':
+                r0, r1, c0, c1 = value
+                _store_result(prediction_map, probability_maps, (slice(r0, r1), slice(c0, c1)), result,
+                              keep=mask[r0:r1, c0:c1])
+            else:
+                _store_result(prediction_map, probability_maps, (value[:, 0], value[:, 1]), result)
+            finished = []
+            with pending_lock:
+                for shard in item_shards[index]:
+                    pending[shard] -= 1
+                    if pending[shard] == 0:
+                        finished.append(shards[shard])
+            for r0, r1 in finished:
+                shard_done(r0, r1)
+
+        if config.executor == 'process' and config.workers > 1:
+            with self._process_run(scene) as (executor, scene_source):
+                futures = [executor.submit(_process_worker_run_item, scene_source, index, item, config.batch_size,
+                                           config.tile_size, top_k)
+                           for index, item in enumerate(items)]
+                for future in as_completed(futures):
+                    store(*future.result())
+            return
+
+        self.model.eval()
+
+        def work(index):
+            model = self.model if items[index][0] == 'tile' else self.patch_model
+            store(index, _predict_item(model, scene, items[index], config.batch_size, config.tile_size, top_k))
+
+        if config.workers == 1:
+            for index in range(len(items)):
+                work(index)
+            return
+
+        with ThreadPoolExecutor(max_workers=config.workers) as executor:
+            for future in [executor.submit(work, index) for index in range(len(items))]:
+                future.result()
+
+    def autotune(self, hypercube):
+        """
+        Picks workers / intra-op threads / batch size for this machine.
+
+        Meant to be called once at start-up, before requests are served (the web servers
+        do so with INFERENCE_AUTOTUNE=true): the timed candidates change PyTorch's
+        process-wide thread counts, and they are kept out of the metrics. Candidates
+        are timed on the first AUTOTUNE_SAMPLE_ROWS rows of the scene with the thread
+        executor; the winner is stored in config.autotune_path, keyed by CPU count,
+        band count and mode, so later start-ups reuse it without re-timing. The winner
+        becomes this engine's config and its thread counts are applied to the process.
+        Concurrent calls tune once.
+
+        Returns:
+            InferenceConfig: The tuned config, for engines created later.
+        """
+        with self._tune_lock:
+            if self._tuned:
+                return self.config
+            config = self.config
+            cube = hypercube.cube if isinstance(hypercube, TiledScene) else hypercube
+            sample = np.asarray(cube[:min(AUTOTUNE_SAMPLE_ROWS, cube.shape[0])])
+            if self.reducer is not None:
+                sample = self.reducer.transform_cube(sample)
+            cpus = os.cpu_count() or 1
+            key = f'cpus={cpus},bands={sample.shape[2]},mode={config.mode}'
+
+            tuned = {}
+            if os.path.isfile(config.autotune_path):
+                with open(config.autotune_path) as f:
+                    tuned = json.load(f)
+
+            if key not in tuned:
+                worker_counts = sorted({w for w in (1, 2, 4, 8, 16, cpus) if w <= cpus})
+                results = []
+                with paused():
+                    for workers in worker_counts:
+                        for batch_size in AUTOTUNE_BATCH_SIZES:
+                            candidate = replace(config, executor='thread', workers=workers, batch_size=batch_size,
+                                                intra_op_threads=max(1, cpus // workers), autotune=False,
+                                                shard_rows=max(1, -(-sample.shape[0] // workers)))
+                            configure_torch_threads(candidate)
+                            start = time.perf_counter()
+                            InferenceEngine(self.model, candidate).run(sample)
+                            results.append((time.perf_counter() - start, workers, batch_size))
+                            logger.info(f'Autotune workers={workers} batch_size={batch_size}: {results[-1][0]:.3f}s')
+
+                _, workers, batch_size = min(results)
+                tuned[key] = {'workers': workers, 'batch_size': batch_size, 'intra_op_threads': max(1, cpus // workers)}
+                os.makedirs(os.path.dirname(config.autotune_path) or '.', exist_ok=True)
+                with open(config.autotune_path, 'w') as f:
+                    json.dump(tuned, f, indent=2)
+
+            self.config = replace(config, autotune=False, **tuned[key])
+            self._tuned = True
+            configure_torch_threads(self.config)
+            logger.info(f'Inference engine tuned: {asdict(self.config)}')
+            return self.config
@@ -0,0 +1,144 @@
+import io
+import json
+
+import numpy as np
+from PIL import Image
+
+from modules.result_cache import compact_labels
+from modules.metrics import timed
+
+# Wire formats for prediction maps, selected by the Accept header or a ?format= override:
+#   raw   - the label map as little-endian uint8/uint16 bytes in row-major order
+#   rle   - run-length encoded: uint32 run lengths followed by one label per run
+#   png   - indexed-palette PNG (16-bit greyscale when labels do not fit a palette)
+#   json  - the original {"prediction_map": [...]} payload, used when nothing else is accepted
+MAP_MEDIA_TYPES = {
+    'raw': 'application/octet-stream',
+    'rle': 'application/x-rle',
+    'png': 'image/png',
+    'json': 'application/json',
+}
+MAP_FORMATS = tuple(MAP_MEDIA_TYPES)
+PNG_COMPRESS_LEVEL = 1  # Label maps are long runs; higher zlib levels barely shrink them but cost far more time
+
+# Response headers describing a binary map; browsers only see them if CORS exposes them.
+MAP_HEADERS = ('X-Map-Shape', 'X-Map-Dtype', 'X-Map-Encoding', 'X-Map-Runs', 'X-Class-Summary')
+
+# Class colours for palette PNGs; index 0 (background) is black.
+CLASS_COLORS = [
+    (0, 0, 0), (230, 25, 75), (60, 180, 75), (255, 225, 25), (0, 130, 200), (245, 130, 48),
+    (145, 30, 180), (70, 240, 240), (240, 50, 230), (210, 245, 60), (250, 190, 212),
+    (0, 128, 128), (220, 190, 255), (170, 110, 40), (255, 250, 200), (128, 0, 0),
+    (170, 255, 195), (128, 128, 0), (255, 215, 180), (0, 0, 128), (128, 128, 128),
+]
+_PALETTE = [channel for color in CLASS_COLORS + [((37 * i) % 256, (91 * i) % 256, (151 * i) % 256)
+                                                 for i in range(len(CLASS_COLORS), 256)] for channel in color]
+
+def negotiate_map_format(accept_header=None, format_param=None):
+    """
+    Picks the wire format for a prediction map.
+
+    Args:
+        accept_header (str): The request's Accept header.
+        format_param (str): Explicit format from the query string; wins over Accept.
+
+    Returns:
+        str: One of MAP_FORMATS. Falls back to 'json' when nothing supported is acceptable.
+    """
+    if format_param:
+        if format_param not in MAP_FORMATS:
+            raise ValueError(f'Unknown map format \'{format_param}\'. Expected one of {MAP_FORMATS}.')
+        return format_param
+
+    formats_by_type = {media_type: fmt for fmt, media_type in MAP_MEDIA_TYPES.items()}
+    best, best_q = 'json', 0.0
+    for part in (accept_header or '').split(','):
+        media_type, *params = [token.strip() for token in part.split(';')]
+        fmt = formats_by_type.get(media_type.lower())
+        if fmt is None:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = fmt, q
+    return best
+
+def run_length_encode(labels):
+    """
+    Returns (run_lengths, values) of a flattened label map.
+    Runs are found with one vectorised comparison, not a Python loop.
+    """
+    flat = labels.ravel()
+    if flat.size == 0:
+        return np.zeros(0, dtype='<u4'), flat[:0]
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    run_lengths = np.diff(np.append(starts, flat.size)).astype('<u4')
+    return run_lengths, flat[starts]
+
+def _palette_png(labels):
+    if labels.dtype == np.uint8:
+        image = Image.fromarray(labels, mode='P')
+        image.putpalette(_PALETTE)
+    else:
+        image = Image.fromarray(labels.astype('<u2'))  # Pillow maps uint16 to I;16
+    buffer = io.BytesIO()
+    with timed('png_encode'):
+        image.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+def encode_map(prediction_map, fmt, class_summary=None):
+    """
+    Serializes a prediction map into a binary wire format.
+
+    Args:
+        prediction_map (np.ndarray): The (height, width) label map.
+        fmt (str): 'raw', 'rle' or 'png'.
+        class_summary (dict): Optional summary sent along in the X-Class-Summary header.
+
+    Returns:
+        tuple: (body, media_type, headers).
+    """
+    labels = compact_labels(np.asarray(prediction_map))
+    labels = np.ascontiguousarray(labels, dtype=labels.dtype.newbyteorder('<'))
+    headers = {
+        'X-Map-Shape': ','.join(str(n) for n in labels.shape),
+        'X-Map-Dtype': labels.dtype.name,
+        'X-Map-Encoding': fmt,
+    }
+    if class_summary is not None:
+        headers['X-Class-Summary'] = json.dumps(class_summary, separators=(',', ':'))
+
+    if fmt == 'raw':
+        body = labels.tobytes()
+    elif fmt == 'rle':
+        run_lengths, values = run_length_encode(labels)
+        headers['X-Map-Runs'] = str(len(run_lengths))
+        body = run_lengths.tobytes() + values.tobytes()
+    elif fmt == 'png':
+        body = _palette_png(labels)
+    else:
+        raise ValueError(f'Map format \'{fmt}\' is not a binary format.')
+    return body, MAP_MEDIA_TYPES[fmt], headers
+
+def decode_map(body, headers):
+    """Inverse of encode_map, for Python clients and round-trip checks."""
+    fmt = headers['X-Map-Encoding']
+    shape = tuple(int(n) for n in headers['X-Map-Shape'].split(','))
+    dtype = np.dtype(headers['X-Map-Dtype']).newbyteorder('<')
+
+    if fmt == 'raw':
+        return np.frombuffer(body, dtype=dtype).reshape(shape)
+    if fmt == 'rle':
+        runs = int(headers['X-Map-Runs'])
+        run_lengths = np.frombuffer(body, dtype='<u4', count=runs)
+        values = np.frombuffer(body, dtype=dtype, count=runs, offset=runs * 4)
+        return np.repeat(values, run_lengths).reshape(shape)
+    if fmt == 'png':
+        return np.asarray(Image.open(io.BytesIO(body))).astype(dtype).reshape(shape)
+    raise ValueError(f'Map format \'{fmt}\' is not a binary format.')
@@ -0,0 +1,309 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Hot-path stages timed into the stage histogram (see timed / timed_iter):
+#   mat_load           - scipy.io.loadmat of a scene's .mat files
+#   normalization      - min / max scan and [0, 1] scaling of a cube
+#   rgb_render         - band read and contrast stretch of an RGB composite
+#   png_encode         - PNG compression of previews, tiles, maps and rasters
+#   base64_encode      - base64 of inline previews and streamed map blocks
+#   patch_extraction   - cutting patch batches out of the padded cube
+#   model_forward      - model forwards as the caller sees them (queueing included when batches go
+#                        through the shared micro-batching server)
+#   batched_forward    - the micro-batching server's own forwards
+#   summary            - per-class counts of a prediction map
+#   json_serialization - response bodies rendered as JSON
+# Timings are recorded in the process doing the work: the shards of a process-pool
+# InferenceEngine run (INFERENCE_EXECUTOR=process) only show up as their requests' latency.
+STAGES = ('mat_load', 'normalization', 'rgb_render', 'png_encode', 'base64_encode', 'patch_extraction',
+          'model_forward', 'batched_forward', 'summary', 'json_serialization')
+STAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Seconds
+REQUEST_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # Seconds
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}, got {labelvalues}.')
+        return tuple(str(value) for value in labelvalues)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def header(self):
+        return [f'# HELP {self.name} {_escape(self.documentation)}', f'# TYPE {self.name} {self.kind}']
+
+class Counter(_Metric):
+    """Monotonic count, one series per combination of label values."""
+    kind = 'counter'
+
+    def inc(self, amount=1, *labelvalues):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labelvalues):
+        with self._lock:
+            return self._values.get(self._key(labelvalues), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, tuple(zip(self.labelnames, key)), value) for key, value in sorted(self._values.items())]
+
+class Gauge(Counter):
+    """Value that can go up and down."""
+    kind = 'gauge'
+
+    def set(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(_Metric):
+    """
+    Fixed-bucket histogram. observe() is a bisect and three additions under a lock;
+    percentiles are left to the Prometheus server (histogram_quantile).
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self, *labelvalues):
+        """(per-bucket counts, sum, count) of one series; the last bucket is +Inf."""
+        with self._lock:
+            series = self._values.get(self._key(labelvalues))
+            return (list(series[0]), series[1], series[2]) if series else ([0] * (len(self.buckets) + 1), 0.0, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(series[0]), series[1], series[2])) for key, series in self._values.items())
+        samples = []
+        for key, (counts, total, count) in values:
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append((f'{self.name}_bucket', labels + (('le', _format_value(float(bound))),), cumulative))
+            samples.append((f'{self.name}_sum', labels, total))
+            samples.append((f'{self.name}_count', labels, count))
+        return samples
+
+class MetricsRegistry:
+    """
+    Metrics of one process, rendered in the Prometheus text exposition format.
+
+    Besides the metrics it owns, a registry calls collectors at render time:
+    callables returning (name, kind, documentation, [(labels dict, value), ...])
+    tuples, for numbers other components already keep (cache hits, queue lengths).
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered.')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collect):
+        with self._lock:
+            self._collectors.append(collect)
+        return collect
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines += metric.header()
+            lines += [f'{name}{_format_labels(labels)} {_format_value(value)}' for name, labels, value in metric.samples()]
+        for collect in collectors:
+            for name, kind, documentation, samples in collect():
+                lines += [f'# HELP {name} {_escape(documentation)}', f'# TYPE {name} {kind}']
+                lines += [f'{name}{_format_labels(tuple(labels.items()))} {_format_value(value)}' for labels, value in samples]
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram('field_prime_stage_seconds', 'Time spent in each hot-path stage.', ('stage',))
+PIXELS_CLASSIFIED = REGISTRY.counter('field_prime_pixels_classified_total', 'Pixels run through the model by scene analyses.')
+REQUEST_SECONDS = REGISTRY.histogram('field_prime_http_request_seconds', 'HTTP request latency until the response starts.',
+                                     ('method', 'route', 'status'), buckets=REQUEST_BUCKETS)
+REQUESTS_IN_PROGRESS = REGISTRY.gauge('field_prime_http_requests_in_progress', 'HTTP requests being handled.')
+
+_enabled = True
+_paused = 0
+_paused_lock = threading.Lock()
+
+def set_enabled(enabled):
+    """Turns stage timing on or off process-wide (request metrics are up to the servers)."""
+    global _enabled
+    _enabled = bool(enabled)
+
+@contextmanager
+def paused():
+    """
+    Stops stage timing and pixel counting process-wide for its block, for start-up
+    work that is not service load (e.g. InferenceEngine.autotune's timed candidates).
+    """
+    global _paused
+    with _paused_lock:
+        _paused += 1
+    try:
+        yield
+    finally:
+        with _paused_lock:
+            _paused -= 1
+
+def count_pixels(pixels):
+    """Adds pixels run through the model by a scene analysis to PIXELS_CLASSIFIED."""
+    if not _paused:
+        PIXELS_CLASSIFIED.inc(pixels)
+
+class _StageTimer:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, self.stage)
+        return False
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+def timed(stage):
+    """Context manager adding the time spent in its block to a stage of STAGE_SECONDS."""
+    return _StageTimer(stage) if _enabled and not _paused else _NO_TIMER
+
+def timed_iter(stage, iterable):
+    """Yields from iterable, adding the time spent producing each item (not consuming it) to a stage."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        if _enabled and not _paused:
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage)
+        yield item
+
+def stage_totals():
+    """{stage: {'count', 'seconds'}} of every stage timed so far, for JSON stats endpoints."""
+    totals = {}
+    for stage in STAGES:
+        _, seconds, count = STAGE_SECONDS.snapshot(stage)
+        if count:
+            totals[stage] = {'count': count, 'seconds': seconds}
+    return totals
+
+def service_collector(result_cache=None, tile_cache=None, index_cache=None, scene_registry=None, inference_servers=None,
+                      change_tracker=None, job_manager=None):
+    """
+    A collector (see MetricsRegistry.register_collector) exposing the counters the
+    servers' caches, scene registry, micro-batching servers, incremental re-analysis
+    and job manager already keep. Missing components are skipped.
+    """
+    def collect():
+        caches = [(name, cache.stats()) for name, cache in
+                  (('result', result_cache), ('tile', tile_cache), ('index', index_cache)) if cache is not None]
+        if caches:
+            yield ('field_prime_cache_hits_total', 'counter', 'Cache lookups served from memory or disk.',
+                   [({'cache': name}, stats['hits']) for name, stats in caches])
+            yield ('field_prime_cache_misses_total', 'counter', 'Cache lookups that had to compute.',
+                   [({'cache': name}, stats['misses']) for name, stats in caches])
+            yield ('field_prime_cache_memory_bytes', 'gauge', 'Bytes held by the in-memory LRU of each cache.',
+                   [({'cache': name}, stats['memory_bytes']) for name, stats in caches])
+        if scene_registry is not None:
+            stats = scene_registry.stats()
+            yield ('field_prime_scene_resident_bytes', 'gauge', 'Bytes of scene cubes held in memory.',
+                   [({}, stats['resident_bytes'])])
+            yield ('field_prime_scene_loads_total', 'counter', 'Scenes loaded.', [({}, stats['loads'])])
+            yield ('field_prime_scene_evictions_total', 'counter', 'Scenes evicted over the memory budget.',
+                   [({}, stats['evictions'])])
+        if inference_servers is not None:
+            servers = [(path, server.stats()) for path, server in list(inference_servers.items())]
+            yield ('field_prime_inference_server_queue_length', 'gauge', 'Requests waiting in a micro-batching server.',
+                   [({'model': path}, stats['queue_length']) for path, stats in servers])
+            yield ('field_prime_inference_server_batches_total', 'counter', 'Batches run by a micro-batching server.',
+                   [({'model': path}, stats['batches']) for path, stats in servers])
+            yield ('field_prime_inference_server_patches_total', 'counter', 'Patches classified by a micro-batching server.',
+                   [({'model': path}, stats['patches']) for path, stats in servers])
+        if change_tracker is not None:
+            stats = change_tracker.stats()
+            yield ('field_prime_incremental_runs_total', 'counter', 'Analyses run incrementally from an earlier result.',
+                   [({}, stats['incremental_runs'])])
+            yield ('field_prime_incremental_reclassified_pixels_total', 'counter',
+                   'Pixels re-classified by change-tracked analyses.', [({}, stats['reclassified'])])
+            yield ('field_prime_incremental_normalization_reruns_total', 'counter',
+                   'Change-tracked analyses re-run in full because the min / max normalization changed.',
+                   [({}, stats['normalization_reruns'])])
+        if job_manager is not None:
+            yield ('field_prime_analysis_jobs_active', 'gauge', 'Queued and running analysis jobs.',
+                   [({}, job_manager.stats()['active_jobs'])])
+    return collect
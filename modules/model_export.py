@@ -0,0 +1,217 @@
+import os
+import io
+import copy
+import time
+import argparse
+import warnings
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from modules.model_handler import CropClassifier, PATCH_SIZE, num_bands_from_state_dict
+from modules.patch_extractor import pad_cube, iter_patch_batches
+from modules.spectral_reduction import load_reducer
+
+# Inference artifacts derived from the fp32 weights in models/crop_classifier.pth:
+#   fp32              - the eager model as trained
+#   int8              - eager model with dynamically quantized nn.LSTM / nn.Linear layers
+#   torchscript       - traced and frozen fp32 model
+#   torchscript_int8  - traced and frozen int8 model
+#   onednn            - traced, frozen and optimized for oneDNN with channels-last Conv3d inputs
+# Only the eager variants keep forward_dense; the TorchScript ones run the patch path.
+MODEL_VARIANTS = ('fp32', 'int8', 'torchscript', 'torchscript_int8', 'onednn')
+
+def artifact_path(model_path, variant):
+    """Where a variant is stored, next to the fp32 weights (e.g. models/crop_classifier.int8.pth)."""
+    if variant == 'fp32':
+        return model_path
+    root, _ = os.path.splitext(model_path)
+    extension = '.pth' if variant == 'int8' else '.pt'
+    return f'{root}.{variant}{extension}'
+
+def load_fp32_model(model_path, num_classes):
+    # The spectral depth follows the weights, so models trained on a reduced cube load too
+    state_dict = torch.load(model_path, map_location=torch.device('cpu'))
+    model = CropClassifier(num_classes=num_classes, num_bands=num_bands_from_state_dict(state_dict))
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+def quantize_model(model):
+    """Returns an int8 copy of the model with dynamically quantized LSTM and Linear layers."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+def build_variant(model, variant, num_bands=None):
+    """
+    Derives an inference variant from an fp32 CropClassifier.
+
+    Args:
+        model (CropClassifier): The trained fp32 model (left unchanged).
+        variant (str): One of MODEL_VARIANTS.
+        num_bands (int): Spectral depth of the example input used for tracing;
+            defaults to the depth the model was built for.
+
+    Returns:
+        torch.nn.Module: The eager or TorchScript model.
+    """
+    if variant not in MODEL_VARIANTS:
+        raise ValueError(f'Unknown model variant \'{variant}\'. Expected one of {MODEL_VARIANTS}.')
+    if variant == 'fp32':
+        return model
+    if variant == 'int8':
+        return quantize_model(model)
+
+    source = quantize_model(model) if variant == 'torchscript_int8' else copy.deepcopy(model).eval()
+    example_input = torch.zeros(2, 1, PATCH_SIZE, PATCH_SIZE, num_bands or model.num_bands)
+    if variant == 'onednn':
+        source = source.to(memory_format=torch.channels_last_3d)
+        example_input = example_input.contiguous(memory_format=torch.channels_last_3d)
+
+    with warnings.catch_warnings(), torch.no_grad():
+        warnings.simplefilter('ignore')  # Tracer warnings about the shape arithmetic in forward()
+        scripted = torch.jit.freeze(torch.jit.trace(source, example_input))
+        if variant == 'onednn':
+            scripted = torch.jit.optimize_for_inference(scripted)
+    return scripted
+
+def save_variant(module, variant, path):
+    if variant in ('fp32', 'int8'):
+        torch.save(module.state_dict(), path)
+    else:
+        torch.jit.save(module, path)
+
+def load_variant(model_path, num_classes, variant):
+    """Loads a saved variant artifact (see artifact_path)."""
+    path = artifact_path(model_path, variant)
+    if variant == 'fp32':
+        return load_fp32_model(path, num_classes)
+    if variant == 'int8':
+        num_bands = num_bands_from_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
+        module = quantize_model(CropClassifier(num_classes=num_classes, num_bands=num_bands))
+        # Quantized packed params are not plain tensors, so weights_only loading does not apply;
+        # the artifact is produced locally by build_variant from our own weights.
+        module.load_state_dict(torch.load(path, map_location=torch.device('cpu'), weights_only=False))
+        return module.eval()
+    return torch.jit.load(path, map_location=torch.device('cpu'))
+
+def load_inference_model(model_path, num_classes, variant='fp32', build_missing=True):
+    """
+    Loads the configured inference variant, (re)building its artifact from the
+    fp32 weights when it is missing or older than them.
+    """
+    if variant not in MODEL_VARIANTS:
+        raise ValueError(f'Unknown model variant \'{variant}\'. Expected one of {MODEL_VARIANTS}.')
+
+    path = artifact_path(model_path, variant)
+    stale = not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(model_path)
+    if variant != 'fp32' and stale:
+        if not build_missing:
+            raise FileNotFoundError(f'Model artifact not found at {path}. Run python -m modules.model_export --build {variant}.')
+        module = build_variant(load_fp32_model(model_path, num_classes), variant)
+        save_variant(module, variant, path)
+        return module
+
+    return load_variant(model_path, num_classes, variant)
+
+def serialize_model(model):
+    """
+    Turns a model into bytes for process workers. Pickling modules directly would
+    share their tensors through file descriptors, which quantized packed params do not survive.
+    """
+    buffer = io.BytesIO()
+    if isinstance(model, torch.jit.ScriptModule):
+        torch.jit.save(model, buffer)
+        return ('torchscript', buffer.getvalue())
+    torch.save(model, buffer)
+    return ('module', buffer.getvalue())
+
+def deserialize_model(payload):
+    kind, value = payload
+    if kind == 'torchscript':
+        return torch.jit.load(io.BytesIO(value), map_location=torch.device('cpu'))
+    return torch.load(io.BytesIO(value), map_location=torch.device('cpu'), weights_only=False)
+
+def _classify_pixels(model, hypercube, coords, batch_size, channels_last=False):
+    padded_cube = pad_cube(hypercube, PATCH_SIZE)
+    predictions = np.empty(len(coords), dtype=np.int64)
+    with torch.no_grad():
+        for start, stop, batch_patches in iter_patch_batches(padded_cube, PATCH_SIZE, batch_size, coords=coords):
+            input_tensor = torch.from_numpy(batch_patches)
+            if channels_last:
+                input_tensor = input_tensor.contiguous(memory_format=torch.channels_last_3d)
+            predictions[start:stop] = torch.argmax(model(input_tensor), dim=1).numpy() + 1
+    return predictions
+
+def evaluate_variants(model_path, num_classes, hypercube, ground_truth, variants=MODEL_VARIANTS,
+                      max_pixels=2000, batch_size=256, seed=0):
+    """
+    Compares inference variants against the fp32 model on labeled ground-truth pixels.
+    The model's spectral reducer, if one was saved with it, is applied to the cube first.
+
+    Returns:
+        list: One dict per variant with accuracy against the ground truth, agreement
+        with fp32 predictions, throughput (pixels/s) and speedup over fp32.
+    """
+    coords = np.argwhere(ground_truth > 0)
+    if max_pixels and len(coords) > max_pixels:
+        rng = np.random.default_rng(seed)
+        coords = coords[np.sort(rng.choice(len(coords), max_pixels, replace=False))]
+    labels = ground_truth[coords[:, 0], coords[:, 1]]
+    reducer = load_reducer(model_path)
+    if reducer is not None:
+        hypercube = reducer.transform_cube(hypercube)
+
+    fp32_model = load_fp32_model(model_path, num_classes)
+    results = []
+    reference = None
+    for variant in ('fp32',) + tuple(v for v in variants if v != 'fp32'):
+        model = fp32_model if variant == 'fp32' else build_variant(fp32_model, variant, num_bands=hypercube.shape[2])
+        channels_last = variant == 'onednn'
+        _classify_pixels(model, hypercube, coords[:batch_size], batch_size, channels_last)  # Warm-up
+
+        start = time.perf_counter()
+        predictions = _classify_pixels(model, hypercube, coords, batch_size, channels_last)
+        elapsed = time.perf_counter() - start
+
+        if reference is None:
+            reference = (predictions, elapsed)
+        results.append({
+            'variant': variant,
+            'accuracy': float(np.mean(predictions == labels)),
+            'agreement_with_fp32': float(np.mean(predictions == reference[0])),
+            'pixels_per_second': len(coords) / elapsed,
+            'speedup': reference[1] / elapsed,
+        })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and check optimized CPU inference artifacts for CropClassifier.')
+    parser.add_argument('--model-path', default=os.path.join('models', 'crop_classifier.pth'))
+    parser.add_argument('--data-folder', default='data')
+    parser.add_argument('--num-classes', type=int, default=16)
+    parser.add_argument('--build', nargs='*', choices=MODEL_VARIANTS, default=[],
+                        help='Variants to (re)build next to the fp32 weights.')
+    parser.add_argument('--check', action='store_true', help='Compare variants against fp32 on the ground truth.')
+    parser.add_argument('--max-pixels', type=int, default=2000)
+    args = parser.parse_args()
+
+    fp32_model = load_fp32_model(args.model_path, args.num_classes)
+    for variant in args.build:
+        path = artifact_path(args.model_path, variant)
+        save_variant(build_variant(fp32_model, variant), variant, path)
+        print(f'Saved {variant} artifact to {path}')
+
+    if args.check:
+        from modules.data_handler import load_hyperspectral_data
+        hypercube, ground_truth = load_hyperspectral_data(args.data_folder)
+        print(f"{'variant':<18}{'accuracy':>10}{'agreement':>11}{'pixels/s':>11}{'speedup':>9}")
+        for row in evaluate_variants(args.model_path, args.num_classes, hypercube, ground_truth,
+                                     max_pixels=args.max_pixels):
+            print(f"{row['variant']:<18}{row['accuracy']:>10.4f}{row['agreement_with_fp32']:>11.4f}"
+                  f"{row['pixels_per_second']:>11.1f}{row['speedup']:>8.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -4,11 +4,26 @@ import torch.nn as nn
 import torch.nn.functional as F
 from sklearn.model_selection import train_test_split
 
+from modules.patch_extractor import pad_cube, patch_windows, fill_patches, gather_patches, iter_patch_batches
+from modules.tiled_scene import TiledScene
+from modules.probability_maps import probability_outputs, empty_probability_maps, store_outputs
+from modules.metrics import timed, timed_iter
+
 PATCH_SIZE = 11
+INFERENCE_MODES = ('dense', 'patch')
+ADAPTIVE_MODE = 'adaptive'  # Coarse-to-fine over the whole scene (modules/adaptive_inference.py), not a predict_rows mode
+DEFAULT_NUM_BANDS = 200  # Indian Pines (corrected); fewer after a spectral reduction (modules/spectral_reduction.py)
+DENSE_TILE_MIN_COVERAGE = 0.2  # Masked tiles at least this full run densely; dense costs about a fifth of the patch path per pixel
+
+def _spectral_max_pool(x):
+    # Max over pairs of the last (spectral) axis, i.e. the spectral half of MaxPool3d(2)
+    depth = x.shape[-1] // 2 * 2
+    return torch.maximum(x[..., 0:depth:2], x[..., 1:depth:2])
 
 class CropClassifier(nn.Module):
-    def __init__(self, num_classes):
+    def __init__(self, num_classes, num_bands=DEFAULT_NUM_BANDS):
         super(CropClassifier, self).__init__()
+        self.num_bands = num_bands  # Spectral depth of the input patches
         
         # CNN Block 1
         self.conv1 = nn.Conv3d(in_channels=1, out_channels=8, kernel_size=(3, 3, 7), padding='same')
@@ -45,9 +60,8 @@ class CropClassifier(nn.Module):
         
     def _get_lstm_input_size(self):
         # This method will be called during __init__ to set up the LSTM layer
-        # It requires a dummy input to calculate the shape
-        # We'll assume a typical input shape for Indian Pines (1, 11, 11, 200)
-        dummy_input = torch.randn(1, 1, PATCH_SIZE, PATCH_SIZE, 200) # (batch, channel, depth, height, width)
+        # It requires a dummy input to calculate the shape, e.g. (1, 11, 11, 200) for Indian Pines
+        dummy_input = torch.randn(1, 1, PATCH_SIZE, PATCH_SIZE, self.num_bands) # (batch, channel, depth, height, width)
         
         x = self.pool1(F.relu(self.conv1(dummy_input)))
         x = self.pool2(F.relu(self.conv2(x)))
@@ -68,6 +82,10 @@ class CropClassifier(nn.Module):
         x = self.pool1(F.relu(self.conv1(x)))
         x = self.pool2(F.relu(self.conv2(x)))
         
+        return self.classify_features(x)
+
+    def classify_features(self, x):
+        """Runs the LSTM/FC head on pooled (batch, channels, depth, height, width) features."""
         # Reshape for LSTM
         # x.shape: (batch_size, channels, depth, height, width)
         # Permute to (batch_size, depth, channels, height, width)
@@ -88,71 +106,358 @@ class CropClassifier(nn.Module):
         
         return x
 
-def prepare_training_data(hypercube, ground_truth):
+    def dense_features(self, padded_tile):
+        """
+        Computes the pooled CNN features of every patch in a tile in one pass.
+
+        Equivalent to running conv1/pool1/conv2/pool2 on each PATCH_SIZE x PATCH_SIZE
+        patch, but every convolution is evaluated once over the tile. The patch path
+        zero-pads each patch on its own, which only changes the first row/column of
+        each conv output that pooling keeps; those positions are reproduced with
+        copies of the kernels whose leading taps are zeroed.
+
+        Args:
+            padded_tile (torch.Tensor): A (rows + PATCH_SIZE - 1, cols + PATCH_SIZE - 1, bands)
+                slice of the zero-padded scene.
+
+        Returns:
+            torch.Tensor: (rows, cols, channels, depth, height, width) features, as pool2
+            would produce them for each pixel's patch.
+        """
+        grid = PATCH_SIZE // 2   # pool1 cells per axis
+        windows = grid // 2      # pool2 cells per axis
+        if PATCH_SIZE % 2 == 0 or grid % 2 == 0:
+            raise ValueError(f'Dense inference needs an odd PATCH_SIZE with an odd PATCH_SIZE // 2, got {PATCH_SIZE}.')
+
+        rows = padded_tile.shape[0] - PATCH_SIZE + 1
+        cols = padded_tile.shape[1] - PATCH_SIZE + 1
+        x = padded_tile.to(self.conv1.weight.dtype).contiguous()[None, None]
+
+        # conv1 in four variants: full, first row truncated, first column truncated, both
+        w1, b1 = self.conv1.weight, self.conv1.bias
+        w_row, w_col = w1.clone(), w1.clone()
+        w_row[:, :, 0] = 0
+        w_col[:, :, :, 0] = 0
+        w_both = w_row.clone()
+        w_both[:, :, :, 0] = 0
+        c1 = F.conv3d(x, torch.cat([w1, w_row, w_col, w_both]), b1.repeat(4),
+                      padding=tuple(k // 2 for k in w1.shape[2:]))
+        c1 = _spectral_max_pool(F.relu(c1[0]))  # Spectral half of pool1
+        full, row, col, both = c1.split(w1.shape[0])
+
+        # Spatial half of pool1 at every offset, picking the variant each 2x2 cell sees
+        def pool(top_left, top_right, bottom_left, bottom_right):
+            return torch.maximum(torch.maximum(top_left[:, :-1, :-1], top_right[:, :-1, 1:]),
+                                 torch.maximum(bottom_left[:, 1:, :-1], bottom_right[:, 1:, 1:]))
+
+        pooled = {
+            ('full', 'full'): pool(full, full, full, full),
+            ('var', 'full'): pool(row, row, full, full),
+            ('full', 'var'): pool(col, full, col, full),
+            ('var', 'var'): pool(both, row, col, full),
+        }
+
+        # conv2 runs on the pool1 grid, i.e. dilated by 2 on the dense lattice. Its
+        # outputs fall into three kinds per axis depending on the grid position a:
+        # a == 0 (tap -1 is padding, tap 0 a truncated cell), a == 1 (tap -1 is a
+        # truncated cell) and a >= 2 (all taps regular).
+        def tap_source(kind, k):
+            if kind == 0:
+                return (None, 'var', 'full')[k + 1]
+            if kind == 1:
+                return 'var' if k == -1 else 'full'
+            return 'full'
+
+        w2, b2 = self.conv2.weight, self.conv2.bias
+        spectral_padding = (0, 0, w2.shape[4] // 2)
+        channels, height, width, spectral = w2.shape[0], *pooled[('full', 'full')].shape[1:]
+        kinds = {(ta, tb): w2.new_zeros((channels, height, width, spectral)) for ta in range(3) for tb in range(3)}
+        for source, features in pooled.items():
+            # Every tap this source feeds, evaluated by one spectral-only convolution
+            taps = [(ka, kb) for ka in (-1, 0, 1) for kb in (-1, 0, 1)
+                    if any((tap_source(ta, ka), tap_source(tb, kb)) == source for ta, tb in kinds)]
+            tap_weights = torch.cat([w2[:, :, ka + 1, kb + 1, None, None, :] for ka, kb in taps])
+            responses = F.conv3d(features[None], tap_weights, padding=spectral_padding)[0].split(channels)
+
+            for (ka, kb), response in zip(taps, responses):
+                dy, dx = 2 * ka, 2 * kb
+                ys, xs = slice(max(0, -dy), min(height, height - dy)), slice(max(0, -dx), min(width, width - dx))
+                shifted = response[:, ys.start + dy:ys.stop + dy, xs.start + dx:xs.stop + dx]
+                for ta, tb in kinds:
+                    if (tap_source(ta, ka), tap_source(tb, kb)) == source:
+                        kinds[(ta, tb)][:, ys, xs] += shifted
+
+        # relu + spectral half of pool2, then the spatial half at each pixel's lattice points
+        for kind in kinds:
+            kinds[kind] = _spectral_max_pool(F.relu(kinds[kind] + b2[:, None, None, None]))
+
+        def lattice(a, b):
+            z = kinds[(min(a, 2), min(b, 2))]
+            return z[:, 2 * a:2 * a + rows, 2 * b:2 * b + cols]
+
+        cells = []
+        for i in range(windows):
+            for j in range(windows):
+                cell = lattice(2 * i, 2 * j)
+                for a, b in ((2 * i, 2 * j + 1), (2 * i + 1, 2 * j), (2 * i + 1, 2 * j + 1)):
+                    cell = torch.maximum(cell, lattice(a, b))
+                cells.append(cell)
+
+        # (windows * windows, channels, rows, cols, spectral) -> (rows, cols, channels, depth, height, width)
+        features = torch.stack(cells).permute(2, 3, 1, 0, 4)
+        return features.reshape(rows, cols, features.shape[2], windows, windows, features.shape[4])
+
+    def forward_dense(self, padded_tile, batch_size=1024):
+        """
+        Classifies every pixel of a padded tile with a single pass of the CNN stack.
+
+        Returns:
+            torch.Tensor: (rows, cols, num_classes) logits matching forward() on each patch.
+        """
+        features = self.dense_features(padded_tile)
+        rows, cols = features.shape[:2]
+        features = features.reshape((rows * cols,) + features.shape[2:])
+
+        logits = [self.classify_features(features[i:i + batch_size].contiguous())
+                  for i in range(0, rows * cols, batch_size)]
+        return torch.cat(logits).reshape(rows, cols, -1)
+
+def num_bands_from_state_dict(state_dict):
+    """
+    Spectral depth a saved CropClassifier was built for, read from its LSTM input size
+    (rounded down to a multiple of 4, which builds an identical model).
+    """
+    lstm_input_size = state_dict['lstm.weight_ih_l0'].shape[1]
+    features_per_band = state_dict['conv2.weight'].shape[0] * (PATCH_SIZE // 2 // 2)
+    return lstm_input_size // features_per_band * 4
+
+def prepare_training_data(hypercube, ground_truth, reducer=None):
     """
     Extracts 3D patches from the hypercube to be used for training.
     Returns PyTorch tensors.
+
+    A fitted SpectralReducer (modules.spectral_reduction) is applied to the cube first,
+    so the patches have its reduced spectral depth.
     """
-    pad_width = PATCH_SIZE // 2
-    padded_cube = np.pad(hypercube, ((pad_width, pad_width), (pad_width, pad_width), (0, 0)), mode='constant')
+    if reducer is not None:
+        hypercube = reducer.transform_cube(hypercube)
+    padded_cube = pad_cube(hypercube, PATCH_SIZE)
+    windows = patch_windows(padded_cube, PATCH_SIZE)
 
-    patches = []
-    labels = []
     coords = np.argwhere(ground_truth > 0)
-    for r, c in coords:
-        label = ground_truth[r, c]
-        patch = padded_cube[r:r+PATCH_SIZE, c:c+PATCH_SIZE, :]
-        patches.append(patch)
-        labels.append(label)
-
-    X = np.array(patches, dtype=np.float32)
-    y = np.array(labels, dtype=np.int64) - 1 # PyTorch expects 0-indexed labels
-    
-    # Add a channel dimension for PyTorch Conv3D (batch, channel, depth, height, width)
-    X = np.expand_dims(X, axis=1) 
+    y = ground_truth[coords[:, 0], coords[:, 1]].astype(np.int64) - 1 # PyTorch expects 0-indexed labels
+
+    # Patches go straight into one preallocated (batch, channel, depth, height, width) array
+    X = np.empty((len(coords), 1) + windows.shape[2:], dtype=np.float32)
+    fill_patches(windows, coords[:, 0], coords[:, 1], X)
     
     return torch.from_numpy(X), torch.from_numpy(y)
 
-def run_prediction(model, hypercube):
+def predict_rows(model, padded_cube, r0, r1, batch_size=128, mode='dense', tile_size=32, top_k=0):
     """
-    Performs a pixel-by-pixel classification on the entire hypercube.
-    Uses batch processing for improved performance.
+    Classifies rows [r0, r1) of a scene padded with pad_cube.
+
+    In 'dense' mode the CNN stack runs once per tile_size x tile_size tile of the
+    padded scene (see CropClassifier.forward_dense); 'patch' mode runs the model
+    on every pixel's patch in raster-order batches. Both give the same predictions.
+    Models without forward_dense (e.g. exported ones) always use the patch path.
+
+    With top_k > 0 the softmax of the same forward passes also yields per-pixel
+    confidence, margin and top-k classes (modules.probability_maps).
+
+    Returns:
+        np.ndarray: (r1 - r0, width) int64 labels, 1-indexed like the ground truth;
+        with top_k, (labels, probability outputs of the rows).
     """
-    height, width, _ = hypercube.shape
-    pad_width = PATCH_SIZE // 2
-    padded_cube = np.pad(hypercube, ((pad_width, pad_width), (pad_width, pad_width), (0, 0)), mode='constant')
+    if mode not in INFERENCE_MODES:
+        raise ValueError(f'Unknown inference mode \'{mode}\'. Expected one of {INFERENCE_MODES}.')
 
-    prediction_map = np.zeros((height, width), dtype=np.int64)
-    batch_size = 128  # Process 128 pixels at a time
+    width = padded_cube.shape[1] - PATCH_SIZE + 1
+    slab = padded_cube[r0:r1 + PATCH_SIZE - 1]
+
+    labels = np.zeros((r1 - r0, width), dtype=np.int64)
+    labels_flat = labels.reshape(-1)
+    outputs = empty_probability_maps(r1 - r0, width, top_k) if top_k else None
 
     model.eval()  # Set model to evaluation mode
     with torch.no_grad():  # Disable gradient calculation for inference
-        # Process the image in batches for better performance
-        for r in range(0, height, 1):  # Still process one row at a time
-            all_patches = []
-            for c in range(width):
-                patch = padded_cube[r:r+PATCH_SIZE, c:c+PATCH_SIZE, :]
-                all_patches.append(patch)
-            
-            # Convert all patches to numpy array
-            all_patches = np.array(all_patches, dtype=np.float32)
-            all_patches = np.expand_dims(all_patches, axis=1)  # Add channel dimension
-            
-            # Process in batches
-            for i in range(0, width, batch_size):
-                batch_patches = all_patches[i:min(i+batch_size, width)]
-                
-                # Convert to PyTorch tensor
+        if mode == 'dense' and hasattr(model, 'forward_dense'):
+            for c0 in range(0, width, tile_size):
+                c1 = min(c0 + tile_size, width)
+                for t0 in range(0, r1 - r0, tile_size):
+                    t1 = min(t0 + tile_size, r1 - r0)
+                    tile = torch.from_numpy(slab[t0:t1 + PATCH_SIZE - 1, c0:c1 + PATCH_SIZE - 1])
+
+                    with timed('model_forward'):
+                        logits = model.forward_dense(tile, batch_size=batch_size)
+                    if top_k:
+                        labels[t0:t1, c0:c1], tile_outputs = probability_outputs(logits, top_k)
+                        store_outputs(outputs, (slice(t0, t1), slice(c0, c1)), tile_outputs)
+                        continue
+                    predicted_labels = torch.argmax(logits, dim=-1).cpu().numpy()
+                    labels[t0:t1, c0:c1] = predicted_labels + 1  # Add 1 to match original label values
+        else:
+            flat_outputs = {layer: values.reshape((-1,) + values.shape[2:]) for layer, values in (outputs or {}).items()}
+            for start, stop, batch_patches in timed_iter('patch_extraction', iter_patch_batches(slab, PATCH_SIZE, batch_size)):
                 input_tensor = torch.from_numpy(batch_patches)
-                
-                outputs = model(input_tensor)
-                predicted_labels = torch.argmax(outputs, dim=1).cpu().numpy()
-                prediction_map[r, i:min(i+batch_size, width)] = predicted_labels + 1  # Add 1 to match original label values
+
+                with timed('model_forward'):
+                    logits = model(input_tensor)
+                if top_k:
+                    labels_flat[start:stop], batch_outputs = probability_outputs(logits, top_k)
+                    store_outputs(flat_outputs, slice(start, stop), batch_outputs)
+                    continue
+                predicted_labels = torch.argmax(logits, dim=1).cpu().numpy()
+                labels_flat[start:stop] = predicted_labels + 1  # Add 1 to match original label values
+
+    return (labels, outputs) if top_k else labels
+
+def plan_masked_prediction(mask, tile_size=32, dense=True):
+    """
+    Splits a region of interest into the tile_size x tile_size tiles worth running
+    densely (at least DENSE_TILE_MIN_COVERAGE selected) and the remaining selected
+    pixels, which are classified through the patch path.
+
+    Args:
+        mask (np.ndarray): (height, width) boolean mask of the pixels to classify.
+        tile_size (int): Side of the dense tiles.
+        dense (bool): False sends every selected pixel to the patch path.
+
+    Returns:
+        tuple: (list of (r0, r1, c0, c1) dense tiles, (n, 2) row-major (row, col) coordinates of the other pixels).
+    """
+    mask = np.asarray(mask, dtype=bool)
+    height, width = mask.shape
+    if not dense:
+        return [], np.argwhere(mask)
+
+    # Selected pixels and area of every tile, by summing a zero-padded mask per tile
+    tiles_down, tiles_across = -(-height // tile_size), -(-width // tile_size)
+    padded = np.zeros((tiles_down * tile_size, tiles_across * tile_size), dtype=np.int32)
+    padded[:height, :width] = mask
+    selected = padded.reshape(tiles_down, tile_size, tiles_across, tile_size).sum(axis=(1, 3))
+    tile_rows = np.minimum(tile_size, height - np.arange(tiles_down) * tile_size)
+    tile_cols = np.minimum(tile_size, width - np.arange(tiles_across) * tile_size)
+    coverage = selected / (tile_rows[:, None] * tile_cols[None, :])
+
+    sparse = mask.copy()
+    tiles = []
+    for i, j in np.argwhere((coverage >= DENSE_TILE_MIN_COVERAGE) & (selected > 0)):
+        r0, c0 = int(i) * tile_size, int(j) * tile_size
+        r1, c1 = min(r0 + tile_size, height), min(c0 + tile_size, width)
+        tiles.append((r0, r1, c0, c1))
+        sparse[r0:r1, c0:c1] = False
+    return tiles, np.argwhere(sparse)
+
+def predict_tile(model, scene, r0, r1, c0, c1, batch_size=128, tile_size=32, top_k=0):
+    """Classifies every pixel of rows [r0, r1) x columns [c0, c1) of a TiledScene densely."""
+    window = scene.read_window(r0, r1, c0, c1, halo=PATCH_SIZE // 2)
+    return predict_rows(model, window, 0, r1 - r0, batch_size=batch_size, mode='dense', tile_size=tile_size, top_k=top_k)
+
+def predict_pixels(model, cube, coords, batch_size=128, return_confidence=False, top_k=0):
+    """
+    Classifies the pixels at coords (an (n, 2) array of (row, col)) of an unpadded
+    cube, packed into full batches wherever in the scene they lie.
+
+    Returns:
+        np.ndarray: (n,) int64 labels, 1-indexed like the ground truth; with
+        return_confidence, also the (n,) float32 softmax probability of each label;
+        with top_k, (labels, (n, ...) probability outputs) instead.
+    """
+    labels = np.empty(len(coords), dtype=np.int64)
+    confidence = np.empty(len(coords), dtype=np.float32)
+    outputs = {layer: values[0] for layer, values in empty_probability_maps(1, len(coords), top_k).items()} if top_k else None
+    if len(coords) == 0:
+        if top_k:
+            return labels, outputs
+        return (labels, confidence) if return_confidence else labels
+    buffer = np.empty((min(batch_size, len(coords)), 1, PATCH_SIZE, PATCH_SIZE, cube.shape[2]), dtype=np.float32)
+
+    model.eval()
+    with torch.no_grad():
+        for start in range(0, len(coords), batch_size):
+            stop = min(start + batch_size, len(coords))
+            with timed('patch_extraction'):
+                batch_patches = gather_patches(cube, coords[start:stop, 0], coords[start:stop, 1], PATCH_SIZE, buffer)
+            with timed('model_forward'):
+                logits = model(torch.from_numpy(batch_patches))
+            if top_k:
+                labels[start:stop], batch_outputs = probability_outputs(logits, top_k)
+                store_outputs(outputs, slice(start, stop), batch_outputs)
+                continue
+            probabilities, predicted_labels = torch.max(F.softmax(logits, dim=1), dim=1)
+            labels[start:stop] = predicted_labels.cpu().numpy() + 1
+            confidence[start:stop] = probabilities.cpu().numpy()
+    if top_k:
+        return labels, outputs
+    return (labels, confidence) if return_confidence else labels
+
+def predict_masked(model, hypercube, mask, batch_size=128, mode='dense', tile_size=32, top_k=0):
+    """
+    Classifies only the pixels selected by a boolean mask; the rest of the map is 0.
+
+    Well-covered tiles run through the dense path; the pixels of sparsely covered
+    ones are packed into full patch batches (see plan_masked_prediction), so the
+    work follows the mask's coverage rather than the scene size. With top_k, also
+    returns the probability maps (0 outside the mask).
+    """
+    if mode not in INFERENCE_MODES:
+        raise ValueError(f'Unknown inference mode \'{mode}\'. Expected one of {INFERENCE_MODES}.')
+    scene = hypercube if isinstance(hypercube, TiledScene) else TiledScene(hypercube)
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape != (scene.height, scene.width):
+        raise ValueError(f'Mask shape {mask.shape} does not match the {scene.height}x{scene.width} scene.')
+
+    tiles, coords = plan_masked_prediction(mask, tile_size, dense=mode == 'dense' and hasattr(model, 'forward_dense'))
+    prediction_map = np.zeros(mask.shape, dtype=np.int64)
+    probability_maps = empty_probability_maps(scene.height, scene.width, top_k) if top_k else None
+    for r0, r1, c0, c1 in tiles:
+        labels = predict_tile(model, scene, r0, r1, c0, c1, batch_size, tile_size, top_k)
+        if top_k:
+            labels, outputs = labels
+            store_outputs(probability_maps, (slice(r0, r1), slice(c0, c1)), outputs, keep=mask[r0:r1, c0:c1])
+        prediction_map[r0:r1, c0:c1] = np.where(mask[r0:r1, c0:c1], labels, 0)
+    labels = predict_pixels(model, scene.cube, coords, batch_size, top_k=top_k)
+    if top_k:
+        labels, outputs = labels
+        store_outputs(probability_maps, (coords[:, 0], coords[:, 1]), outputs)
+    prediction_map[coords[:, 0], coords[:, 1]] = labels
+    return (prediction_map, probability_maps) if top_k else prediction_map
+
+def summarize_prediction(prediction_map):
+    """Per-class pixel counts of a prediction map, skipping the background class 0."""
+    with timed('summary'):
+        counts = np.bincount(prediction_map.ravel())
+        return [{'crop_type_id': cls, 'pixel_count': int(count)} for cls, count in enumerate(counts) if cls != 0 and count]
+
+def run_prediction(model, hypercube, batch_size=128, mode='dense', tile_size=32, reducer=None, mask=None, top_k=0):
+    """
+    Performs a pixel-by-pixel classification on the entire hypercube.
+    Uses batch processing for improved performance; see predict_rows for the
+    'dense' and 'patch' modes. For multi-core runs use modules.inference_engine.
+    Pass the model's SpectralReducer, if it was trained on a reduced cube.
+    With a (height, width) boolean mask (e.g. from modules.roi, or ground_truth > 0)
+    only the selected pixels are classified; see predict_masked.
+    With top_k > 0 a third value is returned: the per-pixel confidence, margin and
+    top-k class probability maps of modules.probability_maps, from the same forwards.
+    """
+    if reducer is not None:
+        hypercube = reducer.transform_cube(hypercube)
+    if mask is not None:
+        prediction_map = predict_masked(model, hypercube, mask, batch_size=batch_size, mode=mode, tile_size=tile_size,
+                                        top_k=top_k)
+    else:
+        padded_cube = pad_cube(hypercube, PATCH_SIZE)
+        prediction_map = predict_rows(model, padded_cube, 0, hypercube.shape[0],
+                                      batch_size=batch_size, mode=mode, tile_size=tile_size, top_k=top_k)
+    if top_k:
+        prediction_map, probability_maps = prediction_map
 
     # Create a summary of the classification
-    unique_classes, counts = np.unique(prediction_map, return_counts=True)
-    class_summary = [{'crop_type_id': int(cls), 'pixel_count': int(count)} for cls, count in zip(unique_classes, counts) if cls != 0]
+    class_summary = summarize_prediction(prediction_map)
 
+    if top_k:
+        return prediction_map, class_summary, probability_maps
     return prediction_map, class_summary
 
 if __name__ == '__main__':
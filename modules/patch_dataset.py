@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
+
+from modules.model_handler import PATCH_SIZE
+from modules.patch_extractor import pad_cube, padded_shape, patch_windows, fill_patches
+
+class PatchDataset(Dataset):
+    """
+    Labeled pixels of a scene whose patches are cut on demand.
+
+    Only the padded cube and the (row, col) coordinates of the labeled pixels are
+    held; memory no longer grows with label count x patch size as it does with
+    prepare_training_data. The padded cube is either a .npy file that every
+    DataLoader worker memory-maps, or an in-memory tensor moved to shared memory
+    so workers read it without a copy.
+
+    Indexing with an int returns one (patch, label) pair; indexing with a list of
+    indices returns a whole (batch, label) pair cut in one pass (see patch_loader).
+    """
+
+    def __init__(self, padded_cube, coords, labels, patch_size=PATCH_SIZE):
+        """
+        Args:
+            padded_cube (np.ndarray or str): A cube padded with pad_cube, or the path
+                of one saved as .npy.
+            coords (np.ndarray): (n, 2) array of (row, col) pixel coordinates.
+            labels (np.ndarray): n 0-indexed class labels.
+            patch_size (int): The spatial size of the square patches.
+        """
+        self.patch_size = patch_size
+        self.coords = np.ascontiguousarray(coords, dtype=np.int32)
+        self.labels = torch.as_tensor(np.asarray(labels), dtype=torch.int64)
+        if isinstance(padded_cube, (str, os.PathLike)):
+            self.padded_path = os.fspath(padded_cube)
+            self._shared_cube = None
+        else:
+            self.padded_path = None
+            self._shared_cube = torch.from_numpy(np.ascontiguousarray(padded_cube, dtype=np.float32)).share_memory_()
+        self._windows = None
+
+    @classmethod
+    def from_scene(cls, hypercube, ground_truth, patch_size=PATCH_SIZE, padded_path=None):
+        """
+        Builds a dataset of every labeled pixel (ground_truth > 0) of a scene.
+
+        Args:
+            hypercube (np.ndarray): The (height, width, bands) data cube.
+            ground_truth (np.ndarray): The (height, width) label map, 0 = unlabeled.
+            patch_size (int): The spatial size of the square patches.
+            padded_path (str): Optional .npy path to write the padded cube to, so it is
+                memory-mapped instead of held in (shared) memory.
+        """
+        coords = np.argwhere(ground_truth > 0)
+        labels = ground_truth[coords[:, 0], coords[:, 1]].astype(np.int64) - 1 # PyTorch expects 0-indexed labels
+
+        if padded_path is None:
+            return cls(pad_cube(hypercube, patch_size), coords, labels, patch_size)
+
+        os.makedirs(os.path.dirname(padded_path) or '.', exist_ok=True)
+        padded = open_memmap(padded_path, mode='w+', dtype=np.float32,
+                             shape=padded_shape(hypercube.shape, patch_size))
+        pad_cube(hypercube, patch_size, out=padded)
+        padded.flush()
+        del padded
+        return cls(padded_path, coords, labels, patch_size)
+
+    def subset(self, indices):
+        """A dataset over some of the pixels that shares this one's padded cube."""
+        indices = np.asarray(indices)
+        subset = PatchDataset.__new__(PatchDataset)
+        subset.__dict__.update(self.__getstate__())
+        subset.coords = self.coords[indices]
+        subset.labels = self.labels[torch.from_numpy(indices)]
+        return subset
+
+    def __getstate__(self):
+        # Workers re-open the memory map / receive the shared tensor; the window view is rebuilt lazily
+        state = self.__dict__.copy()
+        state['_windows'] = None
+        return state
+
+    def _get_windows(self):
+        if self._windows is None:
+            if self.padded_path is not None:
+                padded_cube = np.load(self.padded_path, mmap_mode='r')
+            else:
+                padded_cube = self._shared_cube.numpy()
+            self._windows = patch_windows(padded_cube, self.patch_size)
+        return self._windows
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __getitem__(self, index):
+        windows = self._get_windows()
+        if np.isscalar(index):
+            r, c = self.coords[index]
+            patch = np.array(windows[r, c], dtype=np.float32)[np.newaxis]
+            return torch.from_numpy(patch), self.labels[index]
+
+        index = np.asarray(index)
+        # Sorting makes neighbouring pixels adjacent, so fill_patches copies them as one run
+        order = np.lexsort((self.coords[index, 1], self.coords[index, 0]))
+        index = index[order]
+        batch = np.empty((len(index), 1) + windows.shape[2:], dtype=np.float32)
+        fill_patches(windows, self.coords[index, 0], self.coords[index, 1], batch)
+        return torch.from_numpy(batch), self.labels[torch.from_numpy(index)]
+
+def patch_loader(dataset, batch_size=64, shuffle=False, num_workers=0, seed=None):
+    """
+    DataLoader that asks the dataset for whole batches of indices at a time, so
+    patches are cut with one fill_patches call per batch rather than per pixel.
+    """
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+    sampler = RandomSampler(dataset, generator=generator) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False), batch_size=None,
+                      num_workers=num_workers, persistent_workers=num_workers > 0)
@@ -0,0 +1,135 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+def padded_shape(shape, patch_size):
+    """Shape of the cube pad_cube returns for a (height, width, bands) input."""
+    pad_width = patch_size // 2
+    height, width, bands = shape
+    return (height + 2 * pad_width, width + 2 * pad_width, bands)
+
+def pad_cube(hypercube, patch_size, out=None):
+    """
+    Zero-pads the spatial dimensions of the hypercube by half a patch.
+
+    The padded cube is allocated once as float32 and the source is copied into
+    its interior, so a float64 or memory-mapped source is converted in a single pass.
+
+    Args:
+        hypercube (np.ndarray): The (height, width, bands) data cube.
+        patch_size (int): The spatial size of the square patches.
+        out (np.ndarray): Optional float32 buffer of padded_shape(...) to fill,
+            e.g. one backed by shared memory.
+
+    Returns:
+        np.ndarray: The (height + 2 * pad, width + 2 * pad, bands) float32 cube.
+    """
+    pad_width = patch_size // 2
+    height, width, _ = hypercube.shape
+    if out is None:
+        padded_cube = np.zeros(padded_shape(hypercube.shape, patch_size), dtype=np.float32)
+    else:
+        padded_cube = out
+        padded_cube[:pad_width] = 0
+        padded_cube[pad_width + height:] = 0
+        padded_cube[:, :pad_width] = 0
+        padded_cube[:, pad_width + width:] = 0
+    padded_cube[pad_width:pad_width + height, pad_width:pad_width + width, :] = hypercube
+    return padded_cube
+
+def patch_windows(padded_cube, patch_size):
+    """
+    Returns a strided (height, width, patch_size, patch_size, bands) view of every
+    patch in a padded cube. No data is copied.
+    """
+    bands = padded_cube.shape[2]
+    return sliding_window_view(padded_cube, (patch_size, patch_size, bands))[:, :, 0]
+
+def fill_patches(windows, rows, cols, out):
+    """
+    Copies the patches centred on (rows, cols) into a preallocated buffer.
+
+    Consecutive pixels on the same row are copied as one strided slice of the
+    window view, so the Python loop runs once per row segment, not per pixel.
+
+    Args:
+        windows (np.ndarray): The view returned by patch_windows.
+        rows (np.ndarray): Row index of each pixel.
+        cols (np.ndarray): Column index of each pixel.
+        out (np.ndarray): A (n, 1, patch_size, patch_size, bands) buffer with n >= len(rows).
+
+    Returns:
+        np.ndarray: The filled leading part of `out`.
+    """
+    n = len(rows)
+    if n == 0:
+        return out[:0]
+
+    breaks = np.flatnonzero((rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1] + 1)) + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [n]))
+    for start, stop in zip(starts.tolist(), stops.tolist()):
+        r, c = int(rows[start]), int(cols[start])
+        out[start:stop, 0] = windows[r, c:c + (stop - start)]
+
+    return out[:n]
+
+def iter_patch_batches(padded_cube, patch_size, batch_size, coords=None):
+    """
+    Yields contiguous float32 patch batches ready for the model.
+
+    Args:
+        padded_cube (np.ndarray): A cube padded with pad_cube.
+        patch_size (int): The spatial size of the square patches.
+        batch_size (int): Maximum number of patches per batch.
+        coords (np.ndarray): Optional (n, 2) array of (row, col) pixel coordinates.
+            Defaults to every pixel of the scene in raster order.
+
+    Yields:
+        tuple: (start, stop, batch) where batch is a (stop - start, 1, patch_size,
+        patch_size, bands) array. The buffer is reused, so consume it before advancing.
+    """
+    windows = patch_windows(padded_cube, patch_size)
+    height, width = windows.shape[:2]
+    total = height * width if coords is None else len(coords)
+
+    # (batch, channel, patch_size, patch_size, bands), as Conv3d expects
+    buffer = np.empty((min(batch_size, total), 1) + windows.shape[2:], dtype=np.float32)
+
+    for start in range(0, total, batch_size):
+        stop = min(start + batch_size, total)
+        if coords is None:
+            rows, cols = np.divmod(np.arange(start, stop), width)
+        else:
+            rows, cols = coords[start:stop, 0], coords[start:stop, 1]
+        yield start, stop, fill_patches(windows, rows, cols, buffer)
+
+def gather_patches(cube, rows, cols, patch_size, out):
+    """
+    Copies the patches centred on (rows, cols) of an unpadded cube into a buffer,
+    zero-filling the parts that fall outside the scene, as pad_cube would.
+
+    Unlike fill_patches this reads straight from the (possibly memory-mapped)
+    cube with one gather, so pixels from anywhere in a scene can share a batch
+    without padding or reading the rows in between.
+
+    Args:
+        cube (np.ndarray): The (height, width, bands) data cube.
+        rows (np.ndarray): Row index of each pixel.
+        cols (np.ndarray): Column index of each pixel.
+        patch_size (int): The spatial size of the square patches.
+        out (np.ndarray): A (n, 1, patch_size, patch_size, bands) buffer with n >= len(rows).
+
+    Returns:
+        np.ndarray: The filled leading part of `out`.
+    """
+    n = len(rows)
+    height, width = cube.shape[:2]
+    offsets = np.arange(patch_size) - patch_size // 2
+    patch_rows = np.asarray(rows)[:, None] + offsets
+    patch_cols = np.asarray(cols)[:, None] + offsets
+    inside = ((patch_rows >= 0) & (patch_rows < height))[:, :, None] & ((patch_cols >= 0) & (patch_cols < width))[:, None, :]
+
+    patches = out[:n, 0]
+    patches[...] = cube[np.clip(patch_rows, 0, height - 1)[:, :, None], np.clip(patch_cols, 0, width - 1)[:, None, :]]
+    patches[~inside] = 0
+    return out[:n]
@@ -0,0 +1,72 @@
+import json
+import base64
+
+import numpy as np
+
+from modules.map_encoding import encode_map, MAP_FORMATS
+from modules.result_cache import compact_labels
+from modules.metrics import timed
+
+# Streaming delivers the prediction map as row blocks while the scene is still being
+# classified. Each block message carries its rows plus the running class counts, so a
+# client can paint pixels and update the legend long before the full map exists.
+
+class RunningClassCounts:
+    """Class pixel counts accumulated over the blocks seen so far."""
+
+    def __init__(self):
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, labels):
+        block_counts = np.bincount(np.asarray(labels).ravel())
+        if len(block_counts) > len(self.counts):
+            self.counts = np.pad(self.counts, (0, len(block_counts) - len(self.counts)))
+        self.counts[:len(block_counts)] += block_counts
+
+    def summary(self):
+        """Same shape as modules.model_handler.summarize_prediction, background excluded."""
+        return [{'crop_type_id': int(cls), 'pixel_count': int(count)}
+                for cls, count in enumerate(self.counts.tolist()) if cls != 0 and count]
+
+def block_message(r0, r1, labels, class_summary, rows_total, map_format='json', binary=False):
+    """
+    Describes one finished row block of the prediction map.
+
+    Args:
+        r0 (int): First row of the block.
+        r1 (int): One past the last row of the block.
+        labels (np.ndarray): The (r1 - r0, width) labels of the block.
+        class_summary (list): Running class counts up to and including this block.
+        rows_total (int): Height of the full map.
+        map_format (str): 'json' for a flat label list, or a binary format of
+            modules.map_encoding ('raw', 'rle', 'png').
+        binary (bool): Keep binary payloads as bytes (Socket.IO attachments) instead of base64 text.
+
+    Returns:
+        dict: The message body.
+    """
+    if map_format not in MAP_FORMATS:
+        raise ValueError(f'Unknown map format \'{map_format}\'. Expected one of {MAP_FORMATS}.')
+
+    labels = compact_labels(np.asarray(labels))
+    message = {'row_start': int(r0), 'row_stop': int(r1), 'rows_total': int(rows_total),
+               'width': int(labels.shape[1]), 'class_summary': class_summary}
+    if map_format == 'json':
+        message['prediction_map'] = labels.ravel().tolist()
+        return message
+
+    body, _, headers = encode_map(labels, map_format)
+    message['encoding'] = map_format
+    message['dtype'] = headers['X-Map-Dtype']
+    if 'X-Map-Runs' in headers:
+        message['runs'] = int(headers['X-Map-Runs'])
+    if binary:
+        message['data'] = body
+    else:
+        with timed('base64_encode'):
+            message['data'] = base64.b64encode(body).decode('ascii')
+    return message
+
+def sse_event(event, data):
+    """Formats one Server-Sent Events frame."""
+    return f'event: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
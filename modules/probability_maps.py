@@ -0,0 +1,150 @@
+import json
+
+import numpy as np
+import torch
+
+from modules.map_encoding import encode_map, MAP_FORMATS
+from modules.spectral_indices import encode_raster, RASTER_FORMATS
+
+# Per-pixel outputs kept alongside the label map when a run asks for them, all from the same softmax:
+#   confidence          - probability of the predicted class (float16)
+#   margin              - its lead over the runner-up class (float16); small margins mark confusable pixels
+#   top_k_labels        - the k most probable classes, 1-indexed, most probable first (uint8)
+#   top_k_probabilities - their probabilities (float16)
+# Pixels that were not classified (outside a region of interest) are 0 in every layer.
+PROBABILITY_LAYERS = ('confidence', 'margin', 'top_k_labels', 'top_k_probabilities')
+DEFAULT_TOP_K = 3
+MAX_TOP_K = 8
+UNCERTAIN_CONFIDENCE = 0.5  # Pixels below this confidence count as uncertain in probability_summary
+PROBABILITY_HEADERS = ('X-Probability-Layer', 'X-Probability-Summary')
+LABEL_FORMATS = tuple(fmt for fmt in MAP_FORMATS if fmt != 'json')  # Binary formats of the top_k_labels layer
+
+def validate_top_k(top_k):
+    """Raises ValueError unless 1 <= top_k <= MAX_TOP_K."""
+    if not 1 <= top_k <= MAX_TOP_K:
+        raise ValueError(f'top_k must be between 1 and {MAX_TOP_K}, got {top_k}.')
+    return top_k
+
+def probability_outputs(logits, top_k):
+    """
+    Labels and probability outputs of a batch of logits, from one softmax.
+
+    Args:
+        logits (torch.Tensor): (..., num_classes) logits, e.g. (n, classes) from the patch
+            path or (rows, cols, classes) from CropClassifier.forward_dense.
+        top_k (int): Classes kept per pixel; padded with label 0 and probability 0
+            beyond num_classes.
+
+    Returns:
+        tuple: ((...) int64 labels, 1-indexed like the ground truth, dict of the
+        PROBABILITY_LAYERS arrays shaped (...) or (..., top_k)).
+
+    Raises:
+        ValueError: For models with more classes than the uint8 top_k_labels hold.
+    """
+    if logits.shape[-1] > np.iinfo(np.uint8).max:
+        raise ValueError(f'Probability maps hold at most {np.iinfo(np.uint8).max} classes, got {logits.shape[-1]}.')
+    probabilities = torch.softmax(logits.float(), dim=-1)
+    num_classes = probabilities.shape[-1]
+    ranked, indices = torch.topk(probabilities, min(max(top_k, 2), num_classes), dim=-1)
+    ranked, indices = ranked.cpu().numpy(), indices.cpu().numpy()
+
+    leading = ranked.shape[:-1]
+    kept = min(top_k, num_classes)
+    top_k_labels = np.zeros(leading + (top_k,), dtype=np.uint8)
+    top_k_labels[..., :kept] = indices[..., :kept] + 1
+    top_k_probabilities = np.zeros(leading + (top_k,), dtype=np.float16)
+    top_k_probabilities[..., :kept] = ranked[..., :kept]
+    runner_up = ranked[..., 1] if num_classes > 1 else 0
+
+    outputs = {
+        'confidence': ranked[..., 0].astype(np.float16),
+        'margin': (ranked[..., 0] - runner_up).astype(np.float16),
+        'top_k_labels': top_k_labels,
+        'top_k_probabilities': top_k_probabilities,
+    }
+    return indices[..., 0].astype(np.int64) + 1, outputs
+
+def empty_probability_maps(height, width, top_k):
+    """Zeroed (height, width[, top_k]) arrays of every PROBABILITY_LAYERS layer."""
+    return {
+        'confidence': np.zeros((height, width), dtype=np.float16),
+        'margin': np.zeros((height, width), dtype=np.float16),
+        'top_k_labels': np.zeros((height, width, top_k), dtype=np.uint8),
+        'top_k_probabilities': np.zeros((height, width, top_k), dtype=np.float16),
+    }
+
+def store_outputs(maps, index, outputs, keep=None):
+    """
+    Writes probability outputs into maps[layer][index] for every layer.
+
+    Args:
+        index: A (row, col) index into the maps (slices or coordinate arrays).
+        keep (np.ndarray): Optional boolean mask over the pixels of a slice index; the others are zeroed.
+    """
+    for layer, values in outputs.items():
+        target = maps[layer]
+        target[index] = values
+        if keep is not None:
+            target[index][~keep] = 0
+
+def probability_summary(maps):
+    """Mean confidence and margin and the share of uncertain pixels, over the classified pixels."""
+    classified = maps['top_k_labels'][..., 0] > 0
+    confidence = maps['confidence'][classified].astype(np.float32)
+    margin = maps['margin'][classified].astype(np.float32)
+    if confidence.size == 0:
+        return {'pixels': 0, 'top_k': int(maps['top_k_labels'].shape[-1])}
+    return {
+        'pixels': int(confidence.size),
+        'top_k': int(maps['top_k_labels'].shape[-1]),
+        'mean_confidence': float(confidence.mean()),
+        'mean_margin': float(margin.mean()),
+        'confidence_percentiles': {f'p{q}': float(v) for q, v in zip((10, 50, 90), np.percentile(confidence, (10, 50, 90)))},
+        'uncertain_threshold': UNCERTAIN_CONFIDENCE,
+        'uncertain_fraction': float(np.mean(confidence < UNCERTAIN_CONFIDENCE)),
+    }
+
+def encode_probability_layer(maps, layer, rank=1, fmt=None):
+    """
+    Serializes one layer of probability maps as a compact raster.
+
+    Probability layers (confidence, margin, top_k_probabilities) use the spectral index
+    raster formats (f16, f32 or a greyscale PNG over 0..1, see modules.spectral_indices);
+    top_k_labels uses the prediction map formats (raw, rle or palette PNG, see
+    modules.map_encoding).
+
+    Args:
+        maps (dict): Probability maps, as stored by modules.result_cache.
+        layer (str): One of PROBABILITY_LAYERS.
+        rank (int): Which of the top k (1 = most probable) for the top_k_* layers.
+        fmt (str): Wire format; defaults to f16 for probabilities and raw for labels.
+
+    Returns:
+        tuple: (body, media_type, headers).
+
+    Raises:
+        ValueError: For an unknown layer, rank or format.
+    """
+    if layer not in PROBABILITY_LAYERS:
+        raise ValueError(f'Unknown probability layer \'{layer}\'. Expected one of {PROBABILITY_LAYERS}.')
+    raster = maps[layer]
+    if layer.startswith('top_k_'):
+        top_k = raster.shape[-1]
+        if not 1 <= rank <= top_k:
+            raise ValueError(f'rank must be between 1 and {top_k}, got {rank}.')
+        raster = raster[..., rank - 1]
+
+    if layer == 'top_k_labels':
+        fmt = fmt or 'raw'
+        if fmt not in LABEL_FORMATS:
+            raise ValueError(f'Unknown label raster format \'{fmt}\'. Expected one of {LABEL_FORMATS}.')
+        body, media_type, headers = encode_map(raster, fmt)
+    else:
+        fmt = fmt or 'f16'
+        if fmt not in RASTER_FORMATS:
+            raise ValueError(f'Unknown probability raster format \'{fmt}\'. Expected one of {RASTER_FORMATS}.')
+        body, media_type, headers = encode_raster(raster, fmt, (0.0, 1.0))
+    headers['X-Probability-Layer'] = layer if not layer.startswith('top_k_') else f'{layer};rank={rank}'
+    headers['X-Probability-Summary'] = json.dumps(probability_summary(maps), separators=(',', ':'))
+    return body, media_type, headers
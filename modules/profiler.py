@@ -0,0 +1,150 @@
+import os
+import sys
+import time
+import uuid
+import random
+import threading
+from collections import Counter, OrderedDict
+
+DEFAULT_INTERVAL_MS = 5  # Time between stack samples
+MAX_STACK_DEPTH = 64  # Frames kept per sample, from the innermost outwards
+MAX_PROFILES = 32  # Finished profiles kept for /debug/profiles, oldest dropped first
+# Innermost functions of threads parked on a lock, selector, socket or empty thread-pool queue; their samples are dropped
+IDLE_FUNCTIONS = frozenset(('wait', 'select', 'poll', 'accept', '_wait_for_tstate_lock', '_run_once', '_worker'))
+
+def _frame_name(code):
+    name = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+    return name.replace(';', ',')
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a background thread snapshots the Python stacks of the
+    other threads every interval seconds (sys._current_frames) and counts them.
+
+    Unlike cProfile it adds no cost to the code being profiled, only to the
+    sampler thread, so it can be left on for selected requests in production.
+    Native time (PyTorch kernels, NumPy, zlib) is attributed to the Python
+    frame that called it. Every thread of the process is sampled, so work a
+    request hands to a thread pool is included, along with that of any
+    concurrent requests.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL_MS / 1000, max_depth=MAX_STACK_DEPTH, include_idle=False):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.include_idle = include_idle
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            if not self.include_idle and frame.f_code.co_name in IDLE_FUNCTIONS:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f'thread-{ident}').replace(';', ','))
+            self.stacks[tuple(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+def collapsed_stacks(stacks):
+    """Stack counts as 'thread;outer;...;inner count' lines, the input of flamegraph.pl and speedscope."""
+    return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.most_common())
+
+def top_functions(stacks, limit=20):
+    """The functions most often on top of the stack (self time), as [{'function', 'samples'}]."""
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack[-1]] += count
+    return [{'function': name, 'samples': count} for name, count in leaves.most_common(limit)]
+
+class RequestProfiler:
+    """
+    Opt-in per-request sampling profiles for the web servers.
+
+    Nothing is sampled unless enabled. Then a request is profiled when it asks to
+    be (?profile=1 or an X-Profile: 1 header) or, with sample_rate > 0, at random.
+    One SamplingProfiler runs at a time (it samples the whole process); requests
+    arriving while it runs are not profiled. The last MAX_PROFILES profiles are
+    kept in memory under the id returned in the X-Profile-Id response header.
+    """
+
+    def __init__(self, enabled=False, sample_rate=0.0, interval=DEFAULT_INTERVAL_MS / 1000, max_profiles=MAX_PROFILES):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_profiles = max_profiles
+        self._profiles = OrderedDict()
+        self._busy = threading.Lock()
+        self._lock = threading.Lock()
+
+    def should_profile(self, requested=False):
+        return self.enabled and (requested or (self.sample_rate > 0 and random.random() < self.sample_rate))
+
+    def begin(self, method, path):
+        """Starts profiling a request; returns a handle for end(), or None if a profile is already running."""
+        if not self._busy.acquire(blocking=False):
+            return None
+        return {'method': method, 'path': path, 'started': time.time(), 'start': time.perf_counter(),
+                'profiler': SamplingProfiler(self.interval).start()}
+
+    def end(self, handle, status=None):
+        """Stops a profile started by begin() and stores it; returns its id."""
+        try:
+            profiler = handle['profiler'].stop()
+        finally:
+            self._busy.release()
+        profile_id = uuid.uuid4().hex[:12]
+        profile = {'id': profile_id, 'method': handle['method'], 'path': handle['path'], 'status': status,
+                   'started': handle['started'], 'duration_ms': (time.perf_counter() - handle['start']) * 1000,
+                   'interval_ms': self.interval * 1000, 'samples': profiler.samples, 'stacks': profiler.stacks}
+        with self._lock:
+            self._profiles[profile_id] = profile
+            while len(self._profiles) > self.max_profiles:
+                self._profiles.popitem(last=False)
+        return profile_id
+
+    def get(self, profile_id):
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+    @staticmethod
+    def summary(profile):
+        """A profile without its stacks, plus its top functions, for JSON responses."""
+        return {**{key: value for key, value in profile.items() if key != 'stacks'},
+                'top_functions': top_functions(profile['stacks'], 10)}
+
+    def profiles(self):
+        """Summaries of the stored profiles, newest first."""
+        with self._lock:
+            profiles = list(self._profiles.values())
+        return [self.summary(profile) for profile in reversed(profiles)]
@@ -0,0 +1,205 @@
+import os
+import io
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+FINGERPRINT_CHUNK_BYTES = 1 << 24  # Rows of the cube are hashed ~16 MB at a time
+
+def fingerprint_array(array):
+    """
+    Content hash of an array (e.g. the hypercube), computed in row chunks so a
+    memory-mapped cube is streamed rather than copied.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f'{array.shape}|{array.dtype}'.encode())
+    row_bytes = max(1, array[0].nbytes if len(array) else 1)
+    step = max(1, FINGERPRINT_CHUNK_BYTES // row_bytes)
+    for start in range(0, len(array), step):
+        digest.update(np.ascontiguousarray(array[start:start + step]).data)
+    return digest.hexdigest()
+
+def fingerprint_state_dict(state_dict):
+    """Content hash of a model's weights, independent of dict order."""
+    digest = hashlib.blake2b(digest_size=20)
+    for name in sorted(state_dict):
+        value = state_dict[name]
+        digest.update(name.encode())
+        if isinstance(value, torch.Tensor):
+            value = value.detach().cpu()
+            digest.update(f'{tuple(value.shape)}|{value.dtype}'.encode())
+            digest.update(value.contiguous().numpy().tobytes())
+        else:
+            digest.update(repr(value).encode())
+    return digest.hexdigest()
+
+def inference_cache_key(cube_fingerprint, model_fingerprint, config):
+    """Key of one classification result: cube content + model weights + inference config."""
+    payload = json.dumps({'cube': cube_fingerprint, 'model': model_fingerprint, 'config': config}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def cached_files(folder, suffix):
+    """(path, size, mtime) of every file under folder whose name ends with suffix."""
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if name.endswith(suffix):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # Removed meanwhile
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+def prune_oldest(folder, suffix, max_bytes):
+    """
+    Removes the oldest matching files under folder down to 80% of max_bytes, so a
+    cache that just went over its disk budget is not pruned again on every write.
+
+    Returns:
+        int: Bytes of the matching files left.
+    """
+    files = sorted(cached_files(folder, suffix), key=lambda item: item[2])
+    total = sum(size for _, size, _ in files)
+    for path, size, _ in files:
+        if total <= 0.8 * max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    return total
+
+def compact_labels(prediction_map):
+    """Stores a label map in the smallest unsigned dtype that holds its classes."""
+    max_label = int(prediction_map.max()) if prediction_map.size else 0
+    dtype = np.uint8 if max_label <= np.iinfo(np.uint8).max else np.uint16
+    return prediction_map.astype(dtype, copy=False)
+
+class ResultCache:
+    """
+    Content-addressed cache of classification results.
+
+    Results live on disk as compressed .npz files (label map in uint8/uint16 plus
+    the class summary), fronted by an in-memory LRU that evicts by byte size.
+    Cached maps are returned read-only. The disk copy is bounded too: the oldest
+    files are removed once max_disk_bytes is exceeded.
+
+    Runs with probability maps (modules.probability_maps) store their float16 /
+    uint8 layers in the same file, as probability_<layer> arrays; their entries
+    are (prediction_map, class_summary, probability_maps).
+    """
+
+    def __init__(self, cache_folder, max_memory_bytes=256 * 1024 * 1024, max_disk_bytes=2048 * 1024 * 1024):
+        self.cache_folder = cache_folder
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_folder, f'{key}.npz')
+
+    @staticmethod
+    def _nbytes(entry):
+        nbytes = entry[0].nbytes
+        if len(entry) > 2:
+            nbytes += sum(layer.nbytes for layer in entry[2].values())
+        return nbytes
+
+    def _remember(self, key, entry):
+        nbytes = self._nbytes(entry)
+        if nbytes > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= self._nbytes(self._memory.pop(key))
+        self._memory[key] = entry
+        self._memory_bytes += nbytes
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= self._nbytes(evicted)
+
+    def get(self, key):
+        """Returns (prediction_map, class_summary[, probability_maps]) for a key, or None."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        try:
+            with np.load(self._path(key)) as stored:
+                prediction_map = stored['prediction_map']
+                class_summary = json.loads(str(stored['class_summary']))
+                probability_maps = {name[len('probability_'):]: stored[name] for name in stored.files
+                                    if name.startswith('probability_')}
+        except OSError:  # Not cached, or pruned from disk
+            with self._lock:
+                self.misses += 1
+            return None
+        prediction_map.flags.writeable = False
+        entry = (prediction_map, class_summary)
+        if probability_maps:
+            for layer in probability_maps.values():
+                layer.flags.writeable = False
+            entry += (probability_maps,)
+        with self._lock:
+            self._remember(key, entry)
+            self.hits += 1
+        return entry
+
+    def put(self, key, prediction_map, class_summary, probability_maps=None):
+        prediction_map = np.array(compact_labels(prediction_map))  # Own copy, frozen below
+        prediction_map.flags.writeable = False
+        entry = (prediction_map, class_summary)
+        arrays = {}
+        if probability_maps is not None:
+            probability_maps = {layer: np.array(values) for layer, values in probability_maps.items()}
+            for values in probability_maps.values():
+                values.flags.writeable = False
+            entry += (probability_maps,)
+            arrays = {f'probability_{layer}': values for layer, values in probability_maps.items()}
+
+        os.makedirs(self.cache_folder, exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, prediction_map=prediction_map, class_summary=json.dumps(class_summary), **arrays)
+        tmp_path = f'{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(buffer.getvalue())
+        os.replace(tmp_path, self._path(key))
+
+        with self._lock:
+            self._remember(key, entry)
+            # Counts the ChangeTracker's .tiles.npz sidecars too; losing one only costs a full re-run
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in cached_files(self.cache_folder, '.npz'))
+            else:
+                self._disk_bytes += buffer.getbuffer().nbytes
+            if self._disk_bytes > self.max_disk_bytes:
+                self._disk_bytes = prune_oldest(self.cache_folder, '.npz', self.max_disk_bytes)
+        return entry
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached result for key, or runs compute() ->
+        (prediction_map, class_summary[, probability_maps]) and stores it.
+        """
+        entry = self.get(key)
+        if entry is None:
+            entry = self.put(key, *compute())
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {'entries_in_memory': len(self._memory), 'memory_bytes': self._memory_bytes,
+                    'max_memory_bytes': self.max_memory_bytes, 'disk_bytes': self._disk_bytes,
+                    'max_disk_bytes': self.max_disk_bytes, 'hits': self.hits, 'misses': self.misses}
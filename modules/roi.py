@@ -0,0 +1,83 @@
+import json
+import hashlib
+
+import numpy as np
+
+from modules.spectral_signatures import polygon_mask, polygon_box, clip_box, check_box, parse_vertices
+
+# Named masks a request can ask for instead of drawing a region
+ROI_SOURCES = ('ground_truth',)  # ground_truth: every labeled pixel (ground_truth > 0)
+
+def parse_roi(roi=None, bbox=None, polygon=None):
+    """
+    Normalizes a region of interest given as request parameters.
+
+    Args:
+        roi (str): A named mask from ROI_SOURCES.
+        bbox (str or list): 'x0,y0,x1,y1' or [x0, y0, x1, y1] (x1 / y1 exclusive, so x0 < x1 and y0 < y1).
+        polygon (str or list): [[x, y], ...] vertices, or their JSON encoding.
+
+    Returns:
+        dict: {'roi', 'bbox', 'polygon'} with the given parts, or None if none was given.
+            Several parts select their intersection.
+
+    Raises:
+        ValueError: For malformed parameters.
+    """
+    spec = {}
+    if roi:
+        if roi not in ROI_SOURCES:
+            raise ValueError(f'Unknown roi \'{roi}\'. Expected one of {ROI_SOURCES}.')
+        spec['roi'] = roi
+    if bbox:
+        try:
+            values = [int(v) for v in (bbox.split(',') if isinstance(bbox, str) else bbox)]
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError('bbox must be four integers x0,y0,x1,y1.')
+        if len(values) != 4:
+            raise ValueError('bbox must be four integers x0,y0,x1,y1.')
+        check_box(*values)
+        spec['bbox'] = values
+    if polygon:
+        try:
+            vertices = json.loads(polygon) if isinstance(polygon, str) else polygon
+        except ValueError:
+            raise ValueError('A polygon must be a list of [x, y] vertices.')
+        spec['polygon'] = parse_vertices(vertices).tolist()
+    return spec or None
+
+def roi_mask(spec, height, width, ground_truth=None):
+    """
+    Boolean (height, width) mask of a parse_roi spec.
+
+    Raises:
+        ValueError: If the spec needs ground truth the scene does not have.
+    """
+    mask = np.ones((height, width), dtype=bool)
+    if 'roi' in spec:
+        if ground_truth is None:
+            raise ValueError('This scene has no ground truth to select pixels from.')
+        mask &= np.asarray(ground_truth) > 0
+    if 'bbox' in spec:
+        # Both ends clipped to the scene, so a box outside it selects nothing rather than wrapping around
+        r0, r1, c0, c1 = clip_box(*spec['bbox'], height, width)
+        box = np.zeros_like(mask)
+        box[r0:r1, c0:c1] = True
+        mask &= box
+    if 'polygon' in spec:
+        # Rasterized over the polygon's bounding box only
+        vertices = np.asarray(spec['polygon'])
+        r0, r1, c0, c1 = polygon_box(vertices, height, width)
+        inside = np.zeros_like(mask)
+        if r0 < r1 and c0 < c1:
+            inside[r0:r1, c0:c1] = polygon_mask(vertices, r0, r1, c0, c1)
+        mask &= inside
+    return mask
+
+def mask_fingerprint(mask):
+    """Content hash of a mask, for prediction cache keys."""
+    mask = np.ascontiguousarray(mask, dtype=bool)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{mask.shape}'.encode())
+    digest.update(np.packbits(mask).tobytes())
+    return digest.hexdigest()
@@ -0,0 +1,308 @@
+import os
+import re
+import json
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass, field, asdict, replace
+from typing import Optional
+
+import numpy as np
+
+from modules.data_handler import (load_hyperspectral_data, statistics_cache_path, hypercube_cache_fingerprint,
+                                  raw_tile_checksums, RGB_BANDS)
+from modules.result_cache import fingerprint_array
+from modules.band_statistics import BandStatistics
+
+DEFAULT_SCENE_ID = 'indian_pines'
+UPLOADS_INDEX_FILENAME = 'scenes.json'
+
+class UnknownSceneError(KeyError):
+    """Raised for a scene id that is not registered."""
+
+@dataclass
+class SceneInfo:
+    """Metadata of one hyperspectral scene."""
+    scene_id: str
+    name: str
+    hypercube_filename: str
+    ground_truth_filename: Optional[str] = None
+    data_folder: Optional[str] = None        # Defaults to the registry's data folder
+    rgb_bands: tuple = RGB_BANDS
+    num_classes: int = 16
+    bands: Optional[int] = None              # Filled in once the cube has been loaded
+    model_path: Optional[str] = None         # Classifier trained for this scene, if any
+    uploaded: bool = False
+
+    def to_dict(self):
+        info = asdict(self)
+        info['rgb_bands'] = list(self.rgb_bands)
+        return info
+
+# Scenes shipped with (or documented for) the repository
+BUILTIN_SCENES = (
+    SceneInfo('indian_pines', 'Indian Pines', 'Indian_pines_corrected.mat', 'Indian_pines_gt.mat',
+              rgb_bands=RGB_BANDS, num_classes=16, bands=200,
+              model_path=os.path.join('models', 'crop_classifier.pth')),
+    SceneInfo('salinas', 'Salinas', 'Salinas_corrected.mat', 'Salinas_gt.mat',
+              rgb_bands=RGB_BANDS, num_classes=16, bands=204,
+              model_path=os.path.join('models', 'salinas_classifier.pth')),
+)
+
+@dataclass
+class LoadedScene:
+    """
+    A resident scene: its metadata, cube, ground truth, content hash and band statistics.
+    Cached scenes also carry the tile checksums of their raw cube and its (min, max)
+    normalization, for modules.incremental_inference.
+    """
+    info: SceneInfo
+    hypercube: object
+    ground_truth: object
+    fingerprint: str
+    statistics: Optional[BandStatistics] = None
+    nbytes: int = field(default=0)
+    tile_checksums: Optional[np.ndarray] = None
+    normalization: Optional[tuple] = None
+
+    @property
+    def histograms(self):
+        return self.statistics.histograms if self.statistics is not None else None
+
+class SceneRegistry:
+    """
+    Named hyperspectral scenes with lazily loaded, byte-budgeted residency.
+
+    Scenes are loaded on first use through load_hyperspectral_data (which itself
+    reuses the normalized .npy cache) and stay resident, most recently used
+    first, while their cubes fit in memory_budget_bytes. Switching back to a
+    resident scene costs nothing; an evicted scene is re-opened from the cache
+    rather than re-parsed from .mat. The most recently used scene is always kept,
+    even if it alone exceeds the budget.
+
+    The budget counts the arrays a scene holds in memory: a cube memory-mapped from
+    the cache is left to the OS page cache and does not count, so the budget only
+    bites for scenes loaded without the cache (or with spectra held in RAM).
+
+    Loads run outside the registry lock, so a cold load never blocks requests for
+    resident scenes; concurrent requests for a scene being loaded wait for that
+    one load instead of starting another.
+
+    Uploaded scenes live in upload_folder/<scene_id>/ and are listed in
+    upload_folder/scenes.json so they survive restarts.
+    """
+
+    def __init__(self, data_folder='data', cache_folder=None, cache_dtype='float32', use_cache=True,
+                 memory_budget_bytes=1024 * 1024 * 1024, upload_folder='uploads', scenes=BUILTIN_SCENES):
+        self.data_folder = data_folder
+        self.cache_folder = cache_folder or os.path.join(data_folder, 'cache')
+        self.cache_dtype = cache_dtype
+        self.use_cache = use_cache
+        self.memory_budget_bytes = memory_budget_bytes
+        self.upload_folder = upload_folder
+        self._scenes = OrderedDict()
+        self._resident = OrderedDict()
+        self._resident_bytes = 0
+        self._loading = {}  # Scene id -> Future of the load in progress
+        self._lock = threading.RLock()
+        self.loads = 0
+        self.evictions = 0
+
+        for info in scenes:
+            self.register(info)
+        self._load_upload_index()
+
+    def register(self, info):
+        with self._lock:
+            self._scenes[info.scene_id] = info
+            self._loading.pop(info.scene_id, None)  # A load in progress would keep the old metadata
+            self._drop(info.scene_id)
+        return info
+
+    def info(self, scene_id):
+        with self._lock:
+            if scene_id not in self._scenes:
+                raise UnknownSceneError(f'Unknown scene \'{scene_id}\'. Available scenes: {list(self._scenes)}')
+            return self._scenes[scene_id]
+
+    def scenes(self):
+        """Metadata of every registered scene, with whether its cube is resident and its files exist."""
+        with self._lock:
+            return [{**info.to_dict(), 'resident': scene_id in self._resident, 'available': self._available(info)}
+                    for scene_id, info in self._scenes.items()]
+
+    def _data_folder(self, info):
+        return info.data_folder or self.data_folder
+
+    def _available(self, info):
+        folder = self._data_folder(info)
+        files = [info.hypercube_filename] + ([info.ground_truth_filename] if info.ground_truth_filename else [])
+        return all(os.path.isfile(os.path.join(folder, name)) for name in files)
+
+    def is_resident(self, scene_id):
+        with self._lock:
+            return scene_id in self._resident
+
+    def load(self, scene_id):
+        """
+        Returns the resident LoadedScene for scene_id, loading it if needed.
+
+        Raises:
+            UnknownSceneError: If the scene is not registered.
+            FileNotFoundError: If the scene's files are missing.
+        """
+        with self._lock:
+            info = self.info(scene_id)
+            scene = self._resident.get(scene_id)
+            if scene is not None:
+                self._resident.move_to_end(scene_id)
+                return scene
+            future = self._loading.get(scene_id)
+            if future is not None:
+                owner = False
+            else:
+                future = self._loading[scene_id] = Future()
+                owner = True
+        if not owner:
+            return future.result()
+
+        try:
+            scene = self._read_scene(info)
+        except BaseException as e:
+            with self._lock:
+                if self._loading.get(scene_id) is future:
+                    del self._loading[scene_id]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            # A reload or re-registration while this load ran makes its result stale: hand it to the
+            # requests that waited for it, but do not keep it resident
+            if self._loading.get(scene_id) is future:
+                del self._loading[scene_id]
+                if info.bands != scene.info.bands and scene_id in self._scenes:
+                    self._scenes[scene_id] = replace(self._scenes[scene_id], bands=scene.info.bands)
+                self._resident[scene_id] = scene
+                self._resident_bytes += scene.nbytes
+                self.loads += 1
+                while self._resident_bytes > self.memory_budget_bytes and len(self._resident) > 1:
+                    self._drop(next(iter(self._resident)))
+                    self.evictions += 1
+        future.set_result(scene)
+        return scene
+
+    def _read_scene(self, info):
+        """Reads a scene's cube, ground truth, fingerprint and band statistics; runs without the registry lock."""
+        hypercube, ground_truth = load_hyperspectral_data(
+            self._data_folder(info), use_cache=self.use_cache, cache_folder=self.cache_folder,
+            cache_dtype=self.cache_dtype, hypercube_filename=info.hypercube_filename,
+            ground_truth_filename=info.ground_truth_filename)
+        if info.bands != hypercube.shape[2]:
+            info = replace(info, bands=int(hypercube.shape[2]))
+
+        # A cached cube's fingerprint comes from its header (source hashes); only uncached cubes are hashed
+        fingerprint, raw_checksums = None, None
+        if self.use_cache:
+            fingerprint = hypercube_cache_fingerprint(self.cache_folder, info.hypercube_filename, self.cache_dtype)
+            raw_checksums = raw_tile_checksums(self.cache_folder, info.hypercube_filename, self.cache_dtype)
+        if fingerprint is None:
+            fingerprint = fingerprint_array(hypercube)
+        # Band statistics come from the sidecar next to the cached cube, computed on first load only
+        stats_path = (statistics_cache_path(self.cache_folder, info.hypercube_filename, self.cache_dtype)
+                      if self.use_cache else None)
+        statistics = BandStatistics.load_or_compute(stats_path, hypercube, ground_truth, fingerprint)
+        in_memory = 0 if isinstance(hypercube, np.memmap) else hypercube.nbytes
+        return LoadedScene(info, hypercube, ground_truth, fingerprint, statistics,
+                           nbytes=int(in_memory + ground_truth.nbytes + statistics.nbytes),
+                           tile_checksums=raw_checksums[0] if raw_checksums else None,
+                           normalization=raw_checksums[1] if raw_checksums else None)
+
+    def evict(self, scene_id):
+        with self._lock:
+            return self._drop(scene_id)
+
+    def reload(self, scene_id):
+        """
+        Loads a scene again from its files, e.g. after they were replaced with an updated
+        acquisition; the normalized cache is rebuilt if the sources changed. Analyses of
+        the new cube re-classify only what changed (modules.incremental_inference).
+
+        Returns:
+            tuple: (the reloaded LoadedScene, fingerprint of the cube it replaced or None).
+        """
+        with self._lock:
+            self.info(scene_id)
+            previous = self._resident.get(scene_id)
+            self._loading.pop(scene_id, None)  # A load in progress may have read the old files
+            self._drop(scene_id)
+        return self.load(scene_id), previous.fingerprint if previous is not None else None
+
+    def _drop(self, scene_id):
+        scene = self._resident.pop(scene_id, None)
+        if scene is not None:
+            self._resident_bytes -= scene.nbytes
+        return scene is not None
+
+    def register_upload(self, name, hypercube_file, ground_truth_file=None, rgb_bands=RGB_BANDS,
+                        num_classes=16, model_path=None):
+        """
+        Stores an uploaded scene and registers it.
+
+        Args:
+            name (str): Display name; the scene id is derived from it.
+            hypercube_file: Binary file object with the cube's .mat content.
+            ground_truth_file: Optional binary file object with the labels' .mat content.
+            rgb_bands (tuple): Red, green and blue band indices.
+            num_classes (int): Number of classes in the ground truth.
+            model_path (str): Optional classifier trained for this scene.
+
+        Returns:
+            SceneInfo: The registered scene.
+        """
+        slug = re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_') or 'scene'
+        scene_id = f'upload_{slug}_{uuid.uuid4().hex[:8]}'
+        folder = os.path.join(self.upload_folder, scene_id)
+        os.makedirs(folder, exist_ok=True)
+
+        # Named after the scene id so their normalized caches do not collide
+        hypercube_filename = f'{scene_id}.mat'
+        ground_truth_filename = f'{scene_id}_gt.mat' if ground_truth_file is not None else None
+        files = {hypercube_filename: hypercube_file}
+        if ground_truth_file is not None:
+            files[ground_truth_filename] = ground_truth_file
+        for filename, source in files.items():
+            with open(os.path.join(folder, filename), 'wb') as f:
+                for chunk in iter(lambda: source.read(1 << 20), b''):
+                    f.write(chunk)
+
+        info = SceneInfo(scene_id, name, hypercube_filename, ground_truth_filename, data_folder=folder,
+                         rgb_bands=tuple(rgb_bands), num_classes=num_classes, model_path=model_path, uploaded=True)
+        self.register(info)
+        self._save_upload_index()
+        return info
+
+    def _load_upload_index(self):
+        path = os.path.join(self.upload_folder, UPLOADS_INDEX_FILENAME)
+        if not os.path.isfile(path):
+            return
+        with open(path) as f:
+            for entry in json.load(f):
+                entry['rgb_bands'] = tuple(entry['rgb_bands'])
+                self.register(SceneInfo(**entry))
+
+    def _save_upload_index(self):
+        with self._lock:
+            uploads = [info.to_dict() for info in self._scenes.values() if info.uploaded]
+        os.makedirs(self.upload_folder, exist_ok=True)
+        path = os.path.join(self.upload_folder, UPLOADS_INDEX_FILENAME)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(uploads, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        with self._lock:
+            return {'registered': len(self._scenes), 'resident': list(self._resident),
+                    'resident_bytes': self._resident_bytes, 'memory_budget_bytes': self.memory_budget_bytes,
+                    'loads': self.loads, 'evictions': self.evictions}
@@ -0,0 +1,354 @@
+import io
+import os
+import re
+import ast
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from modules.tiled_scene import TiledScene
+from modules.metrics import timed
+from modules.result_cache import cached_files, prune_oldest
+
+# Approximate AVIRIS band positions (Indian Pines / Salinas after water-band removal);
+# expressions may use these names or refer to any band as b<index>, e.g. b47.
+INDEX_BANDS = {'blue': 9, 'green': 19, 'red': 29, 'red_edge': 33, 'nir': 47}
+
+BUILTIN_INDICES = {
+    'ndvi': '(nir - red) / (nir + red)',             # Vegetation vigour
+    'ndwi': '(green - nir) / (green + nir)',         # Surface water / canopy water (McFeeters)
+    'ndre': '(nir - red_edge) / (nir + red_edge)',   # Red-edge chlorophyll, less saturated than NDVI
+    'savi': '1.5 * (nir - red) / (nir + red + 0.5)',  # Soil-adjusted vegetation index
+}
+
+# Element-wise functions an expression may call, and the number of arguments each takes
+INDEX_FUNCTIONS = {
+    'abs': np.abs, 'sqrt': np.sqrt, 'log': np.log, 'exp': np.exp,
+    'minimum': np.minimum, 'maximum': np.maximum,
+}
+INDEX_FUNCTION_ARITY = {'abs': 1, 'sqrt': 1, 'log': 1, 'exp': 1, 'minimum': 2, 'maximum': 2}
+MAX_EXPRESSION_LENGTH = 512
+
+# Wire formats for index rasters:
+#   f16 - little-endian float16, row-major (NaN where the index is undefined)
+#   f32 - little-endian float32, row-major
+#   png - 8-bit greyscale + alpha, values mapped linearly from X-Raster-Range (transparent = NaN)
+RASTER_MEDIA_TYPES = {'f16': 'application/octet-stream', 'f32': 'application/octet-stream', 'png': 'image/png'}
+RASTER_FORMATS = tuple(RASTER_MEDIA_TYPES)
+RASTER_HEADERS = ('X-Raster-Shape', 'X-Raster-Dtype', 'X-Raster-Encoding', 'X-Raster-Range')
+
+_BAND_NAME = re.compile(r'^b(\d+)$')
+_ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Constant,
+                  ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)
+
+class IndexExpressionError(ValueError):
+    """Raised for a band-math expression that cannot be compiled."""
+
+class SpectralIndex:
+    """
+    A band-math expression compiled once and evaluated over row blocks.
+
+    Expressions are parsed with ast and restricted to arithmetic, numeric
+    constants, the functions in INDEX_FUNCTIONS and band references (names in
+    INDEX_BANDS or b<index>); anything else is rejected before evaluation.
+    Only the referenced bands are read, the arithmetic runs on float32 arrays,
+    and values that are undefined (0/0, log of a negative) become NaN.
+    """
+
+    def __init__(self, expression, num_bands, band_names=INDEX_BANDS):
+        """
+        Args:
+            expression (str): E.g. '(nir - red) / (nir + red)' or '(b47 - b29) / (b47 + b29)'.
+            num_bands (int): Bands of the scene, to validate band references.
+            band_names (dict): Band names usable in the expression.
+
+        Raises:
+            IndexExpressionError: If the expression is malformed or not allowed.
+        """
+        if len(expression) > MAX_EXPRESSION_LENGTH:
+            raise IndexExpressionError(f'Expression is longer than {MAX_EXPRESSION_LENGTH} characters.')
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise IndexExpressionError(f'Invalid expression: {e.msg}.')
+
+        variables = {}
+        called = set()  # Name nodes called as functions; ast.walk visits a Call before its func
+        for node in ast.walk(tree):
+            if not isinstance(node, _ALLOWED_NODES):
+                raise IndexExpressionError(f'\'{type(node).__name__}\' is not allowed in index expressions.')
+            if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise IndexExpressionError('Only numeric constants are allowed.')
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in INDEX_FUNCTIONS or node.keywords:
+                    raise IndexExpressionError(f'Only these functions are allowed: {sorted(INDEX_FUNCTIONS)}.')
+                # NumPy ufuncs take extra positional arguments as out= / where=, so the count must be exact
+                arity = INDEX_FUNCTION_ARITY[node.func.id]
+                if len(node.args) != arity:
+                    raise IndexExpressionError(f'{node.func.id}() takes {arity} argument{"s" if arity > 1 else ""}, '
+                                               f'got {len(node.args)}.')
+                called.add(id(node.func))
+            elif isinstance(node, ast.Name) and node.id in INDEX_FUNCTIONS:
+                if id(node) not in called:
+                    raise IndexExpressionError(f'{node.id} is a function; call it as {node.id}(...).')
+            elif isinstance(node, ast.Name):
+                variables[node.id] = self._band_index(node.id, num_bands, band_names)
+
+        self.expression = ast.unparse(tree)
+        self.band_map = dict(sorted(variables.items()))  # Name in the expression -> band index
+        self.bands = sorted(set(variables.values()))
+        self._variables = {name: self.bands.index(band) for name, band in variables.items()}
+
+        # Constants become float32 values too, so constant-only terms (e.g. 10 ** 10 ** 10)
+        # overflow to inf like everything else instead of running as Python big-int arithmetic
+        self._constants = {}
+        for node in ast.walk(tree):
+            for field, value in ast.iter_fields(node):
+                if isinstance(value, ast.Constant):
+                    name = f'_c{len(self._constants)}'
+                    self._constants[name] = np.float32(value.value)
+                    setattr(node, field, ast.copy_location(ast.Name(id=name, ctx=ast.Load()), value))
+        self._code = compile(ast.fix_missing_locations(tree), '<spectral index>', 'eval')
+
+    @staticmethod
+    def _band_index(name, num_bands, band_names):
+        match = _BAND_NAME.match(name)
+        if match:
+            band = int(match.group(1))
+        elif name in band_names:
+            band = band_names[name]
+        else:
+            raise IndexExpressionError(f'Unknown band \'{name}\'. Use b<index> or one of {sorted(band_names)}.')
+        if not 0 <= band < num_bands:
+            raise IndexExpressionError(f'Band {name} ({band}) is outside the scene\'s {num_bands} bands.')
+        return band
+
+    def evaluate(self, window):
+        """Evaluates the expression on a (..., len(self.bands)) float32 array of the referenced bands."""
+        namespace = {name: window[..., position] for name, position in self._variables.items()}
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            values = eval(self._code, {'__builtins__': {}, **INDEX_FUNCTIONS, **self._constants}, namespace)
+        values = np.broadcast_to(np.asarray(values, dtype=np.float32), window.shape[:-1]).copy()
+        values[~np.isfinite(values)] = np.nan
+        return values
+
+    def compute(self, hypercube):
+        """The (height, width) float32 index raster of a cube or TiledScene, computed block by block."""
+        scene = hypercube if isinstance(hypercube, TiledScene) else TiledScene(hypercube)
+        raster = np.empty((scene.height, scene.width), dtype=np.float32)
+        for r0, r1, window in scene.iter_windows(bands=self.bands or [0]):
+            raster[r0:r1] = self.evaluate(window)
+        return raster
+
+def resolve_index(index=None, expression=None, num_bands=None):
+    """
+    Compiles a built-in index by name or a user expression.
+
+    Returns:
+        tuple: (name, SpectralIndex); the name is 'custom' for expressions.
+    """
+    if expression:
+        return 'custom', SpectralIndex(expression, num_bands)
+    index = (index or 'ndvi').lower()
+    if index not in BUILTIN_INDICES:
+        raise IndexExpressionError(f'Unknown index \'{index}\'. Expected one of {sorted(BUILTIN_INDICES)} or an expression.')
+    return index, SpectralIndex(BUILTIN_INDICES[index], num_bands)
+
+def index_cache_key(cube_fingerprint, spectral_index):
+    """Key of one index raster: cube content + normalized expression + the bands its names resolve to."""
+    payload = f'{cube_fingerprint}|{spectral_index.expression}|{spectral_index.band_map}'
+    return hashlib.blake2b(payload.encode(), digest_size=20).hexdigest()
+
+class IndexCache:
+    """
+    Index rasters keyed by scene content and expression: a byte-bounded in-memory
+    LRU in front of .npy files. Cached rasters are returned read-only. Any
+    ?expression= creates an entry, so the disk copy is bounded as well: the oldest
+    files are removed once max_disk_bytes is exceeded.
+    """
+
+    def __init__(self, cache_folder, max_memory_bytes=128 * 1024 * 1024, max_disk_bytes=1024 * 1024 * 1024):
+        self.cache_folder = cache_folder
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self._computing = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_folder, f'{key}.npy')
+
+    def _remember(self, key, raster):
+        if raster.nbytes > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key).nbytes
+        self._memory[key] = raster
+        self._memory_bytes += raster.nbytes
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+
+    def get(self, key):
+        with self._lock:
+            raster = self._memory.get(key)
+            if raster is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return raster
+        try:
+            raster = np.load(self._path(key))
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        raster.flags.writeable = False
+        with self._lock:
+            self._remember(key, raster)
+            self.hits += 1
+        return raster
+
+    def put(self, key, raster):
+        raster = np.array(raster, dtype=np.float32)
+        raster.flags.writeable = False
+        os.makedirs(self.cache_folder, exist_ok=True)
+        tmp_path = f'{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, raster)
+            nbytes = f.tell()
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self._remember(key, raster)
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in cached_files(self.cache_folder, '.npy'))
+            else:
+                self._disk_bytes += nbytes
+            if self._disk_bytes > self.max_disk_bytes:
+                self._disk_bytes = prune_oldest(self.cache_folder, '.npy', self.max_disk_bytes)
+        return raster
+
+    def get_or_compute(self, key, compute):
+        """The cached raster for key, or compute() stored under it; concurrent callers share one computation."""
+        raster = self.get(key)
+        if raster is not None:
+            return raster
+        with self._lock:
+            lock = self._computing.setdefault(key, threading.Lock())
+        with lock:
+            raster = self.get(key)
+            if raster is None:
+                raster = self.put(key, compute())
+        with self._lock:
+            self._computing.pop(key, None)
+        return raster
+
+    def stats(self):
+        with self._lock:
+            return {'entries_in_memory': len(self._memory), 'memory_bytes': self._memory_bytes,
+                    'max_memory_bytes': self.max_memory_bytes, 'disk_bytes': self._disk_bytes,
+                    'max_disk_bytes': self.max_disk_bytes, 'hits': self.hits, 'misses': self.misses}
+
+def raster_summary(raster):
+    """Overall statistics of an index raster, ignoring NaN."""
+    valid = raster[np.isfinite(raster)]
+    if not valid.size:
+        return {'pixels': int(raster.size), 'valid': 0, 'mean': None, 'std': None, 'min': None, 'max': None}
+    return {'pixels': int(raster.size), 'valid': int(valid.size), 'mean': float(valid.mean(dtype=np.float64)),
+            'std': float(valid.std(dtype=np.float64)), 'min': float(valid.min()), 'max': float(valid.max())}
+
+def zonal_summary(raster, zones, include_zero=False):
+    """
+    Per-zone statistics of an index raster (zones: a label map such as the ground
+    truth or a prediction map), computed with bincount / reduceat rather than a
+    loop over zones.
+
+    Returns:
+        dict: {label: {'pixels', 'valid', 'mean', 'std', 'min', 'max'}} for each label present.
+    """
+    values = raster.ravel()
+    labels = np.asarray(zones).ravel().astype(np.int64)
+    valid = np.isfinite(values)
+    valid_labels, valid_values = labels[valid], values[valid].astype(np.float64)
+
+    n = int(labels.max()) + 1 if labels.size else 1
+    pixels = np.bincount(labels, minlength=n)
+    count = np.bincount(valid_labels, minlength=n)
+    total = np.bincount(valid_labels, weights=valid_values, minlength=n)
+    squares = np.bincount(valid_labels, weights=valid_values * valid_values, minlength=n)
+
+    # Min / max per zone from one stable sort by label
+    order = np.argsort(valid_labels, kind='stable')
+    sorted_values = valid_values[order]
+    present = np.flatnonzero(count)
+    starts = np.concatenate(([0], np.cumsum(count)[:-1]))[present]
+    minimum = np.minimum.reduceat(sorted_values, starts) if present.size else []
+    maximum = np.maximum.reduceat(sorted_values, starts) if present.size else []
+    extremes = {int(label): (float(lo), float(hi)) for label, lo, hi in zip(present, minimum, maximum)}
+
+    summary = {}
+    for label in np.flatnonzero(pixels):
+        label = int(label)
+        if label == 0 and not include_zero:
+            continue
+        if count[label]:
+            mean = total[label] / count[label]
+            std = float(np.sqrt(max(squares[label] / count[label] - mean ** 2, 0.0)))
+            low, high = extremes[label]
+            summary[label] = {'pixels': int(pixels[label]), 'valid': int(count[label]), 'mean': float(mean),
+                              'std': std, 'min': low, 'max': high}
+        else:
+            summary[label] = {'pixels': int(pixels[label]), 'valid': 0, 'mean': None, 'std': None,
+                              'min': None, 'max': None}
+    return summary
+
+def encode_raster(raster, fmt='f16', value_range=None):
+    """
+    Serializes an index raster.
+
+    Args:
+        raster (np.ndarray): The (height, width) float32 raster.
+        fmt (str): One of RASTER_FORMATS.
+        value_range (tuple): (low, high) mapped to 0..255 for 'png'. Defaults to (-1, 1),
+            the range of normalized-difference indices.
+
+    Returns:
+        tuple: (body, media_type, headers).
+    """
+    if fmt not in RASTER_FORMATS:
+        raise ValueError(f'Unknown raster format \'{fmt}\'. Expected one of {RASTER_FORMATS}.')
+    headers = {'X-Raster-Shape': ','.join(str(n) for n in raster.shape), 'X-Raster-Encoding': fmt}
+    if fmt in ('f16', 'f32'):
+        data = np.ascontiguousarray(raster, dtype='<f2' if fmt == 'f16' else '<f4')
+        headers['X-Raster-Dtype'] = data.dtype.name
+        return data.tobytes(), RASTER_MEDIA_TYPES[fmt], headers
+
+    low, high = value_range or (-1.0, 1.0)
+    valid = np.isfinite(raster)
+    scaled = (np.where(valid, raster, low) - low) * (255 / ((high - low) or 1.0))
+    image = np.empty(raster.shape + (2,), dtype=np.uint8)  # Pillow reads (h, w, 2) uint8 as LA
+    image[..., 0] = np.clip(np.rint(scaled), 0, 255)
+    image[..., 1] = np.where(valid, 255, 0)
+    buffer = io.BytesIO()
+    with timed('png_encode'):
+        Image.fromarray(image).save(buffer, format='PNG', compress_level=1)
+    headers.update({'X-Raster-Dtype': 'uint8', 'X-Raster-Range': f'{low:g},{high:g}'})
+    return buffer.getvalue(), RASTER_MEDIA_TYPES[fmt], headers
+
+def decode_raster(body, headers):
+    """Inverse of encode_raster (PNG values are de-quantized), for Python clients and round-trip checks."""
+    fmt = headers['X-Raster-Encoding']
+    shape = tuple(int(n) for n in headers['X-Raster-Shape'].split(','))
+    if fmt in ('f16', 'f32'):
+        return np.frombuffer(body, dtype='<f2' if fmt == 'f16' else '<f4').reshape(shape).astype(np.float32)
+    low, high = (float(v) for v in headers['X-Raster-Range'].split(','))
+    image = np.asarray(Image.open(io.BytesIO(body)).convert('LA'))
+    raster = low + image[..., 0].astype(np.float32) * ((high - low) / 255)
+    raster[image[..., 1] == 0] = np.nan
+    return raster.reshape(shape)
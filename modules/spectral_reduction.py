@@ -0,0 +1,257 @@
+import os
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from sklearn.model_selection import train_test_split
+
+from modules.tiled_scene import TiledScene
+
+# Optional spectral reduction stage in front of CropClassifier:
+#   pca    - projection onto the leading principal components of the training pixels
+#   bands  - the most class-separable bands (Fisher score), kept in spectral order
+# A fitted reducer is stored next to the model weights (models/crop_classifier.reduction.npz)
+# and applied in prepare_training_data, run_prediction and the inference engine.
+REDUCTION_METHODS = ('pca', 'bands')
+REDUCTION_FORMAT_VERSION = 1
+MIN_COMPONENTS = 4  # The CNN pools the spectral axis twice
+FIT_MAX_PIXELS = 50000  # Training pixels sampled for fitting
+
+class SpectralReducer:
+    """Maps (..., bands) spectra to (..., components) with a fitted PCA or band selection."""
+
+    def __init__(self, method, input_bands, mean=None, projection=None, band_indices=None):
+        if method not in REDUCTION_METHODS:
+            raise ValueError(f'Unknown reduction method \'{method}\'. Expected one of {REDUCTION_METHODS}.')
+        self.method = method
+        self.input_bands = int(input_bands)
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float32)
+        self.projection = None if projection is None else np.asarray(projection, dtype=np.float32)
+        self.band_indices = None if band_indices is None else np.asarray(band_indices, dtype=np.int64)
+
+    @property
+    def components(self):
+        return self.projection.shape[1] if self.method == 'pca' else len(self.band_indices)
+
+    @classmethod
+    def fit(cls, hypercube, coords, labels=None, components=30, method='pca', max_pixels=FIT_MAX_PIXELS, seed=0):
+        """
+        Fits a reducer on training pixels only.
+
+        Args:
+            hypercube (np.ndarray): The (height, width, bands) cube.
+            coords (np.ndarray): (n, 2) (row, col) coordinates of the training pixels.
+            labels (np.ndarray): Their class labels; required for 'bands'.
+            components (int): Output spectral depth.
+            method (str): One of REDUCTION_METHODS.
+            max_pixels (int): At most this many pixels are sampled for the fit.
+            seed (int): Sampling seed.
+        """
+        bands = hypercube.shape[2]
+        if not MIN_COMPONENTS <= components <= bands:
+            raise ValueError(f'components must be between {MIN_COMPONENTS} and {bands}, got {components}.')
+        coords = np.asarray(coords)
+        if len(coords) > max_pixels:
+            keep = np.sort(np.random.default_rng(seed).choice(len(coords), max_pixels, replace=False))
+            coords = coords[keep]
+            labels = None if labels is None else np.asarray(labels)[keep]
+        order = np.lexsort((coords[:, 1], coords[:, 0]))
+        spectra = np.asarray(hypercube[coords[order, 0], coords[order, 1]], dtype=np.float64)
+
+        if method == 'pca':
+            mean = spectra.mean(axis=0)
+            centered = spectra - mean
+            eigenvalues, eigenvectors = np.linalg.eigh(centered.T @ centered / max(len(spectra) - 1, 1))
+            leading = eigenvectors[:, np.argsort(eigenvalues)[::-1][:components]]
+            # Fix each component's sign so refits on the same pixels give the same projection
+            leading *= np.where(leading[np.abs(leading).argmax(axis=0), np.arange(components)] < 0, -1, 1)
+            return cls('pca', bands, mean=mean, projection=leading)
+
+        if method == 'bands':
+            if labels is None:
+                raise ValueError('Band selection needs the training labels.')
+            labels = np.asarray(labels)[order]
+            overall = spectra.mean(axis=0)
+            between, within = np.zeros(bands), np.zeros(bands)
+            for label in np.unique(labels):
+                members = spectra[labels == label]
+                between += len(members) * (members.mean(axis=0) - overall) ** 2
+                within += ((members - members.mean(axis=0)) ** 2).sum(axis=0)
+            fisher = between / np.maximum(within, 1e-12)
+            return cls('bands', bands, band_indices=np.sort(np.argsort(fisher)[::-1][:components]))
+
+        raise ValueError(f'Unknown reduction method \'{method}\'. Expected one of {REDUCTION_METHODS}.')
+
+    def transform(self, spectra):
+        """Reduces a (..., input_bands) array to (..., components) float32."""
+        if spectra.shape[-1] != self.input_bands:
+            raise ValueError(f'Reducer was fitted on {self.input_bands} bands, got {spectra.shape[-1]}.')
+        if self.method == 'bands':
+            return np.asarray(spectra[..., self.band_indices], dtype=np.float32)
+        flat = np.asarray(spectra, dtype=np.float32).reshape(-1, self.input_bands)
+        return ((flat - self.mean) @ self.projection).reshape(spectra.shape[:-1] + (self.components,))
+
+    def transform_cube(self, hypercube, mask=None, halo=0, tile_size=32):
+        """
+        Reduces a whole cube or TiledScene block by block into an in-memory (height, width, components) cube.
+
+        With a (height, width) boolean mask only the tile_size x tile_size tiles within
+        halo pixels of a selected pixel are read and reduced, which covers the patches
+        of the selected pixels; the rest of the reduced cube is left zero.
+        """
+        scene = hypercube if isinstance(hypercube, TiledScene) else TiledScene(hypercube)
+        bands = list(self.band_indices) if self.method == 'bands' else None
+        if mask is None:
+            reduced = np.empty((scene.height, scene.width, self.components), dtype=np.float32)
+            for r0, r1, window in scene.iter_windows(bands=bands):
+                reduced[r0:r1] = window if bands is not None else self.transform(window)
+            return reduced
+
+        # Selected pixels of any rectangle from the summed-area table of the mask
+        reduced = np.zeros((scene.height, scene.width, self.components), dtype=np.float32)
+        selected = np.pad(np.asarray(mask, dtype=np.int64).cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+        for r0 in range(0, scene.height, tile_size):
+            r1 = min(r0 + tile_size, scene.height)
+            a, b = max(r0 - halo, 0), min(r1 + halo, scene.height)
+            for c0 in range(0, scene.width, tile_size):
+                c1 = min(c0 + tile_size, scene.width)
+                c, d = max(c0 - halo, 0), min(c1 + halo, scene.width)
+                if selected[b, d] - selected[a, d] - selected[b, c] + selected[a, c]:
+                    window = scene.read_window(r0, r1, c0, c1, bands=bands)
+                    reduced[r0:r1, c0:c1] = window if bands is not None else self.transform(window)
+        return reduced
+
+    def state_dict(self):
+        """Fitted parameters as tensors, e.g. to fold the reducer into a model fingerprint."""
+        state = {'reduction.method': self.method, 'reduction.input_bands': self.input_bands}
+        for name in ('mean', 'projection', 'band_indices'):
+            value = getattr(self, name)
+            if value is not None:
+                state[f'reduction.{name}'] = torch.from_numpy(np.ascontiguousarray(value))
+        return state
+
+    def save(self, path):
+        arrays = {name: getattr(self, name) for name in ('mean', 'projection', 'band_indices')
+                  if getattr(self, name) is not None}
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, version=REDUCTION_FORMAT_VERSION, method=self.method, input_bands=self.input_bands, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['version']) != REDUCTION_FORMAT_VERSION:
+                raise ValueError(f'Unsupported spectral reduction file version in {path}.')
+            return cls(str(data['method']), int(data['input_bands']),
+                       **{name: data[name] for name in ('mean', 'projection', 'band_indices') if name in data})
+
+def reducer_path(model_path):
+    """Where a model's reducer is stored (models/crop_classifier.pth -> models/crop_classifier.reduction.npz)."""
+    root, _ = os.path.splitext(model_path)
+    return f'{root}.reduction.npz'
+
+def load_reducer(model_path):
+    """The reducer saved with a model, or None if the model takes the full spectrum."""
+    path = reducer_path(model_path)
+    return SpectralReducer.load(path) if os.path.isfile(path) else None
+
+def parse_reduction(spec):
+    """'pca:30' / 'bands:40' -> ('pca', 30); '' or 'none' -> None."""
+    if not spec or spec.lower() == 'none':
+        return None
+    method, _, components = spec.partition(':')
+    if method not in REDUCTION_METHODS or not components.isdigit():
+        raise ValueError(f'Expected <method>:<components> with method in {REDUCTION_METHODS}, got \'{spec}\'.')
+    return method, int(components)
+
+def benchmark_reduction(hypercube, ground_truth, settings, epochs=5, batch_size=64, max_pixels=4000, seed=42):
+    """
+    Trains a CropClassifier per reduction setting on the same split of labeled
+    pixels and reports validation accuracy, training time and inference throughput.
+
+    Args:
+        settings (list): (method, components) pairs; (None, None) is the full spectrum.
+        max_pixels (int): Labeled pixels used (split 80/20), to keep the runs short.
+
+    Returns:
+        list: One dict per setting.
+    """
+    from modules.model_handler import CropClassifier, prepare_training_data
+
+    coords = np.argwhere(ground_truth > 0)
+    rng = np.random.default_rng(seed)
+    if max_pixels and len(coords) > max_pixels:
+        coords = coords[np.sort(rng.choice(len(coords), max_pixels, replace=False))]
+    labels = ground_truth[coords[:, 0], coords[:, 1]].astype(np.int64) - 1
+    train_idx, test_idx = train_test_split(np.arange(len(coords)), test_size=0.2, random_state=seed)
+    num_classes = int(ground_truth.max())
+
+    # Only the sampled pixels are labeled, so prepare_training_data cuts just their patches
+    sampled_truth = np.zeros_like(ground_truth)
+    sampled_truth[coords[:, 0], coords[:, 1]] = labels + 1
+
+    results = []
+    for method, components in settings:
+        torch.manual_seed(seed)
+        start = time.perf_counter()
+        reducer = None
+        if method is not None:
+            reducer = SpectralReducer.fit(hypercube, coords[train_idx], labels[train_idx], components, method)
+        fit_seconds = time.perf_counter() - start
+
+        X, y = prepare_training_data(hypercube, sampled_truth, reducer)
+        # prepare_training_data orders pixels like np.argwhere, which is how coords were drawn
+        model = CropClassifier(num_classes, num_bands=X.shape[-1])
+        optimizer = optim.Adam(model.parameters(), lr=0.001)
+        criterion = nn.CrossEntropyLoss()
+
+        start = time.perf_counter()
+        for _ in range(epochs):
+            model.train()
+            for batch in np.array_split(rng.permutation(train_idx), max(1, len(train_idx) // batch_size)):
+                optimizer.zero_grad()
+                loss = criterion(model(X[batch]), y[batch])
+                loss.backward()
+                optimizer.step()
+        train_seconds = time.perf_counter() - start
+
+        model.eval()
+        correct = 0
+        start = time.perf_counter()
+        with torch.no_grad():
+            for batch in np.array_split(test_idx, max(1, len(test_idx) // 256)):
+                correct += int((model(X[batch]).argmax(dim=1) == y[batch]).sum())
+        inference_seconds = time.perf_counter() - start
+
+        results.append({
+            'method': method or 'none',
+            'components': X.shape[-1],
+            'accuracy': correct / len(test_idx),
+            'fit_seconds': fit_seconds,
+            'train_seconds': train_seconds,
+            'pixels_per_second': len(test_idx) / inference_seconds,
+        })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit a spectral reduction for CropClassifier or benchmark component counts.')
+    parser.add_argument('--data-folder', default='data')
+    parser.add_argument('--method', choices=REDUCTION_METHODS, default='pca')
+    parser.add_argument('--components', type=int, nargs='+', default=[10, 20, 30, 50])
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--max-pixels', type=int, default=4000)
+    args = parser.parse_args()
+
+    from modules.data_handler import load_hyperspectral_data
+    hypercube, ground_truth = load_hyperspectral_data(args.data_folder)
+    settings = [(None, None)] + [(args.method, n) for n in args.components]
+    print(f"{'method':<8}{'components':>11}{'accuracy':>10}{'fit s':>8}{'train s':>9}{'pixels/s':>11}")
+    for row in benchmark_reduction(hypercube, ground_truth, settings, epochs=args.epochs, max_pixels=args.max_pixels):
+        print(f"{row['method']:<8}{row['components']:>11}{row['accuracy']:>10.4f}{row['fit_seconds']:>8.2f}"
+              f"{row['train_seconds']:>9.1f}{row['pixels_per_second']:>11.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import json
+
+import numpy as np
+
+MAX_POINTS = 10000  # Pixels per batch request
+MAX_REGIONS = 256   # Rectangles / polygons per batch request
+REGION_CHUNK_ROWS = 64  # Rows of a region's bounding box reduced at a time
+
+# Binary payload of a batch: little-endian float32 blocks, in this order,
+#   point spectra (points x bands), region means (regions x bands), region stds (regions x bands)
+SIGNATURE_MEDIA_TYPE = 'application/octet-stream'
+SIGNATURE_HEADERS = ('X-Spectra-Shape', 'X-Spectra-Layout', 'X-Regions')
+
+def point_spectra(hypercube, points):
+    """
+    Spectra of many pixels in one fancy-indexing read.
+
+    Args:
+        hypercube (np.ndarray): The (height, width, bands) cube.
+        points (list): (x, y) pixel coordinates; x is the column, y the row.
+
+    Returns:
+        np.ndarray: (len(points), bands) float32 spectra, in the order given.
+
+    Raises:
+        ValueError: If a point lies outside the scene.
+    """
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    height, width, bands = hypercube.shape
+    if len(points) > MAX_POINTS:
+        raise ValueError(f'At most {MAX_POINTS} points per request, got {len(points)}.')
+    outside = (points[:, 0] < 0) | (points[:, 0] >= width) | (points[:, 1] < 0) | (points[:, 1] >= height)
+    if outside.any():
+        x, y = points[np.argmax(outside)]
+        raise ValueError(f'Point ({x}, {y}) is outside the {width}x{height} scene.')
+
+    # Reading in row-major order keeps a memory-mapped cube's page accesses sequential
+    order = np.lexsort((points[:, 0], points[:, 1]))
+    spectra = np.empty((len(points), bands), dtype=np.float32)
+    spectra[order] = hypercube[points[order, 1], points[order, 0]]
+    return spectra
+
+def check_box(x0, y0, x1, y1):
+    """
+    Raises ValueError unless x0 < x1 and y0 < y1 (x1 / y1 exclusive); an empty or
+    inverted box is rejected rather than reordered.
+    """
+    if x0 >= x1 or y0 >= y1:
+        raise ValueError('Box is empty or inverted: x0 < x1 and y0 < y1 are required (x1 / y1 exclusive).')
+
+def clip_box(x0, y0, x1, y1, height, width):
+    """
+    Rows [r0, r1) and columns [c0, c1) of a box clipped to the scene at both ends,
+    so a box partly or wholly outside selects only what lies inside (possibly nothing).
+
+    Returns:
+        tuple: (r0, r1, c0, c1).
+    """
+    r0, r1 = min(max(y0, 0), height), min(max(y1, 0), height)
+    c0, c1 = min(max(x0, 0), width), min(max(x1, 0), width)
+    return r0, max(r1, r0), c0, max(c1, c0)
+
+def parse_vertices(points):
+    """
+    Polygon vertices from [[x, y], ...] as an (n, 2) float64 array.
+
+    Raises:
+        ValueError: For malformed or non-finite coordinates or fewer than three vertices.
+    """
+    try:
+        vertices = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    except (TypeError, ValueError):
+        raise ValueError('A polygon must be a list of [x, y] vertices.')
+    if len(vertices) < 3:
+        raise ValueError('A polygon needs at least three vertices.')
+    if not np.isfinite(vertices).all():
+        raise ValueError('Polygon vertices must be finite numbers.')
+    return vertices
+
+def polygon_box(vertices, height, width):
+    """(r0, r1, c0, c1) of the pixels a polygon's bounding box covers, clipped as clip_box."""
+    return clip_box(int(np.floor(vertices[:, 0].min())), int(np.floor(vertices[:, 1].min())),
+                    int(np.ceil(vertices[:, 0].max())) + 1, int(np.ceil(vertices[:, 1].max())) + 1, height, width)
+
+def polygon_mask(vertices, r0, r1, c0, c1):
+    """
+    Pixels of the box [r0, r1) x [c0, c1) whose centres lie inside a polygon
+    (even-odd rule), vectorised over the box with one pass per edge.
+
+    Args:
+        vertices (np.ndarray): (n, 2) polygon vertices as (x, y) pixel coordinates.
+    """
+    ys, xs = np.mgrid[r0:r1, c0:c1]
+    inside = np.zeros(ys.shape, dtype=bool)
+    x_start, y_start = vertices[:, 0], vertices[:, 1]
+    x_end, y_end = np.roll(x_start, -1), np.roll(y_start, -1)
+    for xa, ya, xb, yb in zip(x_start, y_start, x_end, y_end):
+        if ya == yb:
+            continue
+        crosses = (ya > ys) != (yb > ys)
+        x_cross = xa + (ys - ya) * (xb - xa) / (yb - ya)
+        inside ^= crosses & (xs < x_cross)
+    return inside
+
+def _region_box(region, height, width):
+    """(r0, r1, c0, c1, mask or None) of a region description, clipped to the scene."""
+    kind = region.get('type', 'rect')
+    if kind == 'rect':
+        try:
+            x0, y0, x1, y1 = (int(region[key]) for key in ('x0', 'y0', 'x1', 'y1'))
+        except (KeyError, TypeError, ValueError, OverflowError):
+            raise ValueError('Rectangles need integer x0, y0, x1, y1 (x1 / y1 exclusive).')
+        check_box(x0, y0, x1, y1)
+        return clip_box(x0, y0, x1, y1, height, width) + (None,)
+    if kind == 'polygon':
+        if 'points' not in region:
+            raise ValueError('Polygons need points: a list of [x, y] vertices.')
+        vertices = parse_vertices(region['points'])
+        r0, r1, c0, c1 = polygon_box(vertices, height, width)
+        if r0 >= r1 or c0 >= c1:
+            return r0, r0, c0, c0, None
+        return r0, r1, c0, c1, polygon_mask(vertices, r0, r1, c0, c1)
+    raise ValueError(f'Unknown region type \'{kind}\'. Expected \'rect\' or \'polygon\'.')
+
+def region_statistics(hypercube, region):
+    """
+    Mean and standard deviation spectra of the pixels in a rectangle or polygon,
+    reduced REGION_CHUNK_ROWS rows of its bounding box at a time in float64.
+
+    Args:
+        hypercube (np.ndarray): The (height, width, bands) cube.
+        region (dict): {'type': 'rect', 'x0', 'y0', 'x1', 'y1'} (x1 / y1 exclusive) or
+            {'type': 'polygon', 'points': [[x, y], ...]}; an optional 'id' is echoed back.
+
+    Returns:
+        dict: {'id', 'pixels', 'bbox', 'mean', 'std'}; mean / std are (bands,) float64
+            arrays, NaN for a region with no pixels inside the scene.
+    """
+    height, width, bands = hypercube.shape
+    r0, r1, c0, c1, mask = _region_box(region, height, width)
+    total = np.zeros(bands)
+    squares = np.zeros(bands)
+    pixels = 0
+    for start in range(r0, r1, REGION_CHUNK_ROWS):
+        stop = min(start + REGION_CHUNK_ROWS, r1)
+        block = np.asarray(hypercube[start:stop, c0:c1], dtype=np.float64)
+        selected = block.reshape(-1, bands) if mask is None else block[mask[start - r0:stop - r0]]
+        total += selected.sum(axis=0)
+        squares += np.einsum('ij,ij->j', selected, selected)
+        pixels += len(selected)
+
+    if pixels:
+        mean = total / pixels
+        std = np.sqrt(np.maximum(squares / pixels - mean ** 2, 0))
+    else:
+        mean = std = np.full(bands, np.nan)
+    return {'id': region.get('id'), 'pixels': pixels, 'bbox': [c0, r0, c1, r1], 'mean': mean, 'std': std}
+
+def batch_signatures(hypercube, points=(), regions=()):
+    """
+    Spectra of many pixels and mean / std spectra of many regions in one call.
+
+    Returns:
+        tuple: (point spectra as a (points, bands) float32 array, list of region_statistics dicts).
+
+    Raises:
+        ValueError: For malformed or out-of-range points and regions.
+    """
+    if len(regions) > MAX_REGIONS:
+        raise ValueError(f'At most {MAX_REGIONS} regions per request, got {len(regions)}.')
+    if not len(points) and not len(regions):
+        raise ValueError('Give at least one point or region.')
+    spectra = point_spectra(hypercube, points) if len(points) else np.zeros((0, hypercube.shape[2]), dtype=np.float32)
+    return spectra, [region_statistics(hypercube, region) for region in regions]
+
+def signatures_to_dict(spectra, regions):
+    """JSON payload of batch_signatures' result (NaN becomes null)."""
+    def values(array):
+        return [None if np.isnan(v) else float(v) for v in array]
+    return {
+        'spectra': spectra.tolist(),
+        'regions': [{'id': region['id'], 'pixels': region['pixels'], 'bbox': region['bbox'],
+                     'mean': values(region['mean']), 'std': values(region['std'])} for region in regions],
+    }
+
+def encode_signatures(spectra, regions):
+    """
+    Binary payload of batch_signatures' result: one float32 buffer (see the layout
+    above) plus headers giving its shape and the regions' ids, pixel counts and boxes.
+
+    Returns:
+        tuple: (body, media_type, headers).
+    """
+    bands = spectra.shape[1]
+    means = np.array([region['mean'] for region in regions], dtype='<f4').reshape(-1, bands)
+    stds = np.array([region['std'] for region in regions], dtype='<f4').reshape(-1, bands)
+    body = np.ascontiguousarray(spectra, dtype='<f4').tobytes() + means.tobytes() + stds.tobytes()
+    headers = {
+        'X-Spectra-Shape': f'{len(spectra)},{len(regions)},{bands}',
+        'X-Spectra-Layout': 'points,region_mean,region_std',
+        'X-Regions': json.dumps([{'id': region['id'], 'pixels': region['pixels'], 'bbox': region['bbox']}
+                                 for region in regions], separators=(',', ':')),
+    }
+    return body, SIGNATURE_MEDIA_TYPE, headers
+
+def decode_signatures(body, headers):
+    """Inverse of encode_signatures: (point spectra, region means, region stds)."""
+    points, regions, bands = (int(n) for n in headers['X-Spectra-Shape'].split(','))
+    values = np.frombuffer(body, dtype='<f4')
+    spectra = values[:points * bands].reshape(points, bands)
+    means = values[points * bands:(points + regions) * bands].reshape(regions, bands)
+    stds = values[(points + regions) * bands:].reshape(regions, bands)
+    return spectra, means, stds
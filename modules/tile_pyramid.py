@@ -0,0 +1,271 @@
+import io
+import os
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from modules.data_handler import stretch_to_uint8, create_rgb_visualization, RGB_BANDS
+from modules.tiled_scene import TiledScene, band_percentiles
+from modules.metrics import timed
+from modules.result_cache import cached_files, prune_oldest
+
+TILE_SIZE = 256
+DEFAULT_PERCENTILES = (2, 98)
+TILE_CACHE_VERSION = 2  # Part of every tile key and ETag; bump when rendering or the stretch estimate changes
+
+def max_zoom(height, width, tile_size=TILE_SIZE):
+    """Zoom level at which one tile pixel is one scene pixel; zoom 0 fits the scene in one tile."""
+    return max(0, math.ceil(math.log2(max(height, width) / tile_size)))
+
+def parse_style(rgb_bands=None, percentiles=None):
+    """Validates band indices and stretch percentiles given as 'r,g,b' / 'low,high' strings or tuples."""
+    if isinstance(rgb_bands, str):
+        rgb_bands = [int(b) for b in rgb_bands.split(',')]
+    if isinstance(percentiles, str):
+        percentiles = [float(p) for p in percentiles.split(',')]
+    rgb_bands = tuple(int(b) for b in (rgb_bands or RGB_BANDS))
+    percentiles = tuple(float(p) for p in (percentiles or DEFAULT_PERCENTILES))
+    if len(rgb_bands) != 3:
+        raise ValueError('Expected three band indices (red, green, blue).')
+    if len(percentiles) != 2 or not 0 <= percentiles[0] < percentiles[1] <= 100:
+        raise ValueError('Expected two percentiles with 0 <= low < high <= 100.')
+    return rgb_bands, percentiles
+
+class TileCache:
+    """
+    PNG bytes keyed by string, in a byte-bounded in-memory LRU backed by files
+    under cache_folder. The disk copy is bounded too: the oldest files are
+    removed once max_disk_bytes is exceeded.
+    """
+
+    def __init__(self, cache_folder, max_memory_bytes=64 * 1024 * 1024, max_disk_bytes=512 * 1024 * 1024):
+        self.cache_folder = cache_folder
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_folder, f'{key}.png')
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return data
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self._remember(key, data)
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._remember(key, data)
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in cached_files(self.cache_folder, '.png'))
+            else:
+                self._disk_bytes += len(data)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._disk_bytes = prune_oldest(self.cache_folder, '.png', self.max_disk_bytes)
+
+    def _remember(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {'entries_in_memory': len(self._memory), 'memory_bytes': self._memory_bytes,
+                    'max_memory_bytes': self.max_memory_bytes, 'disk_bytes': self._disk_bytes,
+                    'max_disk_bytes': self.max_disk_bytes, 'hits': self.hits, 'misses': self.misses}
+
+class TilePyramid:
+    """
+    XYZ-style pyramid of RGB preview tiles for one scene and contrast setting.
+
+    The deepest level has one tile pixel per scene pixel and is cut straight
+    from the cube through TiledScene windows; each coarser tile is the 2x2
+    average of its four children, so the whole pyramid costs one pass over the
+    three bands. Tiles are built on first request and kept in a TileCache;
+    pixels outside the scene are transparent.
+    """
+
+    def __init__(self, hypercube, fingerprint, cache, rgb_bands=RGB_BANDS, percentiles=DEFAULT_PERCENTILES,
+                 tile_size=TILE_SIZE, histograms=None):
+        self.scene = hypercube if isinstance(hypercube, TiledScene) else TiledScene(hypercube)
+        self.fingerprint = fingerprint
+        self.cache = cache
+        self.rgb_bands = tuple(rgb_bands)
+        self.percentiles = tuple(percentiles)
+        self.tile_size = tile_size
+        self.histograms = histograms
+        self.max_zoom = max_zoom(self.scene.height, self.scene.width, tile_size)
+        self.style_key = 'v{}_{}_{}'.format(TILE_CACHE_VERSION, '-'.join(str(b) for b in self.rgb_bands),
+                                             '-'.join(f'{p:g}' for p in self.percentiles))
+        self._stretch_range = None
+        self._lock = threading.Lock()
+
+    @property
+    def stretch_range(self):
+        """(low, high) values of the contrast stretch, from the scene's band histograms when available."""
+        with self._lock:
+            if self._stretch_range is None:
+                if self.histograms is not None:
+                    stretch_range = self.histograms.percentiles(self.rgb_bands, self.percentiles)
+                else:
+                    stretch_range = band_percentiles(self.scene, list(self.rgb_bands), self.percentiles)
+                self._stretch_range = tuple(stretch_range)
+            return self._stretch_range
+
+    def tile_count(self, z):
+        scale = 2 ** (self.max_zoom - z)
+        span = self.tile_size * scale
+        return math.ceil(self.scene.width / span), math.ceil(self.scene.height / span)
+
+    def info(self):
+        return {'tile_size': self.tile_size, 'min_zoom': 0, 'max_zoom': self.max_zoom,
+                'width': self.scene.width, 'height': self.scene.height,
+                'rgb_bands': list(self.rgb_bands), 'percentiles': list(self.percentiles),
+                'stretch_range': list(self.stretch_range),
+                'tiles': {z: list(self.tile_count(z)) for z in range(self.max_zoom + 1)}}
+
+    def _key(self, name):
+        return f'{self.fingerprint[:20]}/{self.style_key}/{name}'
+
+    def etag(self, *name):
+        """
+        Strong validator of a tile (etag(z, x, y)) or of the preview (etag('preview')),
+        derived from scene content and style without rendering anything.
+        """
+        name = '/'.join(str(part) for part in name)
+        digest = hashlib.blake2b(f'{self.fingerprint}|{self.style_key}|{self.tile_size}|{name}'.encode(),
+                                 digest_size=12)
+        return f'"{digest.hexdigest()}"'
+
+    def tile_png(self, z, x, y):
+        """
+        PNG bytes of tile (z, x, y).
+
+        Raises:
+            IndexError: If the tile is outside the pyramid.
+        """
+        columns, rows = self.tile_count(z) if 0 <= z <= self.max_zoom else (0, 0)
+        if not (0 <= x < columns and 0 <= y < rows):
+            raise IndexError(f'Tile {z}/{x}/{y} is outside the pyramid (zoom 0-{self.max_zoom}).')
+        key = self._key(f'{z}/{x}/{y}')
+        data = self.cache.get(key)
+        if data is None:
+            data = _encode_png(self._render(z, x, y))
+            self.cache.put(key, data)
+        return data
+
+    def _tile_rgba(self, z, x, y):
+        columns, rows = self.tile_count(z)
+        if not (0 <= x < columns and 0 <= y < rows):
+            return np.zeros((self.tile_size, self.tile_size, 4), dtype=np.uint8)
+        return np.asarray(Image.open(io.BytesIO(self.tile_png(z, x, y))).convert('RGBA'))
+
+    def _render(self, z, x, y):
+        size = self.tile_size
+        if z == self.max_zoom:
+            r0, c0 = y * size, x * size
+            r1, c1 = min(r0 + size, self.scene.height), min(c0 + size, self.scene.width)
+            tile = np.zeros((size, size, 4), dtype=np.uint8)
+            window = self.scene.read_window(r0, r1, c0, c1, bands=list(self.rgb_bands))
+            low, high = self.stretch_range
+            stretch_to_uint8(window, low, high, out=tile[:r1 - r0, :c1 - c0, :3])
+            tile[:r1 - r0, :c1 - c0, 3] = 255
+            return tile
+
+        # Average the four children, weighting by coverage so transparent edges do not darken the scene
+        children = np.zeros((2 * size, 2 * size, 4), dtype=np.float32)
+        for dy in (0, 1):
+            for dx in (0, 1):
+                children[dy * size:(dy + 1) * size, dx * size:(dx + 1) * size] = \
+                    self._tile_rgba(z + 1, 2 * x + dx, 2 * y + dy)
+        blocks = children.reshape(size, 2, size, 2, 4)
+        alpha = blocks[..., 3].sum(axis=(1, 3))
+        rgb = (blocks[..., :3] * blocks[..., 3:4]).sum(axis=(1, 3)) / np.maximum(alpha, 1)[..., None]
+        tile = np.empty((size, size, 4), dtype=np.uint8)
+        tile[..., :3] = np.rint(rgb)
+        tile[..., 3] = np.rint(alpha / 4)
+        return tile
+
+    def preview_png(self):
+        """Full-resolution PNG of the whole scene, rendered once per style."""
+        key = self._key('preview')
+        data = self.cache.get(key)
+        if data is None:
+            image = create_rgb_visualization(self.scene, list(self.rgb_bands), stretch_range=self.stretch_range)
+            buffer = io.BytesIO()
+            with timed('png_encode'):
+                image.save(buffer, format='PNG')
+            data = buffer.getvalue()
+            self.cache.put(key, data)
+        return data
+
+def _encode_png(tile):
+    buffer = io.BytesIO()
+    with timed('png_encode'):
+        Image.fromarray(tile).save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
+class TilePyramids:
+    """The pyramids in use, one per (scene content, bands, percentiles), sharing one TileCache."""
+
+    def __init__(self, cache, max_pyramids=32):
+        self.cache = cache
+        self.max_pyramids = max_pyramids
+        self._pyramids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, hypercube, fingerprint, rgb_bands=RGB_BANDS, percentiles=DEFAULT_PERCENTILES, histograms=None):
+        """
+        Returns the pyramid for a scene and style, creating it on first use.
+        Pass the scene's BandHistograms so a new band triplet costs no pass over the cube.
+
+        Raises:
+            ValueError: If a band index is outside the cube.
+        """
+        bands = hypercube.shape[2]
+        if not all(0 <= b < bands for b in rgb_bands):
+            raise ValueError(f'Band indices must be between 0 and {bands - 1}, got {list(rgb_bands)}.')
+        key = (fingerprint, tuple(rgb_bands), tuple(percentiles))
+        with self._lock:
+            pyramid = self._pyramids.get(key)
+            if pyramid is None:
+                pyramid = TilePyramid(hypercube, fingerprint, self.cache, rgb_bands, percentiles, histograms=histograms)
+                self._pyramids[key] = pyramid
+                while len(self._pyramids) > self.max_pyramids:
+                    self._pyramids.popitem(last=False)
+            self._pyramids.move_to_end(key)
+            return pyramid
@@ -0,0 +1,148 @@
+import os
+
+import numpy as np
+
+DEFAULT_TILE_ROWS = 64  # Rows per window when a scene is walked top to bottom
+HISTOGRAM_BINS = 1 << 16  # Resolution of band_percentiles
+
+class TiledScene:
+    """
+    Windowed access to a (height, width, bands) hyperspectral cube.
+
+    The cube is normally the memory-mapped .npy cache written by
+    modules.data_handler, so a window read only touches the rows it covers.
+    Windows can carry a zero-filled halo around them (the padding a patch
+    classifier needs at the scene border), which replaces padding the whole
+    cube up front. Row-major .npy storage makes full-width row bands the cheap
+    unit, so scenes are walked as row blocks: peak memory follows
+    block rows x width x bands, not the scene height.
+    """
+
+    def __init__(self, cube, tile_rows=DEFAULT_TILE_ROWS):
+        if cube.ndim != 3:
+            raise ValueError(f'Expected a (height, width, bands) cube, got shape {cube.shape}.')
+        self.cube = cube
+        self.tile_rows = tile_rows
+
+    @classmethod
+    def open(cls, path, tile_rows=DEFAULT_TILE_ROWS):
+        """Memory-maps a cube stored as .npy."""
+        return cls(np.load(path, mmap_mode='r'), tile_rows)
+
+    @property
+    def shape(self):
+        return self.cube.shape
+
+    @property
+    def height(self):
+        return self.cube.shape[0]
+
+    @property
+    def width(self):
+        return self.cube.shape[1]
+
+    @property
+    def bands(self):
+        return self.cube.shape[2]
+
+    @property
+    def path(self):
+        """
+        The .npy file backing the whole cube, or None. Other processes can map it
+        themselves instead of receiving a copy. Slices of a memmap report the
+        file of the full cube, so the header is checked against this view.
+        """
+        filename = getattr(self.cube, 'filename', None)
+        if not isinstance(self.cube, np.memmap) or not filename or not str(filename).endswith('.npy'):
+            return None
+        if not self.cube.flags.c_contiguous or not os.path.isfile(filename):
+            return None
+        on_disk = np.load(filename, mmap_mode='r')
+        if on_disk.shape != self.cube.shape or on_disk.dtype != self.cube.dtype:
+            return None
+        return os.fspath(filename)
+
+    def row_blocks(self, rows=None):
+        """Splits the scene into consecutive (r0, r1) row blocks."""
+        rows = rows or self.tile_rows
+        return [(r0, min(r0 + rows, self.height)) for r0 in range(0, self.height, rows)]
+
+    def window_shape(self, r0, r1, c0=0, c1=None, halo=0, bands=None):
+        c1 = self.width if c1 is None else c1
+        depth = self.bands if bands is None else len(np.arange(self.bands)[bands])
+        return (r1 - r0 + 2 * halo, c1 - c0 + 2 * halo, depth)
+
+    def read_window(self, r0, r1, c0=0, c1=None, halo=0, bands=None, out=None):
+        """
+        Reads rows [r0, r1) and columns [c0, c1) plus a halo as float32.
+
+        Args:
+            r0 (int): First row of the window.
+            r1 (int): One past the last row.
+            c0 (int): First column. Defaults to 0.
+            c1 (int): One past the last column. Defaults to the scene width.
+            halo (int): Extra pixels read on every side; parts outside the scene are zero.
+            bands: Optional band selection (slice or list of indices).
+            out (np.ndarray): Optional float32 buffer of window_shape(...) to fill.
+
+        Returns:
+            np.ndarray: The (r1 - r0 + 2 * halo, c1 - c0 + 2 * halo, bands) window.
+        """
+        c1 = self.width if c1 is None else c1
+        shape = self.window_shape(r0, r1, c0, c1, halo, bands)
+        window = np.empty(shape, dtype=np.float32) if out is None else out
+
+        # Part of the window that lies inside the scene
+        sr0, sr1 = max(r0 - halo, 0), min(r1 + halo, self.height)
+        sc0, sc1 = max(c0 - halo, 0), min(c1 + halo, self.width)
+        wr0, wc0 = sr0 - (r0 - halo), sc0 - (c0 - halo)
+        wr1, wc1 = wr0 + (sr1 - sr0), wc0 + (sc1 - sc0)
+
+        if halo:
+            window[:wr0] = 0
+            window[wr1:] = 0
+            window[:, :wc0] = 0
+            window[:, wc1:] = 0
+        source = self.cube[sr0:sr1, sc0:sc1]
+        window[wr0:wr1, wc0:wc1] = source if bands is None else source[:, :, bands]
+        return window
+
+    def iter_windows(self, halo=0, bands=None, rows=None):
+        """Yields (r0, r1, window) for full-width row blocks; the buffer is reused."""
+        buffer = None
+        for r0, r1 in self.row_blocks(rows):
+            shape = self.window_shape(r0, r1, halo=halo, bands=bands)
+            if buffer is None or buffer.shape[0] < shape[0]:
+                buffer = np.empty(shape, dtype=np.float32)
+            yield r0, r1, self.read_window(r0, r1, halo=halo, bands=bands, out=buffer[:shape[0]])
+
+def band_percentiles(scene, bands, percentiles):
+    """
+    Percentiles over the selected bands of a scene, computed block by block.
+
+    A first pass finds the value range, a second accumulates a HISTOGRAM_BINS
+    histogram; percentiles are interpolated within their bin, so they match
+    np.percentile to within one bin width without holding the bands in memory.
+    """
+    low, high = np.inf, -np.inf
+    for _, _, window in scene.iter_windows(bands=bands):
+        low, high = min(low, float(window.min())), max(high, float(window.max()))
+    if not low < high:
+        return [low for _ in percentiles]
+
+    counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    for _, _, window in scene.iter_windows(bands=bands):
+        counts += np.histogram(window, bins=HISTOGRAM_BINS, range=(low, high))[0]
+
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+    bin_width = (high - low) / HISTOGRAM_BINS
+    values = []
+    for percentile in percentiles:
+        rank = percentile / 100 * (total - 1)
+        b = int(np.searchsorted(cumulative, rank, side='right'))
+        b = min(b, HISTOGRAM_BINS - 1)
+        before = cumulative[b - 1] if b else 0
+        fraction = (rank - before + 0.5) / counts[b] if counts[b] else 0.0
+        values.append(low + (b + min(max(fraction, 0.0), 1.0)) * bin_width)
+    return values
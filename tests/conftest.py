@@ -0,0 +1,27 @@
+"""
+Shared fixtures: a small random scene and a seeded, untrained CropClassifier for it.
+The checks compare fast paths with reference paths, so the weights need not be trained.
+"""
+import numpy as np
+import pytest
+import torch
+
+from modules.model_handler import CropClassifier
+
+HEIGHT, WIDTH, BANDS = 20, 24, 16
+NUM_CLASSES = 16
+TILE_SIZE = 8
+
+def make_model(bands=BANDS, seed=0):
+    torch.manual_seed(seed)
+    model = CropClassifier(NUM_CLASSES, bands)
+    model.eval()
+    return model
+
+@pytest.fixture(scope='session')
+def model():
+    return make_model()
+
+@pytest.fixture(scope='session')
+def cube():
+    return np.random.default_rng(0).random((HEIGHT, WIDTH, BANDS), dtype=np.float32)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from modules.model_handler import PATCH_SIZE
+from modules.inference_engine import InferenceEngine, InferenceConfig
+from modules.adaptive_inference import predict_adaptive
+from tests.conftest import HEIGHT, WIDTH, BANDS, NUM_CLASSES, TILE_SIZE
+
+class CentrePixelClassifier(nn.Module):
+    """Classifies a patch by its centre pixel alone, so uniform regions get one label throughout."""
+
+    def __init__(self):
+        super().__init__()
+        self.weight = torch.from_numpy(np.random.default_rng(10).normal(size=(BANDS, NUM_CLASSES)).astype(np.float32))
+
+    def forward(self, x):
+        return 50 * x[:, 0, PATCH_SIZE // 2, PATCH_SIZE // 2] @ self.weight  # Confident logits
+
+@pytest.fixture(scope='module')
+def regions():
+    """Four uniform quadrants with different spectra, split off-lattice at row 13 and column 9."""
+    rng = np.random.default_rng(11)
+    spectra = rng.random((4, BANDS), dtype=np.float32)
+    quadrant = 2 * (np.arange(HEIGHT)[:, None] >= 13) + (np.arange(WIDTH)[None, :] >= 9)
+    return spectra[quadrant]
+
+def dense_map(model, cube, mask=None):
+    return InferenceEngine(model, InferenceConfig(mode='patch', tile_size=TILE_SIZE)).run(cube, mask=mask)[0]
+
+def test_adaptive_matches_dense_on_uniform_regions(regions):
+    model = CentrePixelClassifier()
+    reference = dense_map(model, regions)
+    assert len(np.unique(reference)) > 1
+    engine = InferenceEngine(model, InferenceConfig(mode='adaptive', tile_size=TILE_SIZE, adaptive_grid_step=4,
+                                                    adaptive_min_confidence=0.9))
+    np.testing.assert_array_equal(engine.run(regions)[0], reference)
+    report = engine.last_adaptive_report
+    assert report['pixels'] == HEIGHT * WIDTH and report['forwards_saved'] > HEIGHT * WIDTH // 2
+
+def test_adaptive_respects_the_mask(regions):
+    model = CentrePixelClassifier()
+    mask = np.zeros((HEIGHT, WIDTH), dtype=bool)
+    mask[4:18, 2:15] = True
+    prediction_map, report = predict_adaptive(model, regions, grid_step=4, min_confidence=0.9, mask=mask)
+    np.testing.assert_array_equal(prediction_map, dense_map(model, regions, mask))
+    assert report['pixels'] == mask.sum() and report['forwards'] < mask.sum()
+
+def test_uncertain_cells_are_refined_down_to_every_pixel(model, cube):
+    # The untrained model is never fully confident, so min_confidence=1 classifies every pixel
+    prediction_map, report = predict_adaptive(model, cube, grid_step=4, min_confidence=1)
+    np.testing.assert_array_equal(prediction_map, dense_map(model, cube))
+    assert report['forwards'] == HEIGHT * WIDTH
+
+def test_bad_grid_step_is_rejected(cube, model):
+    with pytest.raises(ValueError):
+        predict_adaptive(model, cube, grid_step=0)
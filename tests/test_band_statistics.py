@@ -0,0 +1,31 @@
+import numpy as np
+
+from modules.band_statistics import BandStatistics
+from tests.conftest import HEIGHT, WIDTH
+
+def test_band_moments_match_numpy(cube):
+    statistics = BandStatistics.from_scene(cube)
+    np.testing.assert_allclose(statistics.min, cube.min(axis=(0, 1)))
+    np.testing.assert_allclose(statistics.max, cube.max(axis=(0, 1)))
+    np.testing.assert_allclose(statistics.mean, cube.mean(axis=(0, 1), dtype=np.float64), rtol=1e-9)
+    np.testing.assert_allclose(statistics.std, cube.std(axis=(0, 1), dtype=np.float64), rtol=1e-6)
+    assert statistics.pixels == HEIGHT * WIDTH
+    assert (statistics.histograms.counts.sum(axis=-1) == HEIGHT * WIDTH).all()
+
+def test_class_means_match_numpy(cube):
+    ground_truth = np.random.default_rng(5).integers(0, 5, (HEIGHT, WIDTH))
+    ground_truth[ground_truth == 3] = 0  # A label with no pixels
+    statistics = BandStatistics.from_scene(cube, ground_truth)
+    np.testing.assert_array_equal(statistics.class_labels, [1, 2, 4])
+    for label, pixels, mean in zip(statistics.class_labels, statistics.class_pixels, statistics.class_means):
+        assert pixels == np.count_nonzero(ground_truth == label)
+        np.testing.assert_allclose(mean, cube[ground_truth == label].mean(axis=0), rtol=1e-6)
+
+def test_sidecar_is_reused_only_for_the_same_cube(cube, tmp_path):
+    path = str(tmp_path / 'stats.npz')
+    computed = BandStatistics.load_or_compute(path, cube, fingerprint='a')
+    loaded = BandStatistics.load_or_compute(path, np.zeros_like(cube), fingerprint='a')  # Not read: the sidecar matches
+    np.testing.assert_array_equal(loaded.mean, computed.mean)
+    np.testing.assert_array_equal(loaded.histograms.counts, computed.histograms.counts)
+    recomputed = BandStatistics.load_or_compute(path, np.zeros_like(cube), fingerprint='b')
+    assert not recomputed.mean.any() and BandStatistics.load(path).fingerprint == 'b'
@@ -0,0 +1,69 @@
+import threading
+
+import numpy as np
+import pytest
+import torch
+
+from modules.model_handler import PATCH_SIZE, predict_pixels
+from modules.patch_extractor import gather_patches
+from modules.batching_server import BatchingServer, BatchedModel, classify_points, MAX_POINTS
+
+def patches_at(cube, points):
+    points = np.asarray(points)
+    patches = np.empty((len(points), 1, PATCH_SIZE, PATCH_SIZE, cube.shape[2]), dtype=np.float32)
+    return gather_patches(cube, points[:, 1], points[:, 0], PATCH_SIZE, patches)
+
+def reference_logits(model, patches):
+    with torch.no_grad():
+        return model(torch.from_numpy(patches)).numpy()
+
+@pytest.fixture
+def server(model):
+    server = BatchingServer(model, batch_size=8, max_latency_ms=200)
+    yield server
+    server.close()
+
+def test_each_caller_gets_its_own_logits_in_order(model, cube, server):
+    rng = np.random.default_rng(0)
+    requests = [patches_at(cube, np.stack([rng.integers(0, cube.shape[1], n), rng.integers(0, cube.shape[0], n)], axis=1))
+                for n in (3, 11, 1, 6)]
+    results = [None] * len(requests)
+
+    def call(index):
+        results[index] = server.submit(requests[index]).result(timeout=60)
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for patches, logits in zip(requests, results):
+        np.testing.assert_allclose(logits, reference_logits(model, patches), rtol=1e-4, atol=1e-5)
+
+def test_queued_requests_are_coalesced_into_full_batches(model, cube, server):
+    points = [(x, y) for y in range(3) for x in range(3)]
+    futures = [server.submit(patches_at(cube, points[i:i + 3])) for i in range(0, 9, 3)]
+    logits = np.concatenate([future.result(timeout=60) for future in futures])
+    np.testing.assert_allclose(logits, reference_logits(model, patches_at(cube, points)), rtol=1e-4, atol=1e-5)
+    stats = server.stats()
+    assert stats['requests'] == 3 and stats['patches'] == 9
+    assert stats['batches'] == 2  # One full batch of 8, then the last patch at the deadline
+
+def test_batched_model_matches_the_model(model, cube, server):
+    coords = np.argwhere(np.ones(cube.shape[:2], dtype=bool))[::7]
+    np.testing.assert_array_equal(predict_pixels(BatchedModel(server), cube, coords, batch_size=5),
+                                  predict_pixels(model, cube, coords, batch_size=5))
+
+def test_classify_points_keeps_the_order_given(model, cube, server):
+    rng = np.random.default_rng(1)
+    points = np.stack([rng.integers(0, cube.shape[1], 21), rng.integers(0, cube.shape[0], 21)], axis=1)
+    labels, confidence = classify_points(server, cube, points.tolist())
+    expected_labels, expected_confidence = predict_pixels(model, cube, points[:, ::-1], return_confidence=True)
+    np.testing.assert_array_equal(labels, expected_labels)
+    np.testing.assert_allclose(confidence, expected_confidence, rtol=1e-4)
+    assert server.stats()['batches'] == 3  # Submitted in chunks of the server's batch size
+
+@pytest.mark.parametrize('points', [[(-1, 0)], [(0, 20)], [(0, 0)] * (MAX_POINTS + 1)])
+def test_classify_points_rejects_bad_requests(cube, server, points):
+    with pytest.raises(ValueError):
+        classify_points(server, cube, points)
@@ -0,0 +1,21 @@
+import numpy as np
+import torch
+
+from modules.model_handler import PATCH_SIZE
+from modules.patch_extractor import pad_cube
+from modules.inference_engine import InferenceEngine, InferenceConfig
+from tests.conftest import TILE_SIZE
+
+def test_dense_matches_patch(model, cube):
+    dense_map = InferenceEngine(model, InferenceConfig(mode='dense', tile_size=TILE_SIZE)).run(cube)[0]
+    patch_map = InferenceEngine(model, InferenceConfig(mode='patch', tile_size=TILE_SIZE)).run(cube)[0]
+    np.testing.assert_array_equal(dense_map, patch_map)
+
+def test_forward_dense_matches_forward_on_each_patch(model, cube):
+    rows, cols = 5, 7
+    tile = torch.from_numpy(np.ascontiguousarray(pad_cube(cube, PATCH_SIZE)[:rows + PATCH_SIZE - 1, :cols + PATCH_SIZE - 1]))
+    patches = torch.stack([tile[r:r + PATCH_SIZE, c:c + PATCH_SIZE] for r in range(rows) for c in range(cols)])
+    with torch.no_grad():
+        dense = model.forward_dense(tile)
+        reference = model(patches.unsqueeze(1))
+    np.testing.assert_allclose(dense.reshape(rows * cols, -1).numpy(), reference.numpy(), rtol=1e-4, atol=1e-5)
@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import pytest
+import scipy.io
+
+from modules.model_handler import PATCH_SIZE
+from modules.inference_engine import InferenceEngine, InferenceConfig
+from modules.incremental_inference import tile_checksums, classify_changes, ChangeTracker, CHECKSUM_TILE_SIZE
+from modules.result_cache import ResultCache
+from modules.spectral_reduction import SpectralReducer
+from modules.data_handler import load_hyperspectral_data, raw_tile_checksums
+from tests.conftest import HEIGHT, WIDTH, BANDS, TILE_SIZE, make_model
+
+@pytest.fixture
+def engine(model):
+    return InferenceEngine(model, InferenceConfig(mode='dense', tile_size=TILE_SIZE))
+
+def updated_cube(cube, seed=2):
+    updated = cube.copy()
+    updated[9:14, 17:21] = np.random.default_rng(seed).random((5, 4, BANDS), dtype=np.float32)
+    return updated
+
+def test_incremental_matches_full(cube, engine):
+    base_result = engine.run(cube)
+    updated = updated_cube(cube)
+
+    result, checksums, report = classify_changes(engine, updated, base_result, tile_checksums(cube, TILE_SIZE),
+                                                 tile_size=TILE_SIZE)
+    full_result = engine.run(updated)
+    assert report['incremental']
+    assert report['reclassified'] < HEIGHT * WIDTH
+    np.testing.assert_array_equal(result[0], full_result[0])
+    assert ({entry['crop_type_id']: entry['pixel_count'] for entry in result[1]} ==
+            {entry['crop_type_id']: entry['pixel_count'] for entry in full_result[1]})
+    np.testing.assert_array_equal(checksums, tile_checksums(updated, TILE_SIZE))
+
+def test_normalization_change_is_an_explicit_full_rerun(tmp_path, cube, engine):
+    result_cache = ResultCache(str(tmp_path))
+    tracker = ChangeTracker(result_cache, tile_size=TILE_SIZE)
+
+    def analyse(key, cube, raw, normalization):
+        # As the servers do: the tracker is the compute step of a result cache miss
+        return result_cache.get_or_compute(key, lambda: tracker.run(engine, cube, 'lineage', key,
+                                                                    checksums=tile_checksums(raw, TILE_SIZE),
+                                                                    normalization=normalization))
+
+    # Stand-ins for the raw cubes behind the normalized ones: only one raw value changes, but
+    # the constants moved with it, so every normalized value has moved
+    raw = (cube * 1000).astype(np.uint16)
+    analyse('first', cube, raw, (0, 1000))
+    updated = updated_cube(cube)
+    updated_raw = raw.copy()
+    updated_raw[0, 0, 0] += 1
+    result = analyse('second', updated, updated_raw, (0, 1200))
+    report = tracker.stats()['last_report']
+    assert report['normalization_changed'] and not report['incremental']
+    assert report['changed_tiles'] == 1  # Only the raw change counts as changed
+    assert tracker.stats()['normalization_reruns'] == 1
+    np.testing.assert_array_equal(result[0], engine.run(updated)[0])
+
+    updated_raw[-1, -1, 0] += 1  # Same constants again: back to incremental runs
+    analyse('third', updated, updated_raw, (0, 1200))
+    assert tracker.stats()['last_report']['incremental'] and tracker.stats()['incremental_runs'] == 1
+    assert tracker.stats()['normalization_reruns'] == 1
+
+def test_raw_checksums_are_taken_when_the_cache_is_built(tmp_path):
+    raw = np.random.default_rng(6).integers(100, 1000, (40, 70, 4)).astype(np.uint16)
+    scipy.io.savemat(tmp_path / 'scene.mat', {'scene': raw})
+    cache_folder = str(tmp_path / 'cache')
+
+    def load():
+        load_hyperspectral_data(str(tmp_path), cache_folder=cache_folder, hypercube_filename='scene.mat',
+                                ground_truth_filename=None)
+        return raw_tile_checksums(cache_folder, 'scene.mat')
+
+    checksums, normalization = load()
+    np.testing.assert_array_equal(checksums, tile_checksums(raw, CHECKSUM_TILE_SIZE))
+    assert normalization == (100, 999)
+
+    raw[35, 65, 2] = 5000  # A new global maximum in one tile
+    scipy.io.savemat(tmp_path / 'scene.mat', {'scene': raw})
+    os.utime(tmp_path / 'scene.mat', ns=(0, 1))
+    updated, updated_normalization = load()
+    assert updated_normalization == (100, 5000)
+    assert np.count_nonzero(updated != checksums) == 1
+
+@pytest.mark.parametrize('method', ['pca', 'bands'])
+def test_masked_matches_full_with_reducer(cube, method):
+    rng = np.random.default_rng(1)
+    coords = np.argwhere(np.ones((HEIGHT, WIDTH), dtype=bool))
+    reducer = SpectralReducer.fit(cube, coords, labels=rng.integers(1, 4, len(coords)), components=8, method=method)
+    engine = InferenceEngine(make_model(bands=reducer.components), InferenceConfig(mode='dense', tile_size=TILE_SIZE),
+                             reducer=reducer)
+    # Far from most tiles, so only the tiles within the patch halo are reduced
+    mask = np.zeros((HEIGHT, WIDTH), dtype=bool)
+    mask[2:5, 3:6] = True
+    mask[17, 21] = True
+    np.testing.assert_array_equal(engine.run(cube, mask=mask)[0][mask], engine.run(cube)[0][mask])
+
+    # Every pixel a selected pixel's patch reads is reduced; far-away tiles are skipped
+    halo = PATCH_SIZE // 2
+    reduced = reducer.transform_cube(cube)
+    partial = reducer.transform_cube(cube, mask=mask, halo=halo, tile_size=TILE_SIZE)
+    for row, col in np.argwhere(mask):
+        rows, cols = slice(max(row - halo, 0), row + halo + 1), slice(max(col - halo, 0), col + halo + 1)
+        np.testing.assert_allclose(partial[rows, cols], reduced[rows, cols], rtol=1e-5, atol=1e-6)
+    assert not partial[16:, :8].any()
@@ -0,0 +1,59 @@
+import os
+import json
+import threading
+
+import numpy as np
+import pytest
+
+from modules.inference_engine import InferenceEngine, InferenceConfig, shard_rows
+from modules.metrics import PIXELS_CLASSIFIED, STAGE_SECONDS
+from modules.tiled_scene import TiledScene
+from tests.conftest import TILE_SIZE
+
+@pytest.fixture(scope='module')
+def full_map(model, cube):
+    return InferenceEngine(model, InferenceConfig(mode='dense', tile_size=TILE_SIZE)).run(cube)[0]
+
+def test_shards_cover_every_row_once():
+    assert shard_rows(10, 4) == [(0, 4), (4, 8), (8, 10)]
+
+@pytest.mark.parametrize('workers, rows', [(1, 3), (2, 5)])
+def test_sharding_does_not_change_the_map(model, cube, full_map, workers, rows):
+    config = InferenceConfig(mode='dense', workers=workers, shard_rows=rows, tile_size=TILE_SIZE)
+    np.testing.assert_array_equal(InferenceEngine(model, config).run(cube)[0], full_map)
+
+def test_process_pool_is_kept_across_runs(model, cube, full_map, tmp_path):
+    engine = InferenceEngine(model, InferenceConfig(mode='dense', executor='process', workers=2, tile_size=TILE_SIZE))
+    try:
+        # An in-memory cube goes to the workers through shared memory, a cached one as its .npy path
+        np.testing.assert_array_equal(engine.run(cube)[0], full_map)
+        pool = engine._pool
+        np.save(tmp_path / 'cube.npy', cube)
+        np.testing.assert_array_equal(engine.run(TiledScene.open(tmp_path / 'cube.npy'))[0], full_map)
+        mask = np.zeros(cube.shape[:2], dtype=bool)
+        mask[3:9, 2:12] = True
+        np.testing.assert_array_equal(engine.run(cube, mask=mask)[0][mask], full_map[mask])
+        assert engine._pool is pool
+    finally:
+        engine.close()
+    assert engine._pool is None
+
+def test_autotune_runs_once_and_stays_out_of_the_metrics(model, cube, tmp_path):
+    path = tmp_path / 'autotune.json'
+    engine = InferenceEngine(model, InferenceConfig(autotune=True, autotune_path=str(path), tile_size=TILE_SIZE))
+    engine.run(cube[:4])
+    assert not path.exists()  # run() never tunes
+
+    pixels, forwards = PIXELS_CLASSIFIED.value(), STAGE_SECONDS.snapshot('model_forward')[2]
+    threads = [threading.Thread(target=engine.autotune, args=(cube,)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert PIXELS_CLASSIFIED.value() == pixels
+    assert STAGE_SECONDS.snapshot('model_forward')[2] == forwards
+
+    stored = json.loads(path.read_text())
+    assert list(stored) == [f'cpus={os.cpu_count() or 1},bands={cube.shape[2]},mode=dense']
+    assert not engine.config.autotune
+    assert engine.config.workers == stored[next(iter(stored))]['workers']
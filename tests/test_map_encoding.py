@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from modules.map_encoding import encode_map, decode_map, negotiate_map_format
+from tests.conftest import HEIGHT, WIDTH
+
+@pytest.mark.parametrize('fmt', ['raw', 'rle', 'png'])
+@pytest.mark.parametrize('max_label', [16, 300])
+def test_map_round_trip(fmt, max_label):
+    labels = np.random.default_rng(3).integers(0, max_label + 1, (HEIGHT, WIDTH))
+    labels[:5] = 7  # A long run for RLE
+    body, _, headers = encode_map(labels, fmt)
+    np.testing.assert_array_equal(decode_map(body, headers), labels)
+
+@pytest.mark.parametrize('accept, format_param, expected', [
+    (None, None, 'json'),
+    ('text/html, */*', None, 'json'),
+    ('image/png;q=0.5, application/x-rle;q=0.9', None, 'rle'),
+    ('application/octet-stream;q=bad, image/png', None, 'png'),
+    ('image/png', 'raw', 'raw'),
+])
+def test_map_format_negotiation(accept, format_param, expected):
+    assert negotiate_map_format(accept, format_param) == expected
+
+def test_unknown_map_format_is_rejected():
+    with pytest.raises(ValueError):
+        negotiate_map_format(None, 'tiff')
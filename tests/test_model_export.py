@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from modules.model_handler import PATCH_SIZE
+from modules.model_export import (MODEL_VARIANTS, build_variant, save_variant, load_inference_model, artifact_path,
+                                  serialize_model, deserialize_model)
+from tests.conftest import NUM_CLASSES, BANDS, make_model
+
+@pytest.fixture(scope='module')
+def patches():
+    return torch.from_numpy(np.random.default_rng(7).random((6, 1, PATCH_SIZE, PATCH_SIZE, BANDS), dtype=np.float32))
+
+@pytest.fixture
+def model_path(model, tmp_path):
+    path = str(tmp_path / 'crop_classifier.pth')
+    torch.save(model.state_dict(), path)
+    return path
+
+@pytest.mark.parametrize('variant', MODEL_VARIANTS)
+def test_variant_round_trip(model, model_path, patches, variant):
+    with torch.no_grad():
+        reference = model(patches).numpy()
+        built = load_inference_model(model_path, NUM_CLASSES, variant)  # Builds and saves the artifact
+        loaded = load_inference_model(model_path, NUM_CLASSES, variant)  # Loads it back
+        built_logits, loaded_logits = built(patches).numpy(), loaded(patches).numpy()
+    np.testing.assert_allclose(loaded_logits, built_logits, rtol=1e-5, atol=1e-6)
+    tolerance = 0.05 if 'int8' in variant else 1e-4  # Quantized weights only approximate the fp32 logits
+    np.testing.assert_allclose(loaded_logits, reference, atol=tolerance)
+
+def test_stale_artifact_is_rebuilt(model, model_path, patches):
+    save_variant(build_variant(make_model(seed=1), 'torchscript'), 'torchscript', artifact_path(model_path, 'torchscript'))
+    os.utime(artifact_path(model_path, 'torchscript'), (0, 0))  # Older than the weights
+    with torch.no_grad():
+        np.testing.assert_allclose(load_inference_model(model_path, NUM_CLASSES, 'torchscript')(patches).numpy(),
+                                   model(patches).numpy(), atol=1e-4)
+
+@pytest.mark.parametrize('variant', ['int8', 'torchscript'])
+def test_serialized_model_round_trip(model, patches, variant):
+    module = build_variant(model, variant)
+    with torch.no_grad():
+        np.testing.assert_array_equal(deserialize_model(serialize_model(module))(patches).numpy(),
+                                      module(patches).numpy())
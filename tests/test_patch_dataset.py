@@ -0,0 +1,46 @@
+import pickle
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from modules.model_handler import prepare_training_data
+from modules.patch_dataset import PatchDataset, patch_loader
+from tests.conftest import HEIGHT, WIDTH
+
+@pytest.fixture(scope='module')
+def ground_truth():
+    ground_truth = np.random.default_rng(8).integers(0, 4, (HEIGHT, WIDTH))
+    ground_truth[:3] = 0  # Unlabeled rows
+    return ground_truth
+
+@pytest.fixture(params=['memory', 'file'])
+def dataset(request, cube, ground_truth, tmp_path):
+    padded_path = str(tmp_path / 'padded.npy') if request.param == 'file' else None
+    return PatchDataset.from_scene(cube, ground_truth, padded_path=padded_path)
+
+def test_items_match_materialized_patches(cube, ground_truth, dataset):
+    X, y = prepare_training_data(cube, ground_truth)
+    assert len(dataset) == len(X)
+    for index in (0, 7, len(X) - 1):
+        patch, label = dataset[index]
+        np.testing.assert_array_equal(patch.numpy(), X[index].numpy())
+        assert label == y[index]
+    patches, labels = pickle.loads(pickle.dumps(dataset))[[5, 1, 9]]  # As a DataLoader worker gets it
+    order = np.lexsort((dataset.coords[[5, 1, 9], 1], dataset.coords[[5, 1, 9], 0]))
+    np.testing.assert_array_equal(patches.numpy(), X[np.array([5, 1, 9])[order]].numpy())
+    np.testing.assert_array_equal(labels.numpy(), y[np.array([5, 1, 9])[order]].numpy())
+
+def test_shuffled_loader_yields_every_pair_once(cube, ground_truth, dataset):
+    X, y = prepare_training_data(cube, ground_truth)
+    expected = Counter((patch.tobytes(), int(label)) for patch, label in zip(X.numpy(), y.numpy()))
+    seen = Counter()
+    for patches, labels in patch_loader(dataset, batch_size=16, shuffle=True, seed=0):
+        seen.update((patch.tobytes(), int(label)) for patch, label in zip(patches.numpy(), labels.numpy()))
+    assert seen == expected
+
+def test_subset_shares_the_padded_cube(dataset):
+    subset = dataset.subset(np.arange(0, len(dataset), 3))
+    assert len(subset) == -(-len(dataset) // 3)
+    np.testing.assert_array_equal(subset[1][0].numpy(), dataset[3][0].numpy())
+    assert subset.padded_path == dataset.padded_path and subset._shared_cube is dataset._shared_cube
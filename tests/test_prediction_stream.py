@@ -0,0 +1,49 @@
+import json
+import base64
+
+import numpy as np
+import pytest
+
+from modules.model_handler import summarize_prediction
+from modules.inference_engine import InferenceEngine, InferenceConfig
+from modules.map_encoding import decode_map
+from modules.prediction_stream import RunningClassCounts, block_message, sse_event
+from tests.conftest import TILE_SIZE
+
+def block_labels(message):
+    """The labels of a block message, as a client would decode them."""
+    shape = (message['row_stop'] - message['row_start'], message['width'])
+    if 'encoding' not in message:
+        return np.array(message['prediction_map']).reshape(shape)
+    data = message['data'] if isinstance(message['data'], bytes) else base64.b64decode(message['data'])
+    headers = {'X-Map-Encoding': message['encoding'], 'X-Map-Dtype': message['dtype'],
+               'X-Map-Shape': ','.join(map(str, shape))}
+    if 'runs' in message:
+        headers['X-Map-Runs'] = str(message['runs'])
+    return decode_map(data, headers)
+
+@pytest.mark.parametrize('map_format, binary', [('json', False), ('raw', False), ('rle', False), ('png', True)])
+def test_blocks_rebuild_the_map_and_its_counts(model, cube, map_format, binary):
+    counts, messages = RunningClassCounts(), []
+
+    def on_block(r0, r1, labels):
+        counts.add(labels)
+        messages.append(block_message(r0, r1, labels, counts.summary(), cube.shape[0], map_format, binary))
+
+    prediction_map = InferenceEngine(model, InferenceConfig(mode='dense', tile_size=TILE_SIZE)).run(
+        cube, block_callback=on_block)[0]
+    assert len(messages) > 1
+    assert [message['row_start'] for message in messages] == [0] + [message['row_stop'] for message in messages[:-1]]
+    np.testing.assert_array_equal(np.concatenate([block_labels(message) for message in messages]), prediction_map)
+    assert messages[-1]['class_summary'] == summarize_prediction(prediction_map)
+    json.dumps(messages if not binary else [{**m, 'data': None} for m in messages])  # JSON-safe apart from attachments
+
+def test_sse_event_frame():
+    frame = sse_event('block', {'row_start': 0, 'class_summary': []})
+    assert frame.endswith('\n\n')
+    event, data = frame.strip().split('\n')
+    assert event == 'event: block' and json.loads(data[len('data: '):]) == {'row_start': 0, 'class_summary': []}
+
+def test_unknown_block_format_is_rejected():
+    with pytest.raises(ValueError):
+        block_message(0, 1, np.zeros((1, 4), dtype=np.uint8), [], 1, 'tiff')
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import torch
+
+from modules.inference_engine import InferenceEngine, InferenceConfig
+from modules.map_encoding import decode_map
+from modules.spectral_indices import decode_raster
+from modules.probability_maps import probability_outputs, encode_probability_layer
+from tests.conftest import HEIGHT, WIDTH, TILE_SIZE
+
+def test_probability_maps_match_between_modes(model, cube):
+    dense = InferenceEngine(model, InferenceConfig(mode='dense', tile_size=TILE_SIZE)).run(cube, top_k=3)
+    patch = InferenceEngine(model, InferenceConfig(mode='patch', tile_size=TILE_SIZE)).run(cube, top_k=3)
+    np.testing.assert_array_equal(dense[0], patch[0])
+    np.testing.assert_array_equal(dense[2]['top_k_labels'], patch[2]['top_k_labels'])
+    np.testing.assert_allclose(dense[2]['confidence'].astype(np.float32), patch[2]['confidence'].astype(np.float32),
+                               atol=1e-3)
+
+@pytest.mark.parametrize('top_k', [1, 3, 6])
+def test_outputs_match_softmax(top_k):
+    logits = torch.from_numpy(np.random.default_rng(12).normal(size=(50, 4)).astype(np.float32))
+    labels, outputs = probability_outputs(logits, top_k)
+    probabilities = torch.softmax(logits, dim=-1).numpy()
+    ranked = np.sort(probabilities, axis=-1)[:, ::-1]
+    np.testing.assert_array_equal(labels, probabilities.argmax(axis=-1) + 1)
+    np.testing.assert_allclose(outputs['confidence'], ranked[:, 0], atol=1e-3)
+    np.testing.assert_allclose(outputs['margin'], ranked[:, 0] - ranked[:, 1], atol=1e-3)
+    kept = min(top_k, 4)
+    np.testing.assert_array_equal(outputs['top_k_labels'][:, :kept], np.argsort(-probabilities, axis=-1)[:, :kept] + 1)
+    np.testing.assert_allclose(outputs['top_k_probabilities'][:, :kept], ranked[:, :kept], atol=1e-3)
+    assert not outputs['top_k_labels'][:, kept:].any() and not outputs['top_k_probabilities'][:, kept:].any()
+
+def test_masked_maps_are_zero_outside_the_mask(model, cube):
+    mask = np.zeros((HEIGHT, WIDTH), dtype=bool)
+    mask[3:9, 5:20] = True
+    engine = InferenceEngine(model, InferenceConfig(mode='dense', tile_size=TILE_SIZE))
+    full, masked = engine.run(cube, top_k=2)[2], engine.run(cube, mask=mask, top_k=2)[2]
+    for layer, values in masked.items():
+        np.testing.assert_array_equal(values[mask], full[layer][mask])
+        assert not values[~mask].any()
+
+def test_layers_round_trip(model, cube):
+    maps = InferenceEngine(model, InferenceConfig(mode='dense', tile_size=TILE_SIZE)).run(cube, top_k=2)[2]
+    body, _, headers = encode_probability_layer(maps, 'confidence')
+    np.testing.assert_array_equal(decode_raster(body, headers), maps['confidence'])
+    body, _, headers = encode_probability_layer(maps, 'top_k_labels', rank=2, fmt='rle')
+    np.testing.assert_array_equal(decode_map(body, headers), maps['top_k_labels'][..., 1])
+    assert headers['X-Probability-Layer'] == 'top_k_labels;rank=2'
+    with pytest.raises(ValueError):
+        encode_probability_layer(maps, 'top_k_labels', rank=3)
@@ -0,0 +1,39 @@
+import os
+import time
+
+import numpy as np
+
+from modules.result_cache import ResultCache
+
+def entry(seed, size=64):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, 17, (size, size))
+    return labels, [{'crop_type_id': 1, 'pixel_count': int((labels == 1).sum())}], {'confidence': rng.random((size, size))}
+
+def test_round_trip_through_disk(tmp_path):
+    labels, summary, probability_maps = entry(0)
+    ResultCache(str(tmp_path)).put('a', labels, summary, probability_maps)
+    cache = ResultCache(str(tmp_path))  # A fresh process: nothing in memory
+    prediction_map, class_summary, layers = cache.get('a')
+    np.testing.assert_array_equal(prediction_map, labels)
+    assert prediction_map.dtype == np.uint8 and not prediction_map.flags.writeable
+    assert class_summary == summary
+    np.testing.assert_array_equal(layers['confidence'], probability_maps['confidence'])
+    assert cache.get('b') is None and cache.stats()['misses'] == 1
+
+def test_oldest_files_are_pruned_beyond_the_disk_budget(tmp_path):
+    cache = ResultCache(str(tmp_path), max_memory_bytes=0)
+    cache.put('first', *entry(1))
+    file_bytes = os.path.getsize(tmp_path / 'first.npz')
+    cache.max_disk_bytes = int(2.2 * file_bytes)
+    now = time.time()
+    os.utime(tmp_path / 'first.npz', (now - 20, now - 20))
+    cache.put('second', *entry(2))
+    os.utime(tmp_path / 'second.npz', (now - 10, now - 10))
+    assert sorted(os.listdir(tmp_path)) == ['first.npz', 'second.npz']
+
+    cache.put('third', *entry(3))  # Over budget: the oldest files go until 80% of it is left
+    assert sorted(os.listdir(tmp_path)) == ['third.npz']
+    assert cache.stats()['disk_bytes'] <= cache.max_disk_bytes
+    assert cache.get('first') is None
+    np.testing.assert_array_equal(cache.get('third')[0], entry(3)[0])
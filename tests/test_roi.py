@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from modules.inference_engine import InferenceEngine, InferenceConfig
+from modules.roi import parse_roi, roi_mask
+from modules.spectral_signatures import region_statistics, batch_signatures
+from tests.conftest import HEIGHT, WIDTH, TILE_SIZE
+
+def roi():
+    """A region of interest with a dense block, a sparse diagonal and an isolated pixel."""
+    mask = np.zeros((HEIGHT, WIDTH), dtype=bool)
+    mask[2:10, 3:11] = True
+    mask[np.arange(HEIGHT), np.arange(HEIGHT) % WIDTH] = True
+    mask[HEIGHT - 1, WIDTH - 1] = True
+    return mask
+
+@pytest.mark.parametrize('mode', ['dense', 'patch'])
+def test_masked_matches_full(model, cube, mode):
+    full_map = InferenceEngine(model, InferenceConfig(mode='dense', tile_size=TILE_SIZE)).run(cube)[0]
+    mask = roi()
+    masked_map = InferenceEngine(model, InferenceConfig(mode=mode, tile_size=TILE_SIZE)).run(cube, mask=mask)[0]
+    np.testing.assert_array_equal(masked_map[mask], full_map[mask])
+    assert not masked_map[~mask].any()
+
+@pytest.mark.parametrize('bbox, rows, cols', [
+    ('2,3,6,8', (3, 8), (2, 6)),
+    ('-5,-5,4,4', (0, 4), (0, 4)),
+    ('20,15,99,99', (15, HEIGHT), (20, WIDTH)),
+])
+def test_bbox_mask(bbox, rows, cols):
+    expected = np.zeros((HEIGHT, WIDTH), dtype=bool)
+    expected[rows[0]:rows[1], cols[0]:cols[1]] = True
+    np.testing.assert_array_equal(roi_mask(parse_roi(bbox=bbox), HEIGHT, WIDTH), expected)
+
+@pytest.mark.parametrize('bbox', ['-10,-10,-2,-2', f'{WIDTH},{HEIGHT},{WIDTH + 5},{HEIGHT + 5}'])
+def test_bbox_outside_the_scene_selects_nothing(bbox):
+    assert not roi_mask(parse_roi(bbox=bbox), HEIGHT, WIDTH).any()
+
+@pytest.mark.parametrize('bbox', ['5,5,5,9', '5,5,9,5', '9,2,4,6', '1,2,3', [0, 0, float('inf'), 4]])
+def test_bad_bbox_is_rejected(bbox):
+    with pytest.raises(ValueError):
+        parse_roi(bbox=bbox)
+
+def test_polygon_mask():
+    mask = roi_mask(parse_roi(polygon='[[2, 2], [8, 2], [8, 6], [2, 6]]'), HEIGHT, WIDTH)
+    expected = np.zeros((HEIGHT, WIDTH), dtype=bool)
+    expected[2:6, 2:8] = True  # Pixel centres inside the square
+    np.testing.assert_array_equal(mask, expected)
+    assert not roi_mask(parse_roi(polygon=[[-9, -9], [-5, -9], [-5, -5]]), HEIGHT, WIDTH).any()
+
+@pytest.mark.parametrize('polygon', ['[[0, 0], [1e999, 0], [0, 5]]', '[[0, 0], [NaN, 0], [0, 5]]', '[[0, 0], [1, 1]]',
+                                     'not json', '[[0, 0], [1, "a"], [0, 5]]'])
+def test_bad_polygon_is_rejected(polygon):
+    with pytest.raises(ValueError):
+        parse_roi(polygon=polygon)
+
+def test_signature_regions_clip_and_validate_like_roi_masks(cube):
+    region = region_statistics(cube, {'type': 'rect', 'x0': -5, 'y0': 15, 'x1': 4, 'y1': 99})
+    mask = roi_mask(parse_roi(bbox='-5,15,4,99'), HEIGHT, WIDTH)
+    assert region['pixels'] == mask.sum() and region['bbox'] == [0, 15, 4, HEIGHT]
+    np.testing.assert_allclose(region['mean'], cube[mask].mean(axis=0), rtol=1e-6)
+    for bad in ({'type': 'rect', 'x0': 9, 'y0': 0, 'x1': 4, 'y1': 5}, {'type': 'rect', 'x0': 0, 'y0': 0, 'x1': 1e999, 'y1': 5},
+                {'type': 'polygon', 'points': [[0, 0], [float('inf'), 0], [0, 5]]}):
+        with pytest.raises(ValueError):
+            batch_signatures(cube, regions=[bad])
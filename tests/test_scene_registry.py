@@ -0,0 +1,53 @@
+import threading
+
+import numpy as np
+import pytest
+import scipy.io
+
+from modules.scene_registry import SceneRegistry, SceneInfo, UnknownSceneError
+
+SCENE_IDS = ('a', 'b', 'c')
+
+@pytest.fixture
+def registry(tmp_path):
+    rng = np.random.default_rng(9)
+    for scene_id in SCENE_IDS:
+        scipy.io.savemat(tmp_path / f'{scene_id}.mat', {'cube': rng.integers(0, 1000, (20, 24, 16)).astype(np.uint16)})
+    scenes = [SceneInfo(scene_id, scene_id.upper(), f'{scene_id}.mat') for scene_id in SCENE_IDS]
+    # Uncached cubes are held in memory, so each counts against the budget
+    return SceneRegistry(data_folder=str(tmp_path), use_cache=False, upload_folder=str(tmp_path / 'uploads'),
+                         scenes=scenes)
+
+def test_least_recently_used_scene_is_evicted(registry):
+    scene_bytes = registry.load('a').nbytes
+    registry.memory_budget_bytes = int(2.5 * scene_bytes)
+    registry.load('b')
+    assert registry.load('a') is registry.load('a')  # Resident, and now the most recently used
+    registry.load('c')
+    stats = registry.stats()
+    assert stats['resident'] == ['a', 'c'] and stats['evictions'] == 1
+    assert stats['resident_bytes'] <= registry.memory_budget_bytes
+    assert registry.load('b').info.bands == 16 and registry.stats()['loads'] == 4
+
+def test_a_scene_over_budget_stays_resident_alone(registry):
+    registry.memory_budget_bytes = 1
+    registry.load('a')
+    registry.load('b')
+    assert registry.stats()['resident'] == ['b']
+
+def test_concurrent_requests_share_one_load(registry):
+    scenes = [None] * 4
+
+    def load(index):
+        scenes[index] = registry.load('a')
+
+    threads = [threading.Thread(target=load, args=(index,)) for index in range(len(scenes))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(scene is scenes[0] for scene in scenes) and registry.stats()['loads'] == 1
+
+def test_unknown_scene_is_rejected(registry):
+    with pytest.raises(UnknownSceneError):
+        registry.load('missing')
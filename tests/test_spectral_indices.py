@@ -0,0 +1,45 @@
+import io
+import os
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from modules.spectral_indices import SpectralIndex, IndexExpressionError, IndexCache, encode_raster, decode_raster
+from tests.conftest import HEIGHT, WIDTH, BANDS
+
+@pytest.mark.parametrize('expression', ['sqrt()', 'sqrt(b1, b2, b3)', 'abs(b1, b2)', 'minimum(b1)', 'sqrt + b1'])
+def test_index_function_arity_is_checked(expression):
+    with pytest.raises(IndexExpressionError):
+        SpectralIndex(expression, BANDS)
+
+def test_index_matches_numpy(cube):
+    index = SpectralIndex('maximum(abs(b1 - b2), sqrt(b3)) / (b1 + b2)', BANDS)
+    b1, b2, b3 = (cube[..., band].astype(np.float32) for band in (1, 2, 3))
+    np.testing.assert_allclose(index.compute(cube), np.maximum(np.abs(b1 - b2), np.sqrt(b3)) / (b1 + b2), rtol=1e-6)
+
+def test_raster_round_trip():
+    raster = np.random.default_rng(4).uniform(-1, 1, (HEIGHT, WIDTH)).astype(np.float32)
+    raster[0, :3] = np.nan
+    decoded = {fmt: decode_raster(*encode_raster(raster, fmt)[::2]) for fmt in ('f32', 'f16', 'png')}
+    np.testing.assert_array_equal(decoded['f32'], raster)
+    np.testing.assert_allclose(decoded['f16'], raster, atol=1e-3)
+    np.testing.assert_allclose(decoded['png'], raster, atol=1 / 255 + 1e-6)
+    for values in decoded.values():
+        np.testing.assert_array_equal(np.isnan(values), np.isnan(raster))
+    assert Image.open(io.BytesIO(encode_raster(raster, 'png')[0])).mode == 'LA'
+
+def test_index_cache_prunes_the_oldest_rasters(tmp_path, cube):
+    cache = IndexCache(str(tmp_path), max_memory_bytes=0)
+    expressions = ['b1 + b2', 'b1 - b2', 'b1 * b2']
+    cache.get_or_compute(expressions[0], lambda: SpectralIndex(expressions[0], BANDS).compute(cube))
+    cache.max_disk_bytes = int(2.2 * os.path.getsize(tmp_path / f'{expressions[0]}.npy'))
+    now = time.time()
+    for age, expression in zip((20, 10, 0), expressions):
+        raster = cache.get_or_compute(expression, lambda: SpectralIndex(expression, BANDS).compute(cube))
+        os.utime(tmp_path / f'{expression}.npy', (now - age, now - age))
+    assert sorted(os.listdir(tmp_path)) == [f'{expressions[2]}.npy']
+    assert cache.stats()['disk_bytes'] <= cache.max_disk_bytes
+    np.testing.assert_array_equal(cache.get(expressions[2]), raster)
+    assert cache.get(expressions[0]) is None
@@ -0,0 +1,55 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from modules.data_handler import stretch_to_uint8
+from modules.tile_pyramid import TilePyramid, TileCache
+from tests.conftest import HEIGHT, WIDTH, TILE_SIZE
+
+RGB = (3, 2, 1)
+
+def rgba(data):
+    return np.asarray(Image.open(io.BytesIO(data)).convert('RGBA'))
+
+@pytest.fixture
+def pyramid(cube, tmp_path):
+    return TilePyramid(cube, 'f' * 40, TileCache(str(tmp_path)), RGB, tile_size=TILE_SIZE)
+
+def test_deepest_level_tiles_the_stretched_scene(cube, pyramid):
+    assert pyramid.max_zoom == 2 and pyramid.tile_count(2) == (3, 3)
+    low, high = pyramid.stretch_range
+    expected = stretch_to_uint8(cube[..., list(RGB)], low, high)
+    columns, rows = pyramid.tile_count(2)
+    mosaic = np.concatenate([np.concatenate([rgba(pyramid.tile_png(2, x, y)) for x in range(columns)], axis=1)
+                             for y in range(rows)])
+    np.testing.assert_array_equal(mosaic[:HEIGHT, :WIDTH, :3], expected)
+    assert (mosaic[:HEIGHT, :WIDTH, 3] == 255).all() and not mosaic[HEIGHT:, :, 3].any()
+
+def test_parent_tiles_average_their_children(pyramid):
+    children = np.concatenate([np.concatenate([rgba(pyramid.tile_png(2, x, y)) for x in (0, 1)], axis=1)
+                               for y in (0, 1)]).astype(np.float64)
+    expected = children.reshape(TILE_SIZE, 2, TILE_SIZE, 2, 4).mean(axis=(1, 3))
+    np.testing.assert_allclose(rgba(pyramid.tile_png(1, 0, 0)), expected, atol=0.5 + 1e-9)
+
+def test_tiles_are_cached_on_disk(cube, pyramid, tmp_path):
+    data = pyramid.tile_png(2, 1, 1)
+    assert pyramid.tile_png(2, 1, 1) == data and pyramid.cache.stats()['hits'] == 1
+    fresh = TilePyramid(cube, 'f' * 40, TileCache(str(tmp_path)), RGB, tile_size=TILE_SIZE)
+    assert fresh.tile_png(2, 1, 1) == data and fresh.cache.stats()['hits'] == 1
+
+def test_etags_follow_content_and_style_without_rendering(cube, pyramid, tmp_path):
+    etag = pyramid.etag(2, 1, 1)
+    assert etag.startswith('"') and etag == TilePyramid(cube, 'f' * 40, pyramid.cache, RGB, tile_size=TILE_SIZE).etag(2, 1, 1)
+    others = {pyramid.etag(2, 1, 0), pyramid.etag('preview'),
+              TilePyramid(cube, 'e' * 40, pyramid.cache, RGB, tile_size=TILE_SIZE).etag(2, 1, 1),
+              TilePyramid(cube, 'f' * 40, pyramid.cache, (0, 1, 2), tile_size=TILE_SIZE).etag(2, 1, 1),
+              TilePyramid(cube, 'f' * 40, pyramid.cache, RGB, (1, 99), tile_size=TILE_SIZE).etag(2, 1, 1)}
+    assert etag not in others and len(others) == 5
+    assert pyramid.cache.stats()['misses'] == 0  # Nothing was rendered
+
+@pytest.mark.parametrize('z, x, y', [(3, 0, 0), (2, 3, 0), (0, 1, 0), (-1, 0, 0)])
+def test_tiles_outside_the_pyramid_are_rejected(pyramid, z, x, y):
+    with pytest.raises(IndexError):
+        pyramid.tile_png(z, x, y)
@@ -4,14 +4,19 @@ from sklearn.model_selection import train_test_split
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader, TensorDataset
 
 from modules.data_handler import load_hyperspectral_data
-from modules.model_handler import prepare_training_data, CropClassifier, PATCH_SIZE
+from modules.model_handler import CropClassifier, PATCH_SIZE
+from modules.patch_dataset import PatchDataset, patch_loader
+from modules.spectral_reduction import SpectralReducer, parse_reduction, reducer_path
 
 # --- Configuration ---
 DATA_PATH = 'data'
 MODEL_SAVE_PATH = os.path.join('models', 'crop_classifier.pth') # PyTorch models typically .pth
+PADDED_CUBE_PATH = os.path.join(DATA_PATH, 'cache', 'train_padded_cube.npy') # Memory-mapped by every loader worker; None keeps it in shared memory
+BATCH_SIZE = 64
+NUM_WORKERS = int(os.getenv('TRAIN_NUM_WORKERS', min(4, os.cpu_count() or 1))) # DataLoader processes cutting patches
+SPECTRAL_REDUCTION = os.getenv('SPECTRAL_REDUCTION', '') # e.g. 'pca:30' or 'bands:40'; empty trains on the full spectrum
 
 def main():
     """Main function to execute the training pipeline."""
@@ -29,25 +34,34 @@ def main():
 
     # 2. Prepare Data for Training
     print("Step 2/5: Preparing data for training...")
-    X, y = prepare_training_data(hypercube, ground_truth)
-    print(f"Data prepared. Number of patches: {len(X)}")
+    # Patches are cut per batch from one padded cube instead of being materialized up front
+    dataset = PatchDataset.from_scene(hypercube, ground_truth, PATCH_SIZE, padded_path=PADDED_CUBE_PATH)
+    y = dataset.labels
+    print(f"Data prepared. Number of patches: {len(dataset)}")
 
     # 3. Split Data
     print("Step 3/5: Splitting data into training and validation sets...")
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42, stratify=y)
-    print(f"Training samples: {len(X_train)}, Validation samples: {len(X_test)}")
-
-    # Create TensorDatasets and DataLoaders
-    train_dataset = TensorDataset(X_train, y_train)
-    test_dataset = TensorDataset(X_test, y_test)
-
-    train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True)
-    test_loader = DataLoader(test_dataset, batch_size=64, shuffle=False)
+    train_indices, test_indices = train_test_split(np.arange(len(dataset)), test_size=0.2, random_state=42, stratify=y.numpy())
+
+    # Optional spectral reduction, fitted on the training pixels only; the patches are then cut from the reduced cube
+    reducer = None
+    reduction = parse_reduction(SPECTRAL_REDUCTION)
+    if reduction is not None:
+        method, components = reduction
+        reducer = SpectralReducer.fit(hypercube, dataset.coords[train_indices], y.numpy()[train_indices], components, method)
+        dataset = PatchDataset.from_scene(reducer.transform_cube(hypercube), ground_truth, PATCH_SIZE, padded_path=PADDED_CUBE_PATH)
+        print(f"Spectral reduction: {method}, {hypercube.shape[2]} -> {reducer.components} bands")
+    train_dataset = dataset.subset(train_indices)
+    test_dataset = dataset.subset(test_indices)
+    print(f"Training samples: {len(train_dataset)}, Validation samples: {len(test_dataset)}")
+
+    train_loader = patch_loader(train_dataset, batch_size=BATCH_SIZE, shuffle=True, num_workers=NUM_WORKERS)
+    test_loader = patch_loader(test_dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=NUM_WORKERS)
 
     # 4. Create Model, Loss Function, and Optimizer
     print("Step 4/5: Creating model, loss function, and optimizer...")
     num_classes = len(torch.unique(y))
-    model = CropClassifier(num_classes=num_classes)
+    model = CropClassifier(num_classes=num_classes, num_bands=reducer.components if reducer else hypercube.shape[2])
     
     # Move model to GPU if available
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -107,6 +121,8 @@ def main():
             epochs_no_improve = 0
             # Save the best model
             torch.save(model.state_dict(), MODEL_SAVE_PATH)
+            if reducer is not None:
+                reducer.save(reducer_path(MODEL_SAVE_PATH))
             print(f"Model saved to {MODEL_SAVE_PATH}")
         else:
             epochs_no_improve += 1